@@ -1,10 +1,13 @@
 import os
 import sys
-__all__ = ['Workbook', 'CellError', 'CellErrorType']
+__all__ = ['Workbook', 'CellError', 'CellErrorType', 'NotifyDispatcher',
+           'AsyncioNotifyDispatcher', 'BLOCK', 'MERGE', 'DROP']
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 from cellerror import CellError, CellErrorType
 from workbook import Workbook
+from notify_dispatcher import (NotifyDispatcher, AsyncioNotifyDispatcher,
+                               BLOCK, MERGE, DROP)
 import version_file
 
 version = version_file.version
@@ -0,0 +1,174 @@
+'''
+This file contains code for the binary workbook format. Besides the contents
+of every cell, a binary workbook stores each cell's cached value, the
+references its formula read and the workbook's dependency graphs, with the
+topological order kept for them, so opening it does not need to parse or
+evaluate any formulas.
+
+A file starts with a magic string followed by two pickles: a header with the
+engine version and a hash of the formula grammar the values were computed
+with, then the body. Only plain data and Decimals are pickled, and the
+unpickler refuses to construct anything else.
+'''
+
+import decimal
+import gc
+import hashlib
+import pickle
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import BinaryIO
+
+import version_file
+from lark_impl import GRAMMAR_PATH
+from cellerror import CellError, CellErrorType
+
+MAGIC = b'SHEETSWB'
+FORMAT_VERSION = 4
+
+
+@lru_cache(maxsize=None)
+def grammar_hash():
+    '''
+    Returns a hash of the formula grammar file. Cached values computed with a
+    different grammar may not be what the current engine would compute.
+    '''
+    with open(GRAMMAR_PATH, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def current_header():
+    '''
+    Returns the header describing the engine that is writing a file.
+    '''
+    return (FORMAT_VERSION, version_file.version, grammar_hash())
+
+
+def encode_value(value):
+    '''
+    Converts a cell value into plain data. Cell errors become (type, detail)
+    tuples; their original exception is not stored.
+    '''
+    if isinstance(value, CellError):
+        return (value.get_type().value, value.get_detail())
+    return value
+
+
+def decode_value(value):
+    '''
+    Converts a stored cell value back, the inverse of encode_value.
+    '''
+    if isinstance(value, tuple):
+        return CellError(CellErrorType(value[0]), value[1])
+    return value
+
+
+class DataUnpickler(pickle.Unpickler):
+    '''
+    An unpickler that only loads plain data and Decimals, so that opening a
+    file cannot run arbitrary code.
+    '''
+
+    def find_class(self, module, name):
+        if module == 'decimal' and name == 'Decimal':
+            return decimal.Decimal
+        raise pickle.UnpicklingError(f'{module}.{name} is not allowed.')
+
+
+def share_cells(graph, shared):
+    '''
+    Returns a copy of a dependency graph in which equal (sheet, location)
+    tuples are the same object, so pickle writes each of them only once.
+    '''
+    return {sheet_name: {location: {shared.setdefault(cell, cell)
+                                    for cell in cells}
+                         for (location, cells) in sheet_graph.items()}
+            for (sheet_name, sheet_graph) in graph.items()}
+
+
+def share_order(keys, shared):
+    '''
+    Returns a copy of the keys of a TopologicalOrder that uses the same
+    (sheet, location) tuples as share_cells.
+    '''
+    return {(frozenset(shared.setdefault(cell, cell) for cell in node)
+             if isinstance(node, frozenset) else shared.setdefault(node, node)):
+            key for (node, key) in keys.items()}
+
+
+@contextmanager
+def gc_paused():
+    '''
+    Pauses the garbage collector while a workbook is opened. Opening creates
+    many small containers, none of which are in reference cycles, and every
+    collection would also scan whatever else is already in memory.
+    '''
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def write_workbook(fp: BinaryIO, sheets, forward_graph, backward_graph,
+                   range_graph, order_keys, self_loops):
+    '''
+    Writes a binary workbook to fp.
+
+    Parameters:
+        fp (BinaryIO): the already opened binary file to write to
+        sheets (list): (sheet name, list of (location, contents, value,
+            sheet_name_dict, refs)) pairs
+        forward_graph (dict): the forward direction of the workbook's
+            DependencyGraph
+        backward_graph (dict): the backward direction of the workbook's
+            DependencyGraph
+        range_graph (dict): the range dependencies of the workbook's
+            DependencyGraph, from get_range_dependents()
+        order_keys (dict): the keys of the DependencyGraph's TopologicalOrder
+        self_loops (set): the cells of the TopologicalOrder that depend on
+            themselves
+    '''
+    fp.write(MAGIC)
+    # the header and body share one pickler, and so must share one unpickler
+    pickler = pickle.Pickler(fp, protocol=pickle.HIGHEST_PROTOCOL)
+    pickler.dump(current_header())
+    shared = {}
+    pickler.dump({'sheets': sheets,
+                  'forward_graph': share_cells(forward_graph, shared),
+                  'backward_graph': share_cells(backward_graph, shared),
+                  'range_graph': share_cells(range_graph, shared),
+                  'order_keys': share_order(order_keys, shared),
+                  'self_loops': {shared.setdefault(cell, cell)
+                                 for cell in self_loops}})
+
+
+def read_workbook(fp: BinaryIO):
+    '''
+    Reads a binary workbook from fp.
+
+    If the input is not a binary workbook, or it is truncated or corrupt, a
+    ValueError is raised.
+
+    Parameters:
+        fp (BinaryIO): the already opened binary file to read from
+
+    Returns:
+        (bool, dict): whether the cached values and graphs were written by
+            this engine version with this grammar, and the body written by
+            write_workbook
+    '''
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a binary workbook file.')
+    try:
+        unpickler = DataUnpickler(fp)
+        header = unpickler.load()
+        body = unpickler.load()
+    except (pickle.UnpicklingError, EOFError, AttributeError, IndexError,
+            TypeError) as e:
+        raise ValueError('Binary workbook file is corrupt.') from e
+    if not isinstance(body, dict):
+        raise ValueError('Binary workbook file is corrupt.')
+    return header == current_header(), body
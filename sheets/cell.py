@@ -0,0 +1,53 @@
+'''
+This file contains code relating to a cell object.
+'''
+
+# the references of a cell that does not read any other cells
+NO_REFS = ()
+
+
+class Cell:
+    '''
+    A cell in a sheet. Every cell holds its contents and value. Formula cells
+    also hold their compiled formula, the sheet names and cells written in the
+    formula, and the references the formula read when it was last evaluated;
+    other cells leave these as None and NO_REFS.
+
+    The sheet_name_dict of a formula cell is the one compiled with the
+    formula, shared by every cell with the same formula text, so it must be
+    replaced rather than changed in place. Cells themselves are shared by a
+    sheet and its copies too, so a sheet replaces a cell instead of changing
+    it.
+
+    A formula that was moved or copied is stored without its text, which is
+    written out from the compiled formula when the contents are first read.
+    '''
+
+    __slots__ = ('text', 'value', 'formula', 'sheet_name_dict', 'refs')
+
+    def __init__(self, contents, value, formula=None, sheet_name_dict=None,
+                 refs=NO_REFS):
+        self.text = contents
+        self.value = value
+        self.formula = formula
+        self.sheet_name_dict = sheet_name_dict
+        self.refs = refs
+
+    @property
+    def contents(self):
+        if self.text is None and self.formula is not None:
+            self.text = self.formula.get_text()
+        return self.text
+
+    @contents.setter
+    def contents(self, contents):
+        self.text = contents
+
+    def has_contents(self):
+        '''
+        Returns whether the cell has contents, without writing them out.
+        '''
+        return self.text is not None or self.formula is not None
+
+    def __repr__(self):
+        return f'Cell({self.contents!r}, {self.value!r})'
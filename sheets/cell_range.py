@@ -0,0 +1,28 @@
+'''
+This file contains code relating to a cell range object.
+'''
+
+
+class CellRange:
+    '''
+    A rectangular range of cells on one sheet, such as the A1:B5 in
+    =SUM(A1:B5). Columns and rows are 1-based numbers, and the corners are
+    normalized so that (left_col, top_row) is the top-left corner.
+    '''
+
+    def __init__(self, sheet_name, left_col, top_row, right_col, bot_row):
+        self.sheet_name = sheet_name
+        self.left_col = left_col
+        self.top_row = top_row
+        self.right_col = right_col
+        self.bot_row = bot_row
+
+    def width(self):
+        return self.right_col - self.left_col + 1
+
+    def height(self):
+        return self.bot_row - self.top_row + 1
+
+    def __repr__(self):
+        return (f'CellRange({self.sheet_name!r}, {self.left_col}, '
+                f'{self.top_row}, {self.right_col}, {self.bot_row})')
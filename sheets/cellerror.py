@@ -58,3 +58,8 @@ class CellError(BaseException):
 
     def __repr__(self) -> str:
         return self.__str__()
+
+    def __reduce__(self):
+        # exceptions are pickled from their args, which this class does not
+        # set, so the constructor arguments are given here instead
+        return (CellError, (self._error_type, self._detail, self._exception))
@@ -0,0 +1,574 @@
+'''
+This file contains the dependency graph of a workbook, which records which
+cells each formula depends on and, the other way around, which formulas
+depend on each cell.
+'''
+
+from contextlib import contextmanager
+
+from lark_impl import num_to_col
+from sheet import location_to_coords
+from topological_order import TopologicalOrder
+
+# the dependents or precedents of a cell that has none
+NO_CELLS = frozenset()
+
+# the size of the blocks of cells a RangeIndex files its ranges under
+BLOCK_ROWS = 64
+BLOCK_COLS = 16
+
+# ranges that cover more blocks than this are kept in a single list instead
+MAX_RANGE_BLOCKS = 256
+
+
+class RangeIndex:
+    '''
+    A spatial index of the cell ranges that formulas depend on in one sheet.
+
+    A range is a (left col, top row, right col, bottom row) tuple of numbers.
+    The sheet is divided into a grid of blocks, and each range is filed under
+    every block it overlaps, so finding the ranges that contain a cell only
+    has to check the ranges filed under that cell's block. A range is stored
+    once however many formulas use it, and costs one entry per block rather
+    than one per cell.
+    '''
+
+    def __init__(self):
+        # maps each range to the set of cells that depend on it
+        self.dependents = {}
+
+        # maps (block row, block col) to the ranges overlapping that block
+        self.blocks = {}
+
+        # ranges too large to be filed under each of their blocks
+        self.large_ranges = set()
+
+    @staticmethod
+    def range_blocks(cell_range):
+        '''
+        Returns the (block row, block col) of every block a range overlaps.
+        '''
+        (left, top, right, bottom) = cell_range
+        return [(block_row, block_col)
+                for block_row in range((top - 1) // BLOCK_ROWS,
+                                       (bottom - 1) // BLOCK_ROWS + 1)
+                for block_col in range((left - 1) // BLOCK_COLS,
+                                       (right - 1) // BLOCK_COLS + 1)]
+
+    def add(self, cell_range, cell):
+        '''
+        Records that cell depends on every cell in a range.
+        '''
+        if cell_range in self.dependents:
+            self.dependents[cell_range].add(cell)
+            return
+        self.dependents[cell_range] = {cell}
+        blocks = self.range_blocks(cell_range)
+        if len(blocks) > MAX_RANGE_BLOCKS:
+            self.large_ranges.add(cell_range)
+            return
+        for block in blocks:
+            if block in self.blocks:
+                self.blocks[block].add(cell_range)
+            else:
+                self.blocks[block] = {cell_range}
+
+    def remove(self, cell_range, cell):
+        '''
+        Removes the record that cell depends on a range.
+        '''
+        cells = self.dependents[cell_range]
+        cells.discard(cell)
+        if cells:
+            return
+        del self.dependents[cell_range]
+        if cell_range in self.large_ranges:
+            self.large_ranges.discard(cell_range)
+            return
+        for block in self.range_blocks(cell_range):
+            ranges = self.blocks[block]
+            ranges.discard(cell_range)
+            if not ranges:
+                del self.blocks[block]
+
+    def find(self, location):
+        '''
+        Returns a list of the sets of cells depending on each range that
+        contains a location.
+        '''
+        (col, row) = location_to_coords(location)
+        block = ((row - 1) // BLOCK_ROWS, (col - 1) // BLOCK_COLS)
+        found = []
+        for ranges in (self.blocks.get(block, NO_CELLS), self.large_ranges):
+            for cell_range in ranges:
+                (left, top, right, bottom) = cell_range
+                if left <= col <= right and top <= row <= bottom:
+                    found.append(self.dependents[cell_range])
+        return found
+
+
+def range_contains(cell_range, location):
+    '''
+    Returns whether a (left, top, right, bottom) range contains a location.
+    '''
+    (col, row) = location_to_coords(location)
+    (left, top, right, bottom) = cell_range
+    return left <= col <= right and top <= row <= bottom
+
+
+class DependencyGraph:
+    '''
+    The dependencies between the cells of a workbook. Cells are
+    (sheet name, location) tuples with both parts in lower case.
+
+    Dependencies on single cells are stored in both directions as
+    dictionaries mapping sheet names to dictionaries that map locations to
+    sets of cells:
+        forward: a cell to the cells that depend on it
+        backward: a cell to the cells it depends on
+    Dependencies on cell ranges are stored as the ranges themselves, without
+    listing the cells they cover:
+        ranges: a sheet name to the RangeIndex of ranges in that sheet
+        range_backward: a cell to the set of (sheet name, range) it depends on
+    Cells without any edges in a direction have no entry in it, so a sheet
+    only appears in forward or ranges while some formula depends on one of its
+    cells, even if that sheet does not exist.
+
+    Changing a formula only applies the difference between its old and new
+    precedents, so the cost of an edit does not depend on how many other
+    formulas share those precedents.
+
+    The graph also keeps a TopologicalOrder of its cells, in order, which is
+    updated with every change to the edges.
+    '''
+
+    def __init__(self, forward=None, backward=None, range_dependents=None,
+                 order_keys=None, self_loops=None):
+        '''
+        Parameters:
+            forward (dict): an existing forward graph to use, for example one
+                read from a binary workbook
+            backward (dict): the backward graph matching forward
+            range_dependents (dict): maps sheet names to dictionaries that map
+                ranges to the cells that depend on them, as returned by
+                get_range_dependents()
+            order_keys (dict): the keys of the TopologicalOrder matching the
+                graph, computed from scratch if not given
+            self_loops (set): the cells that depend on themselves, given with
+                order_keys
+        '''
+        self.forward = {} if forward is None else forward
+        self.backward = {} if backward is None else backward
+        self.ranges = {}
+        self.range_backward = {}
+        for (sheet_name, sheet_ranges) in (range_dependents or {}).items():
+            for (cell_range, cells) in sheet_ranges.items():
+                for cell in cells:
+                    self.add_range_edge(sheet_name, cell_range, cell)
+        self.order = TopologicalOrder(self)
+        if order_keys is None:
+            self.order.rebuild()
+        else:
+            self.order.restore(order_keys, self_loops)
+
+    @contextmanager
+    def bulk_update(self):
+        '''
+        Context manager for making many changes at once, such as loading a
+        workbook. The order is not kept up to date during the changes, and is
+        computed once at the end.
+        '''
+        self.order.suspended = True
+        try:
+            yield
+        finally:
+            self.order.suspended = False
+            self.order.rebuild()
+
+    def get_range_dependents(self):
+        '''
+        Returns the range dependencies as a dictionary mapping sheet names to
+        dictionaries that map ranges to the cells that depend on them.
+        '''
+        return {sheet_name: index.dependents
+                for (sheet_name, index) in self.ranges.items()}
+
+    def dependents(self, sheet_name, location):
+        '''
+        Returns the set of cells that depend directly on a cell, either on
+        the cell itself or on a range containing it. The set must not be
+        changed.
+        '''
+        sheet_graph = self.forward.get(sheet_name)
+        if sheet_graph is None:
+            cells = NO_CELLS
+        else:
+            cells = sheet_graph.get(location, NO_CELLS)
+        index = self.ranges.get(sheet_name)
+        if index is None:
+            return cells
+        found = index.find(location)
+        if not found:
+            return cells
+        cells = set(cells)
+        for range_cells in found:
+            cells.update(range_cells)
+        return cells
+
+    def precedents(self, sheet_name, location):
+        '''
+        Returns the set of single cells that a cell depends on directly. The
+        set must not be changed.
+        '''
+        sheet_graph = self.backward.get(sheet_name)
+        if sheet_graph is None:
+            return NO_CELLS
+        return sheet_graph.get(location, NO_CELLS)
+
+    def range_precedents(self, sheet_name, location):
+        '''
+        Returns the set of (sheet name, range) that a cell depends on
+        directly. The set must not be changed.
+        '''
+        sheet_graph = self.range_backward.get(sheet_name)
+        if sheet_graph is None:
+            return NO_CELLS
+        return sheet_graph.get(location, NO_CELLS)
+
+    def has_precedents(self, sheet_name, location):
+        '''
+        Returns whether a cell depends on anything.
+        '''
+        return (location in self.backward.get(sheet_name, NO_CELLS) or
+                location in self.range_backward.get(sheet_name, NO_CELLS))
+
+    def depends_on_itself(self, sheet_name, location):
+        '''
+        Returns whether a cell depends directly on itself, either on its own
+        or through a range containing it.
+        '''
+        return ((sheet_name, location) in self.precedents(sheet_name, location)
+                or any(range_sheet == sheet_name and
+                       range_contains(cell_range, location)
+                       for (range_sheet, cell_range)
+                       in self.range_precedents(sheet_name, location)))
+
+    def cells_with_precedents(self, sheet_name=None):
+        '''
+        Returns a list of the cells that depend on anything, in one sheet or
+        in every sheet.
+        '''
+        if sheet_name is None:
+            sheet_names = self.backward.keys() | self.range_backward.keys()
+        else:
+            sheet_names = [sheet_name]
+        cells = []
+        for name in sheet_names:
+            locations = self.backward.get(name, {}).keys()
+            cells.extend((name, location) for location in locations)
+            cells.extend((name, location)
+                         for location in self.range_backward.get(name, {})
+                         if location not in locations)
+        return cells
+
+    def ordered_precedents(self, sheet_name, location):
+        '''
+        Returns the set of cells that a cell depends on directly, either on
+        its own or through a range, and that depend on something themselves.
+        These are the precedents that have a place in the order.
+        '''
+        found = {cell for cell in self.precedents(sheet_name, location)
+                 if self.has_precedents(*cell)}
+        for (range_sheet, cell_range) in self.range_precedents(sheet_name,
+                                                               location):
+            found.update(self.cells_with_precedents_in(range_sheet,
+                                                       cell_range))
+        return found
+
+    def cells_with_precedents_in(self, range_sheet, cell_range):
+        '''
+        Returns a list of the cells in a range that depend on anything. The
+        range is checked against whichever is smaller: the cells it covers,
+        or the cells of its sheet that depend on anything.
+        '''
+        (left, top, right, bottom) = cell_range
+        num_with_precedents = (len(self.backward.get(range_sheet, ())) +
+                               len(self.range_backward.get(range_sheet, ())))
+        if (right - left + 1) * (bottom - top + 1) <= num_with_precedents:
+            cols = [num_to_col(col) for col in range(left, right + 1)]
+            return [(range_sheet, col + str(row))
+                    for row in range(top, bottom + 1) for col in cols
+                    if self.has_precedents(range_sheet, col + str(row))]
+        return [cell for cell in self.cells_with_precedents(range_sheet)
+                if range_contains(cell_range, cell[1])]
+
+    def precedents_in(self, sheet_name, location, cells):
+        '''
+        Returns the set of cells from the given collection that a cell
+        depends on directly, either on its own or through a range. Each range
+        is checked against whichever is smaller: the collection, or the cells
+        the range covers.
+
+        Parameters:
+            sheet_name (str): the lower case name of the cell's sheet
+            location (str): the lower case location of the cell
+            cells (set or dict): (sheet name, location) tuples to look for
+        '''
+        found = {cell for cell in self.precedents(sheet_name, location)
+                 if cell in cells}
+        for (range_sheet, cell_range) in self.range_precedents(sheet_name,
+                                                               location):
+            (left, top, right, bottom) = cell_range
+            if (right - left + 1) * (bottom - top + 1) <= len(cells):
+                cols = [num_to_col(col) for col in range(left, right + 1)]
+                for row in range(top, bottom + 1):
+                    for col in cols:
+                        cell = (range_sheet, col + str(row))
+                        if cell in cells:
+                            found.add(cell)
+            else:
+                found.update(cell for cell in cells
+                             if cell[0] == range_sheet and
+                             range_contains(cell_range, cell[1]))
+        return found
+
+    def sheet_dependents(self, sheet_name):
+        '''
+        Returns the set of cells that depend on any cell in a sheet.
+        '''
+        cells = set()
+        for dependents in self.forward.get(sheet_name, {}).values():
+            cells.update(dependents)
+        if sheet_name in self.ranges:
+            for dependents in self.ranges[sheet_name].dependents.values():
+                cells.update(dependents)
+        return cells
+
+    def set_precedents(self, sheet_name, location, cells,
+                       ranges=NO_CELLS):
+        '''
+        Makes the given cells and ranges the precedents of a cell, adding and
+        removing only the edges that changed.
+
+        Parameters:
+            sheet_name (str): the lower case name of the cell's sheet
+            location (str): the lower case location of the cell
+            cells (iterable): the (sheet name, location) tuples it depends on
+            ranges (iterable): the (sheet name, range) tuples it depends on
+        '''
+        cell = (sheet_name, location)
+        new_cells = set(cells)
+        old_cells = self.precedents(sheet_name, location)
+        new_ranges = set(ranges)
+        old_ranges = self.range_precedents(sheet_name, location)
+        if new_cells == old_cells and new_ranges == old_ranges:
+            return
+
+        # the removed edges are taken out and the order updated before any
+        # edges are added, so the order only has to handle one kind of change
+        # at a time
+        removed_cells = old_cells - new_cells
+        removed_ranges = old_ranges - new_ranges
+        if removed_cells or removed_ranges:
+            for (curr_name, curr_loc) in removed_cells:
+                self.remove_edge(self.forward, curr_name, curr_loc, cell)
+            for (range_sheet, cell_range) in removed_ranges:
+                index = self.ranges[range_sheet]
+                index.remove(cell_range, cell)
+                if not index.dependents:
+                    del self.ranges[range_sheet]
+            self.set_entry(self.backward, sheet_name, location,
+                           old_cells & new_cells)
+            self.set_entry(self.range_backward, sheet_name, location,
+                           old_ranges & new_ranges)
+            if not self.order.suspended:
+                self.order.precedents_removed(cell)
+
+        added_cells = new_cells - old_cells
+        added_ranges = new_ranges - old_ranges
+        for (curr_name, curr_loc) in added_cells:
+            sheet_graph = self.forward.get(curr_name)
+            if sheet_graph is None:
+                self.forward[curr_name] = {curr_loc: {cell}}
+            elif curr_loc in sheet_graph:
+                sheet_graph[curr_loc].add(cell)
+            else:
+                sheet_graph[curr_loc] = {cell}
+        for (range_sheet, cell_range) in added_ranges:
+            self.add_range_edge(range_sheet, cell_range, cell)
+        self.set_entry(self.backward, sheet_name, location, new_cells)
+        self.set_entry(self.range_backward, sheet_name, location, new_ranges)
+        if self.order.suspended or not (added_cells or added_ranges):
+            return
+
+        # only new precedents that have a place in the order can be out of
+        # order with the cell
+        added = [precedent for precedent in added_cells
+                 if self.has_precedents(*precedent)]
+        for (range_sheet, cell_range) in added_ranges:
+            added.extend(self.cells_with_precedents_in(range_sheet,
+                                                       cell_range))
+        self.order.precedents_added(cell, added)
+
+    def add_cells(self, cells):
+        '''
+        Adds the precedents of many cells that did not depend on anything
+        before, such as the cells of a copied sheet. Unless something already
+        depended on the cells, they are put in the order after everything
+        else at once, instead of one at a time.
+
+        Parameters:
+            cells (iterable): (sheet name, location, cells, ranges) tuples,
+                see set_precedents()
+        '''
+        added = []
+        self.order.suspended = True
+        try:
+            for (sheet_name, location, precedents, ranges) in cells:
+                self.set_precedents(sheet_name, location, precedents, ranges)
+                if self.has_precedents(sheet_name, location):
+                    added.append((sheet_name, location))
+        finally:
+            self.order.suspended = False
+        new_cells = set(added)
+        if any(dependent not in new_cells for cell in added
+               for dependent in self.dependents(*cell)):
+            self.order.rebuild()
+        else:
+            self.order.append(added)
+
+    def add_range_edge(self, range_sheet, cell_range, cell):
+        '''
+        Helper method that records that cell depends on a range, in both
+        directions.
+        '''
+        if range_sheet not in self.ranges:
+            self.ranges[range_sheet] = RangeIndex()
+        self.ranges[range_sheet].add(cell_range, cell)
+        sheet_graph = self.range_backward.setdefault(cell[0], {})
+        if cell[1] in sheet_graph:
+            sheet_graph[cell[1]].add((range_sheet, cell_range))
+        else:
+            sheet_graph[cell[1]] = {(range_sheet, cell_range)}
+
+    @staticmethod
+    def set_entry(graph, sheet_name, location, cells):
+        '''
+        Helper method that stores the set of cells for a location in one
+        direction of the graph, or removes the entry if the set is empty.
+        '''
+        if cells:
+            graph.setdefault(sheet_name, {})[location] = cells
+        elif location in graph.get(sheet_name, ()):
+            sheet_graph = graph[sheet_name]
+            del sheet_graph[location]
+            if not sheet_graph:
+                del graph[sheet_name]
+
+    def clear_precedents(self, sheet_name, location):
+        '''
+        Removes every edge from a cell to the cells it depends on.
+        '''
+        self.set_precedents(sheet_name, location, NO_CELLS)
+
+    @staticmethod
+    def remove_edge(graph, sheet_name, location, cell):
+        '''
+        Helper method that removes cell from the set stored for a location in
+        one direction of the graph, dropping entries that become empty.
+        '''
+        sheet_graph = graph[sheet_name]
+        cells = sheet_graph[location]
+        cells.discard(cell)
+        if not cells:
+            del sheet_graph[location]
+            if not sheet_graph:
+                del graph[sheet_name]
+
+    def remove_sheet(self, sheet_name):
+        '''
+        Removes the precedents of every cell in a deleted sheet. Edges from
+        other cells into the sheet are kept, since those formulas still
+        depend on it if a sheet with the same name is created.
+        '''
+        locations = set(self.backward.get(sheet_name, ()))
+        locations.update(self.range_backward.get(sheet_name, ()))
+        for location in locations:
+            self.clear_precedents(sheet_name, location)
+
+    def rename_sheet(self, sheet_name, new_sheet_name):
+        '''
+        Replaces a sheet name with a new one in every cell of the graph. The
+        new name may already be in the graph if formulas referred to it
+        before any sheet had that name.
+
+        Parameters:
+            sheet_name (str): the lower case old sheet name
+            new_sheet_name (str): the lower case new sheet name
+        '''
+        def renamed_cell(cell):
+            if cell[0] == sheet_name:
+                return (new_sheet_name, cell[1])
+            return cell
+
+        def renamed(cells):
+            return {(new_sheet_name, location) if name == sheet_name
+                    else (name, location) for (name, location) in cells}
+
+        # the cells with an edge to or from the sheet are found before any
+        # of them are renamed, since some may be in the sheet itself
+        dependents = self.sheet_dependents(sheet_name)
+        joined = bool(self.sheet_dependents(new_sheet_name))
+        ordered = set(self.backward.get(sheet_name, ()))
+        ordered.update(self.range_backward.get(sheet_name, ()))
+        if not joined and not self.order.suspended:
+            self.order.rename_cells([(sheet_name, location)
+                                     for location in ordered], renamed_cell)
+        precedents = set()
+        for cells in self.backward.get(sheet_name, {}).values():
+            precedents.update(cells)
+        range_precedents = set()
+        for ranges in self.range_backward.get(sheet_name, {}).values():
+            range_precedents.update(ranges)
+
+        for (graph, cells) in ((self.backward, dependents),
+                               (self.range_backward, dependents),
+                               (self.forward, precedents)):
+            for (curr_name, curr_loc) in cells:
+                sheet_graph = graph.get(curr_name, {})
+                if curr_loc in sheet_graph:
+                    sheet_graph[curr_loc] = renamed(sheet_graph[curr_loc])
+        for (range_sheet, cell_range) in range_precedents:
+            index = self.ranges[range_sheet]
+            index.dependents[cell_range] = renamed(
+                index.dependents[cell_range])
+
+        for graph in (self.forward, self.backward, self.range_backward):
+            if sheet_name not in graph:
+                continue
+            sheet_graph = graph.pop(sheet_name)
+            if new_sheet_name not in graph:
+                graph[new_sheet_name] = sheet_graph
+                continue
+            new_sheet_graph = graph[new_sheet_name]
+            for (location, cells) in sheet_graph.items():
+                if location in new_sheet_graph:
+                    new_sheet_graph[location] |= cells
+                else:
+                    new_sheet_graph[location] = cells
+
+        if sheet_name in self.ranges:
+            index = self.ranges.pop(sheet_name)
+            if new_sheet_name not in self.ranges:
+                self.ranges[new_sheet_name] = index
+            else:
+                new_index = self.ranges[new_sheet_name]
+                for (cell_range, cells) in index.dependents.items():
+                    for cell in cells:
+                        new_index.add(cell_range, cell)
+
+        # renaming can join cells in the sheet to formulas that depended on
+        # the new name before, and then the order is computed again;
+        # otherwise the edges are the same as before, under new names
+        if joined and not self.order.suspended:
+            self.order.rebuild()
@@ -0,0 +1,180 @@
+'''
+This file contains code for reading and writing workbook JSON files
+incrementally, so that saving or loading a very large workbook only ever holds
+one sheet of the document in memory at a time instead of the whole file.
+
+The format is the same one produced by json.dumps:
+    {"sheets": [{"name": ..., "cell-contents": {location: contents}}, ...]}
+'''
+
+import json
+from json.encoder import encode_basestring_ascii
+from typing import TextIO
+
+READ_CHUNK_SIZE = 1 << 16
+
+
+class JsonStreamReader:
+    '''
+    Reads JSON values one at a time from a file-like object, keeping only the
+    unread part of the input in a buffer. Values are decoded with the json
+    module's own decoder, so errors are reported as json.JSONDecodeError.
+    '''
+
+    def __init__(self, fp: TextIO, chunk_size: int = READ_CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> None:
+        '''
+        Reads more input into the buffer, dropping what was already consumed.
+        Reads at least as much as is left unread, so a value that spans many
+        chunks is only retried a logarithmic number of times.
+        '''
+        chunk = self.fp.read(max(self.chunk_size, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self) -> str:
+        '''
+        Skips whitespace and returns the next character of the input without
+        consuming it, or '' at the end of the input.
+        '''
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                break
+            self.fill()
+        return self.buf[self.pos] if self.pos < len(self.buf) else ''
+
+    def expect(self, char: str) -> None:
+        '''
+        Consumes the next character, which must be char.
+        '''
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.buf,
+                                       self.pos)
+        self.pos += 1
+
+    def read_value(self):
+        '''
+        Decodes and returns the next complete JSON value.
+        '''
+        self.peek()
+        while True:
+            try:
+                (value, end) = self.decoder.raw_decode(self.buf, self.pos)
+                # a number may continue past the end of the buffer
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_json_sheets(fp: TextIO, chunk_size: int = READ_CHUNK_SIZE):
+    '''
+    Reads a workbook document from fp, yielding each element of its "sheets"
+    list as soon as it has been decoded. Other top-level keys are skipped.
+
+    Syntax errors are raised as json.JSONDecodeError when they are reached, so
+    sheets before the error will already have been yielded. If the document
+    has no "sheets" key a KeyError is raised.
+
+    Parameters:
+        fp (TextIO): the already opened json file to read from
+        chunk_size (int): how many characters to read from fp at a time
+
+    Returns:
+        generator: the decoded sheet objects, in order
+    '''
+    reader = JsonStreamReader(fp, chunk_size)
+    found_sheets = False
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.pos += 1
+    else:
+        while True:
+            key = reader.read_value()
+            if not isinstance(key, str):
+                raise json.JSONDecodeError('Expecting property name',
+                                           reader.buf, reader.pos)
+            reader.expect(':')
+            if key != 'sheets':
+                reader.read_value()
+            elif reader.peek() != '[':
+                # not a list, iterate it the way json.load would have
+                found_sheets = True
+                yield from reader.read_value()
+            else:
+                found_sheets = True
+                reader.expect('[')
+                if reader.peek() == ']':
+                    reader.pos += 1
+                else:
+                    while True:
+                        yield reader.read_value()
+                        if reader.peek() != ',':
+                            break
+                        reader.pos += 1
+                    reader.expect(']')
+            if reader.peek() != ',':
+                break
+            reader.pos += 1
+        reader.expect('}')
+    if reader.peek() != '':
+        raise json.JSONDecodeError('Extra data', reader.buf, reader.pos)
+    if not found_sheets:
+        raise KeyError('sheets')
+
+
+def write_json_sheets(fp: TextIO, sheets, indent=4) -> None:
+    '''
+    Writes a workbook document to fp one cell at a time. The output is the
+    same text json.dumps(document, indent=indent) would produce, without
+    building the document or its text in memory first.
+
+    Parameters:
+        fp (TextIO): the already opened json file to write to
+        sheets (iterable): (sheet name, iterable of (location, contents))
+            pairs, in the order they should be written
+        indent (int or None): spaces per indentation level, or None to write
+            everything on one line
+    '''
+    if indent is None:
+        newlines = [''] * 5
+        separator = ', '
+    else:
+        newlines = ['\n' + ' ' * (indent * level) for level in range(5)]
+        separator = ','
+
+    fp.write('{' + newlines[1] + '"sheets": [')
+    sheet_separator = newlines[2]
+    for (name, cells) in sheets:
+        fp.write(sheet_separator + '{' + newlines[3] + '"name": ' +
+                 encode_basestring_ascii(name) + separator + newlines[3] +
+                 '"cell-contents": {')
+        cell_separator = newlines[4]
+        for (location, contents) in cells:
+            # a cell whose contents were cleared is written as null, the
+            # way json.dumps writes None
+            fp.write(cell_separator + encode_basestring_ascii(location) +
+                     ': ' + ('null' if contents is None
+                             else encode_basestring_ascii(contents)))
+            cell_separator = separator + newlines[4]
+        if cell_separator != newlines[4]:
+            fp.write(newlines[3])
+        fp.write('}' + newlines[2] + '}')
+        sheet_separator = separator + newlines[2]
+    if sheet_separator != newlines[2]:
+        fp.write(newlines[1])
+    fp.write(']' + newlines[0] + '}')
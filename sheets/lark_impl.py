@@ -1,987 +1,1486 @@
 '''
-This file contains the lark parser for formulas.
+This file contains the lark parser for formulas, and the compiler that turns
+parsed formulas into plans that can be evaluated over and over again.
+
+A formula is parsed and compiled once per distinct formula text. Compiling
+turns every node of the parse tree into a closure, so evaluating a formula is
+just a chain of Python calls: the parse tree is never copied, mutated or walked
+again. Everything that changes between evaluations (the workbook, the sheet the
+formula lives on, and the references read along the way) is kept in an
+EvalContext instead of on the compiled formula, so one compiled formula is
+safely shared by every cell and workbook that uses the same text.
 '''
+import os
 import re
 import decimal
 
 import lark
-from lark import Tree
-from lark.visitors import visit_children_decor
+from lark import Tree, Token
 from functools import lru_cache
-from copy import deepcopy
 import string
 
 from cellerror import CellErrorType, CellError
+from cell_range import CellRange
 from version_file import version
 
-class FormulaEvaluator(lark.visitors.Interpreter):
+GRAMMAR_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            'formulas.lark')
+
+BAD_REFERENCE_DETAIL = ('Invalid cell reference in formula. ' +
+                        'Check sheet name and cell location.')
+
+ERROR_DICT = {
+    "#ERROR!": {
+        'type': CellErrorType.PARSE_ERROR,
+        'detail': 'Formula cannot be parsed.'},
+    "#CIRCREF!": {
+        'type': CellErrorType.CIRCULAR_REFERENCE,
+        'detail': 'Cell is part of circular reference.'},
+    "#REF!": {
+        'type': CellErrorType.BAD_REFERENCE,
+        'detail': BAD_REFERENCE_DETAIL},
+    "#NAME?": {
+        'type': CellErrorType.BAD_NAME,
+        'detail': 'Function name in formula is unrecognized.'},
+    "#VALUE!": {
+        'type': CellErrorType.TYPE_ERROR,
+        'detail': 'Incompatible types of values.'},
+    "#DIV/0!": {
+        'type': CellErrorType.DIVIDE_BY_ZERO,
+        'detail': 'Cannot divide by zero.'}}
+
+
+@lru_cache(maxsize=None)
+def get_parser():
     '''
-    This class is a helper class that evaluates formulas in cells.
+    Returns the formula parser shared by every workbook in the process.
+
+    The grammar is compiled to LALR(1) tables once per process; Lark's cache
+    also serializes the tables to disk, so later processes load them instead
+    of recompiling the grammar.
     '''
+    return lark.Lark.open(GRAMMAR_PATH, parser='lalr', start='formula',
+                          cache=True)
 
-    def __init__(self, sheet_name, workbook):
-        '''
-        Initializes a FormulaEvaluator.
-        '''
+
+@lru_cache(maxsize=65536)
+def compile_formula(contents):
+    '''
+    Parses and compiles a formula, returning a CompiledFormula. Compiled
+    formulas are immutable, so they are cached by formula text and shared.
+
+    Raises lark.exceptions.UnexpectedInput if the formula cannot be parsed.
+    '''
+    tree = get_parser().parse(contents)
+    return get_compiler().compile_formula(tree, text=contents)
+
+
+@lru_cache(maxsize=None)
+def get_compiler():
+    '''
+    Returns the formula compiler shared by every workbook in the process. The
+    compiler keeps no state between formulas.
+    '''
+    return FormulaCompiler()
+
+
+#=============================================================================
+# Value helpers shared by the compiled closures
+
+def remove_dollar_sign(ref):
+    return ref.replace('$', '')
+
+
+def wrong_arguments():
+    return CellError(CellErrorType.TYPE_ERROR, 'Wrong number of arguments.')
+
+
+def convert_none_to_zero(value_zero, value_two):
+    '''
+    Converts none type to zero.
+    '''
+    if value_zero is None:
+        value_zero = decimal.Decimal(0)
+    if value_two is None:
+        value_two = decimal.Decimal(0)
+    return value_zero, value_two
+
+
+def is_string_float(val):
+    '''
+    Helper method to check if string can be interpreted as a float.
+    '''
+    return re.match(r'^-?\d+(?:\.\d+)$', val) is not None
+
+
+def is_string_digit(val):
+    '''
+    Helper method to check if a string is a whole number.
+    '''
+    return re.match('^[-+]?[0-9]+$', val) is not None
+
+
+@lru_cache(maxsize=1024)
+def string_to_decimal(value):
+    '''
+    Converts a string to a Decimal, raising a TYPE_ERROR if it is not a
+    number.
+    '''
+    value = value.strip()
+    if is_string_float(value) or value.isdigit():
+        return decimal.Decimal(value)
+    raise CellError(CellErrorType.TYPE_ERROR, 'Incompatible types of values.')
+
+
+def convert_to_decimal(value):
+    '''
+    Converts a string or boolean to a Decimal if possible.
+    '''
+    if isinstance(value, str):
+        return string_to_decimal(value)
+    if isinstance(value, bool):
+        if value == True:
+            return decimal.Decimal(1)
+        return decimal.Decimal(0)
+    return value
+
+
+def convert_val_to_decimal(value):
+    if value is None:
+        return None
+    return convert_to_decimal(value)
+
+
+def check_if_errors(values):
+    '''
+    Raises the error among values that takes precedence, if there is one: a
+    parse error first, then a circular reference, then the first other error.
+    '''
+    ret_error = None
+    for value in values:
+        if (isinstance(value, CellError) and
+                value.get_type() == CellErrorType.PARSE_ERROR):
+            raise CellError(CellErrorType.PARSE_ERROR,
+                            'Formula cannot be parsed.')
+        if (isinstance(value, CellError) and
+                value.get_type() == CellErrorType.CIRCULAR_REFERENCE):
+            ret_error = CellError(CellErrorType.CIRCULAR_REFERENCE,
+                                  'Cell is part of circular reference.')
+        if isinstance(value, CellError) and not isinstance(ret_error,
+                                                           CellError):
+            ret_error = value
+    if ret_error is not None:
+        raise ret_error
+
+
+def check_if_cell_range(values):
+    for value in values:
+        if isinstance(value, CellRange):
+            raise CellError(CellErrorType.TYPE_ERROR,
+                            'Cell range not valid here.')
+
+
+def convert_value_to_string(value):
+    if isinstance(value, bool):
+        if value == True:
+            return 'TRUE'
+        return 'FALSE'
+    try:
+        return str(value)
+    except TypeError as e:
+        detail = 'Incompatible types of values.'
+        raise CellError(CellErrorType.TYPE_ERROR, detail, e)
+
+
+def check_str_bool(value):
+    value = str(value)
+    if value.lower() == 'true':
+        return True
+    elif value.lower() == 'false':
+        return False
+    else:
+        return value.lower()
+
+
+def comp_convert_values(value_zero, value_two):
+    if type(value_zero) == decimal.Decimal:
+        if type(value_two) == decimal.Decimal:
+            return value_zero, value_two
+        elif value_two is None:
+            return value_zero, decimal.Decimal(0)
+        else:
+            return value_zero, value_two
+    elif type(value_zero) == str:
+        if type(value_two) == decimal.Decimal:
+            return check_str_bool(value_zero), value_two
+        elif value_two is None:
+            return value_zero, ""
+        elif type(value_two) == str:
+            return value_zero.lower(), value_two.lower()
+        else:
+            return value_zero, value_two
+    elif type(value_zero) == bool:
+        if type(value_two) == decimal.Decimal:
+            return value_zero, value_two
+        elif value_two is None:
+            return value_zero, False
+        else:
+            return value_zero, value_two
+    else:
+        if type(value_two) == decimal.Decimal:
+            return decimal.Decimal(0), value_two
+        elif type(value_two) == str:
+            return "", value_two
+        elif type(value_two) == bool:
+            return False, value_two
+        elif value_two is None:
+            return True, True
+
+
+def comp_types(value_zero, value_two):
+    if type(value_zero) == bool:
+        return True
+    elif type(value_zero) == str:
+        if type(value_two) == bool:
+            return False
+        else:
+            return True
+    else:
+        return False
+
+
+def compare(big_op, value_zero, value_two):
+    '''
+    Compares two converted values with a comparison operator. Values of
+    different types are ordered strings < numbers < booleans.
+    '''
+    if big_op == '=' or big_op == '==':
+        if type(value_zero) != type(value_two):
+            return False
+        return value_zero == value_two
+    elif big_op == '<>' or big_op == '!=':
+        if type(value_zero) != type(value_two):
+            return True
+        return value_zero != value_two
+    elif big_op == '>':
+        if type(value_zero) != type(value_two):
+            return comp_types(value_zero, value_two)
+        return value_zero > value_two
+    elif big_op == '<':
+        if type(value_zero) != type(value_two):
+            return not comp_types(value_zero, value_two)
+        return value_zero < value_two
+    elif big_op == '>=':
+        if type(value_zero) != type(value_two):
+            return comp_types(value_zero, value_two)
+        return value_zero >= value_two
+    elif big_op == '<=':
+        if type(value_zero) != type(value_two):
+            return not comp_types(value_zero, value_two)
+        return value_zero <= value_two
+    return None
+
+
+def value_bool_converter(value):
+    if value is None:
+        return False
+    if type(value) == bool:
+        return value
+    if type(value) == str:
+        resp = check_str_bool(value)
+        if type(resp) != bool:
+            raise CellError(
+                CellErrorType.TYPE_ERROR,
+                'Incompatible types of values.')
+        return resp
+    elif type(value) == decimal.Decimal:
+        return value != decimal.Decimal(0)
+    raise CellError(CellErrorType.TYPE_ERROR, 'Incompatible types of values.')
+
+
+def strings_equal(values):
+    '''
+    Compares two values as strings, the way EXACT and the lookups do.
+    '''
+    check_if_cell_range(values)
+    if len(values) != 2:
+        raise wrong_arguments()
+    values = ['' if value is None else value for value in values]
+    values = [value if isinstance(value, str)
+              else convert_value_to_string(value) for value in values]
+    check_if_errors(values)
+    return values[0] == values[1]
+
+
+def parse_cell_ref(cell_ref):
+    match = re.match(r"([a-z]+)([1-9][0-9]*)$", cell_ref, re.I)
+    if not match:
+        return False
+    col, row = match.groups()
+    return col, row
+
+
+def is_valid_cell_location(location):
+    '''
+    Checks that a location is a column of at most four letters followed by a
+    row of at most four digits.
+    '''
+    match = parse_cell_ref(location)
+    if not match:
+        return False
+    col, row = match
+    return len(col) <= 4 and len(row) <= 4
+
+
+def num_to_col(num):
+    res = ''
+    while num > 0:
+        num, remainder = divmod(num - 1, 26)
+        res = chr(remainder + ord('a')) + res
+    return res
+
+
+def col_to_num(col: str):
+    num = 0
+    for letter in col:
+        if letter in string.ascii_letters:
+            num = num * 26 + (ord(letter.upper()) - ord('A')) + 1
+    return num
+
+
+#=============================================================================
+# Evaluation
+
+class EvalContext:
+    '''
+    The state of one evaluation of a formula. Compiled formulas are shared, so
+    everything that belongs to a single evaluation lives here.
+
+    References are recorded relative to the formula's sheet: a sheet name of
+    None means the sheet the formula is on.
+    '''
+
+    def __init__(self, workbook, sheet_name, in_scc=False):
         self.workbook = workbook
         self.sheet_name = sheet_name
-        self.contains_func = False
+        self.in_scc = in_scc
+        # references that are only known once the formula runs, such as the
+        # rows and columns a lookup read or the formula INDIRECT built
+        self.refs = []
+        # maps IF and IFERROR nodes to the indices of the branches they kept
+        self.kept_branches = {}
 
-    def convert_none_to_zero(self, value_zero, value_two):
+
+def get_range_sheet(ctx, cell_range):
+    '''
+    Returns the Sheet that a cell range refers to.
+    '''
+    sheet_name = cell_range.sheet_name
+    if sheet_name is None:
+        sheet_name = ctx.sheet_name
+    sheet_name = sheet_name.lower()
+    if sheet_name not in ctx.workbook.sheets:
+        raise CellError(CellErrorType.BAD_REFERENCE, BAD_REFERENCE_DETAIL)
+    return ctx.workbook.sheets[sheet_name]
+
+
+def get_range_value(ctx, cell_range, col_offset, row_offset):
+    '''
+    Returns the value of the cell at the given 0-based offset from the
+    top-left corner of a cell range.
+    '''
+    sheet = get_range_sheet(ctx, cell_range)
+    location = (num_to_col(cell_range.left_col + col_offset) +
+                str(cell_range.top_row + row_offset))
+    return sheet.get_cell_value(location)
+
+
+def add_lookup_ref(ctx, cell_range, col_offset, row_offset, is_row):
+    '''
+    Records that a lookup depends on one whole row or column of its range.
+    '''
+    if is_row:
+        start_location = (num_to_col(cell_range.left_col) +
+                          str(cell_range.top_row + row_offset))
+        end_location = (num_to_col(cell_range.right_col) +
+                        str(cell_range.top_row + row_offset))
+    else:
+        start_location = (num_to_col(cell_range.left_col + col_offset) +
+                          str(cell_range.top_row))
+        end_location = (num_to_col(cell_range.left_col + col_offset) +
+                        str(cell_range.bot_row))
+    ctx.refs.append((cell_range.sheet_name, start_location, end_location))
+
+
+def cell_range_helper(ctx, cell_range, conv_to_dec=False):
+    '''
+    Returns the values of the non-empty cells in a range in row-major
+    order. A circular reference in the range is raised immediately; any
+    other error is raised once the whole range has been read.
+    '''
+    sheet = get_range_sheet(ctx, cell_range)
+    value_arr = []
+    error = None
+    for (_, cell) in sheet.get_cells_in_range(
+            cell_range.left_col, cell_range.top_row,
+            cell_range.right_col, cell_range.bot_row):
+        value = cell.value
+        if isinstance(value, CellError):
+            if value.get_type() == CellErrorType.CIRCULAR_REFERENCE:
+                raise value
+            error = value
+        if conv_to_dec:
+            value_arr.append(convert_to_decimal(value))
+        else:
+            value_arr.append(value)
+    if error:
+        raise error
+    return value_arr
+
+
+def range_aggregate(ctx, cell_range, func, ret_value):
+    '''
+    Aggregates a range with min, max or sum from the numeric columns of its
+    sheet, see numeric_columns.py. A sum is only taken this way when the
+    aggregate so far is a number the columns could keep, so that adding the
+    range as one number rounds no differently than adding its cells.
+
+    Returns:
+        tuple: (aggregate, count) as NumericColumns.aggregate() does, or None
+        if the range has to be read cell by cell
+    '''
+    sheet = get_range_sheet(ctx, cell_range)
+    numbers = getattr(sheet, 'numbers', None)
+    if numbers is None:
+        return None
+    if func is sum and ret_value is not None and (
+            not numbers.is_number(ret_value)):
+        return None
+    return numbers.aggregate(func, cell_range.left_col, cell_range.top_row,
+                             cell_range.right_col, cell_range.bot_row)
+
+
+def add_plan_refs(plan, kept_branches, refs):
+    '''
+    Adds the references of a reference plan to refs. The branches of an IF or
+    IFERROR that the evaluation pruned are left out; a conditional that was
+    never reached keeps all of its branches.
+    '''
+    static_refs, conditionals = plan
+    refs.extend(static_refs)
+    for (key, branches) in conditionals:
+        kept = kept_branches.get(key)
+        for (i, branch) in enumerate(branches):
+            if kept is None or i in kept:
+                add_plan_refs(branch, kept_branches, refs)
+
+
+class CompiledFormula:
+    '''
+    A parsed formula compiled into a closure, along with what is known about
+    its references before it runs.
+    '''
+
+    def __init__(self, tree, evaluate, ref_plan, sheet_name_dict, text=None,
+                 pieces=None):
+        # the tree is kept alive because the reference plan is keyed by the
+        # ids of its nodes
+        self.tree = tree
+        self.evaluate = evaluate
+        self.ref_plan = ref_plan
+        self.sheet_name_dict = sheet_name_dict
+        self.is_cell = tree.data == 'cell'
+        # the text the formula was compiled from; a relocated formula has
+        # none until it is written out from its pieces
+        self.text = text
+        # see text_pieces(), found when the formula is first relocated
+        self.pieces = pieces
+        # whether the formula calls INDIRECT, found when first asked
+        self.indirect = None
+
+    def get_refs(self, kept_branches):
         '''
-        Converts none type to zero.
+        Returns the references the formula depends on after an evaluation that
+        kept the given IF and IFERROR branches.
         '''
-        if value_zero is None:
-            value_zero = decimal.Decimal(0)
-        if value_two is None:
-            value_two = decimal.Decimal(0)
-        return value_zero, value_two
+        static_refs, conditionals = self.ref_plan
+        if not conditionals:
+            return list(static_refs)
+        refs = []
+        add_plan_refs(self.ref_plan, kept_branches, refs)
+        return refs
+
+    def has_branches(self):
+        '''
+        Returns whether the formula has IF or IFERROR branches, so that the
+        references it reads depend on how it evaluates.
+        '''
+        return bool(self.ref_plan[1])
 
-    def is_string_float(self, val):
+    def get_text(self):
         '''
-        Helper method to check if string can be interpreted as a float.
+        Returns the text of the formula. The text of a relocated formula is
+        only written out the first time it is asked for.
         '''
-        return re.match(r'^-?\d+(?:\.\d+)$', val) is not None
+        if self.text is None:
+            self.text = ''.join(piece if isinstance(piece, str)
+                                else piece_text(piece) for piece in self.pieces)
+        return self.text
 
-    @lru_cache
-    def convert_to_decimal(self, value):
+    def uses_indirect(self):
         '''
-        Converts a string to an integer if possible.
+        Returns whether the formula calls INDIRECT, so that the sheets and
+        cells it reads are only known when it runs.
         '''
-        if isinstance(value, str):
-            value = value.strip()
-            if self.is_string_float(value):
-                # string is a float
-                value = decimal.Decimal(value)
-            elif value.isdigit():
-                # string is an int
-                value = decimal.Decimal(value)
-            else:
-                raise CellError(
-                    CellErrorType.TYPE_ERROR,
-                    'Incompatible types of values.')
-        elif isinstance(value, bool):
-            if value == True:
-                value = decimal.Decimal(1)
-            else:
-                value = decimal.Decimal(0)
-        return value
+        if self.indirect is None:
+            self.indirect = any(
+                node.data == 'func' and node.children[0].lower() == 'indirect'
+                for node in self.tree.iter_subtrees())
+        return self.indirect
+
+    def get_pieces(self):
+        '''
+        Returns the pieces the formula is written out from, see text_pieces().
+        '''
+        if self.pieces is None:
+            self.pieces = text_pieces(self.tree, self.text)
+        return self.pieces
 
-    def remove_dollar_sign(self, ref):
-        return ref.replace('$', '')
 
-    @visit_children_decor
-    def cell(self, values):
+#=============================================================================
+# Compilation
+
+class FormulaCompiler:
+    '''
+    This class compiles a parsed formula into nested closures. Each closure
+    takes an EvalContext and returns the value of its part of the formula.
+    '''
+
+    def __init__(self):
+        self.func_map = {
+            'and': self.and_func, 'or': self.or_func, 'not': self.not_func,
+            'xor': self.xor_func, 'exact': self.exact_func,
+            'if': self.if_func, 'iferror': self.iferror_func,
+            'choose': self.choose_func, 'isblank': self.isblank_func,
+            'iserror': self.iserror_func, 'version': self.version_func,
+            'indirect': self.indirect_func, 'min': self.min_func,
+            'max': self.max_func, 'sum': self.sum_func,
+            'average': self.average_func, 'hlookup': self.hlookup_func,
+            'vlookup': self.vlookup_func}
+
+    def compile_formula(self, tree, text=None, pieces=None):
         '''
-        Handles single cell references in formulas.
+        Compiles a parse tree into a CompiledFormula. Either the text the tree
+        was parsed from or the pieces to write the text out from are given.
         '''
-        try:
-            if values[0].type == 'SHEET_NAME':
-                stripped_cell = self.remove_dollar_sign(values[1].value).lower()
-                cell_value = self.workbook.get_cell_value(values[0].value, stripped_cell)
-            elif values[0].type == 'QUOTED_SHEET_NAME':
-                stripped_cell = self.remove_dollar_sign(values[1].value).lower()
-                cell_value = self.workbook.get_cell_value(values[0].value[1:-1], stripped_cell)
+        return CompiledFormula(tree, self.compile(tree), self.ref_plan(tree),
+                               self.sheet_name_dict(tree), text, pieces)
+
+    def compile(self, node):
+        return getattr(self, node.data)(node)
+
+    # ------------------------------------------------------------------
+    # References known before evaluation
+
+    def sheet_ref(self, token):
+        '''
+        Returns the lower case sheet name of a sheet name token.
+        '''
+        if token.type == 'QUOTED_SHEET_NAME':
+            return token.value[1:-1].lower()
+        return token.value.lower()
+
+    def node_ref(self, node):
+        '''
+        Returns the reference of a cell or cell range node, relative to the
+        formula's sheet.
+        '''
+        children = node.children
+        ref_sheet = None
+        if children[0].type in ('SHEET_NAME', 'QUOTED_SHEET_NAME'):
+            ref_sheet = self.sheet_ref(children[0])
+            children = children[1:]
+        return (ref_sheet,) + tuple(remove_dollar_sign(corner.value).lower()
+                                    for corner in children)
+
+    def ref_plan(self, node):
+        '''
+        Returns the references a node depends on as (refs, conditionals).
+        The branches of IF and IFERROR are kept separately, keyed by the id of
+        their function node, because evaluation decides which of them count.
+        The range passed to a lookup is left out; the lookup records the rows
+        or columns it actually read.
+        '''
+        refs = []
+        conditionals = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Token):
+                continue
+            if node.data in ('cell', 'cell_range'):
+                refs.append(self.node_ref(node))
+                continue
+            children = node.children
+            if node.data == 'func':
+                func_name = children[0].lower()
+                if func_name in ('if', 'iferror'):
+                    conditionals.append((id(node), [self.ref_plan(branch)
+                                                    for branch in children[2:]]))
+                    children = children[:2]
+                elif (func_name in ('vlookup', 'hlookup') and
+                        len(children) > 2 and isinstance(children[2], Tree) and
+                        children[2].data == 'cell_range'):
+                    children = children[:2] + children[3:]
+            stack.extend(children)
+        return (tuple(refs), tuple(conditionals))
+
+    def sheet_name_dict(self, tree):
+        '''
+        Finds the sheet names and cells written in a formula, which are
+        rewritten when sheets are renamed and cells are moved or copied.
+        '''
+        stack = [tree]
+        sheet_name_dict = {'QUOTED_SHEET_NAMES': [], 'SHEET_NAMES': [],
+                           'CELLS': []}
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Token):
+                continue
+            if node.data == 'cell':
+                if node.children[0].type == 'SHEET_NAME':
+                    sheet_name = node.children[0].value
+                    sheet_name_dict['CELLS'].append((node.children[1].value,
+                                                     sheet_name))
+                    sheet_name_dict['SHEET_NAMES'].append(sheet_name)
+                elif node.children[0].type == 'QUOTED_SHEET_NAME':
+                    sheet_name = node.children[0].value
+                    sheet_name_dict['CELLS'].append((node.children[1].value,
+                                                     sheet_name))
+                    sheet_name_dict['QUOTED_SHEET_NAMES'].append(sheet_name)
+                else:
+                    sheet_name_dict['CELLS'].append((node.children[0].value,
+                                                     None))
+            elif node.data == 'cell_range':
+                corners = node.children
+                sheet_name = None
+                if corners[0].type == 'SHEET_NAME':
+                    sheet_name = corners[0].value
+                    corners = corners[1:]
+                    sheet_name_dict['SHEET_NAMES'].append(sheet_name)
+                elif corners[0].type == 'QUOTED_SHEET_NAME':
+                    sheet_name = corners[0].value
+                    corners = corners[1:]
+                    sheet_name_dict['QUOTED_SHEET_NAMES'].append(sheet_name)
+                for corner in corners:
+                    sheet_name_dict['CELLS'].append((corner.value, sheet_name))
             else:
-                stripped_cell = self.remove_dollar_sign(values[0].value).lower()
-                cell_value = self.workbook.get_cell_value(self.sheet_name, stripped_cell)
-            return cell_value
-        except (ValueError, KeyError) as e:
-            detail = 'Invalid cell reference in formula. ' + \
-                     'Check sheet name and cell location.'
-            return CellError(CellErrorType.BAD_REFERENCE, detail, e)
-    
-    #@lru_cache
-    def check_if_errors(self, values):
-
-        ret_error = None
-        for value in values:
-            if (isinstance(value, CellError) and value.get_type() == CellErrorType.PARSE_ERROR):
-                ret_error = CellError(CellErrorType.PARSE_ERROR,
-                            'Formula cannot be parsed.')
-                raise ret_error
-            if (isinstance(value, CellError) and value.get_type() == CellErrorType.CIRCULAR_REFERENCE):
-                ret_error = CellError(CellErrorType.CIRCULAR_REFERENCE, 'Cell is part of circular reference.')
-            if isinstance(value, CellError) and not isinstance(ret_error, CellError):
-                ret_error = value
-        if ret_error is not None:
-            raise ret_error
-        
-    def check_if_cell_range(self, values):
-        for value in values:
-            if isinstance(value, list):
-                raise CellError(CellErrorType.TYPE_ERROR,
-                                'Cell range not valid here.')
+                for child in node.children:
+                    stack.append(child)
+        return sheet_name_dict
 
-    @visit_children_decor
-    def add_expr(self, values):
+    # ------------------------------------------------------------------
+    # Expressions
+
+    def cell(self, node):
         '''
-        Handles addition and subtraction.
+        Handles single cell references in formulas.
         '''
-        #print(values)
-        values[0], values[2] = self.convert_none_to_zero(values[0], values[2])
-        # self.check_if_error(values[0], values[2])
-        self.check_if_errors(values)
-        self.check_if_cell_range(values)
-        values[0] = self.convert_to_decimal(values[0])
-        values[2] = self.convert_to_decimal(values[2])
-        
-        if values[1] == '+':
-            return values[0] + values[2]
+        ref_sheet, location = self.node_ref(node)
 
-        # subtraction expression
-        return values[0] - values[2]
+        def evaluate(ctx):
+            sheet_name = ctx.sheet_name if ref_sheet is None else ref_sheet
+            try:
+                return ctx.workbook.get_cell_value(sheet_name, location)
+            except (ValueError, KeyError) as e:
+                return CellError(CellErrorType.BAD_REFERENCE,
+                                 BAD_REFERENCE_DETAIL, e)
+        return evaluate
 
-    @visit_children_decor
-    def mul_expr(self, values):
+    def cell_range(self, node):
         '''
-        Handles multiplication and division.
+        Handles cell ranges. The cells are not evaluated here; functions that
+        take ranges read the occupied cells of the returned CellRange.
         '''
-        values[0], values[2] = self.convert_none_to_zero(values[0], values[2])
-        # self.check_if_error(values[0], values[2])
-        self.check_if_errors(values)
-        self.check_if_cell_range(values)
-        values[0] = self.convert_to_decimal(values[0])
-        values[2] = self.convert_to_decimal(values[2])
-        if values[1] == '*':
-            return values[0] * values[2]
+        ref_sheet, start_location, end_location = self.node_ref(node)
+        if (not is_valid_cell_location(start_location) or
+                not is_valid_cell_location(end_location)):
+            def evaluate(ctx):
+                raise CellError(CellErrorType.BAD_REFERENCE,
+                                BAD_REFERENCE_DETAIL)
+            return evaluate
+
+        start_col, start_row = parse_cell_ref(start_location)
+        end_col, end_row = parse_cell_ref(end_location)
+        start_col, end_col = col_to_num(start_col), col_to_num(end_col)
+        start_row, end_row = int(start_row), int(end_row)
+        corners = (min(start_col, end_col), min(start_row, end_row),
+                   max(start_col, end_col), max(start_row, end_row))
 
-        # division expression
-        if values[2] == 0:
-            raise ZeroDivisionError
-        return values[0] / values[2]
+        def evaluate(ctx):
+            return CellRange(ref_sheet, *corners)
+        return evaluate
 
-    @lru_cache
-    @visit_children_decor
-    def number(self, values):
+    def add_expr(self, node):
+        '''
+        Handles addition and subtraction.
         '''
-        Handles numbers.
+        left = self.compile(node.children[0])
+        is_add = node.children[1] == '+'
+        right = self.compile(node.children[2])
+
+        def evaluate(ctx):
+            value_zero, value_two = convert_none_to_zero(left(ctx), right(ctx))
+            check_if_errors((value_zero, value_two))
+            check_if_cell_range((value_zero, value_two))
+            value_zero = convert_to_decimal(value_zero)
+            value_two = convert_to_decimal(value_two)
+            if is_add:
+                return value_zero + value_two
+            return value_zero - value_two
+        return evaluate
+
+    def mul_expr(self, node):
         '''
-        # add in protections
-        value_temp = str(values[0])
+        Handles multiplication and division.
+        '''
+        left = self.compile(node.children[0])
+        is_mul = node.children[1] == '*'
+        right = self.compile(node.children[2])
+
+        def evaluate(ctx):
+            value_zero, value_two = convert_none_to_zero(left(ctx), right(ctx))
+            check_if_errors((value_zero, value_two))
+            check_if_cell_range((value_zero, value_two))
+            value_zero = convert_to_decimal(value_zero)
+            value_two = convert_to_decimal(value_two)
+            if is_mul:
+                return value_zero * value_two
+            if value_two == 0:
+                raise ZeroDivisionError
+            return value_zero / value_two
+        return evaluate
+
+    def number(self, node):
+        '''
+        Handles numbers. The Decimal is built once, when compiling.
+        '''
+        value_temp = str(node.children[0])
+        value = decimal.Decimal(node.children[0])
         if value_temp[-1] == '0':
             if '.' in value_temp:
                 value_temp = value_temp.rstrip('0').rstrip('.')
-            if self.is_string_float(value_temp) or self.workbook.is_string_digit(value_temp):
-                return decimal.Decimal(value_temp)
-        
-        return decimal.Decimal(values[0])
-    
-    def convert_value_to_string(self, value):
-        if isinstance(value, bool):
-            if value == True:
-                value = 'TRUE'
-            else:
-                value = 'FALSE'
-        else:
-            try:
-                value = str(value)
-            except TypeError as e:
-                detail = 'Incompatible types of values.'
-                value = CellError(CellErrorType.TYPE_ERROR, detail, e)
-                raise value
-        return value
-    
-    @visit_children_decor
-    def concat_expr(self, values):
+            if is_string_float(value_temp) or is_string_digit(value_temp):
+                value = decimal.Decimal(value_temp)
+        return lambda ctx: value
+
+    def string(self, node):
         '''
-        Handles string concatenation.
+        Handles strings.
         '''
-        self.check_if_errors(values)
-        self.check_if_cell_range(values)
-        if values[0] is None:
-            values[0] = ''
-        if values[1] is None:
-            values[1] = ''
-        if not isinstance(values[0], str):
-            values[0] = self.convert_value_to_string(values[0])
-        if not isinstance(values[1], str):
-            values[1] = self.convert_value_to_string(values[1])
-        # self.check_if_error(values[0], values[1])
-        
-        return values[0] + values[1]
-
-    def check_str_bool(self, value):
-        value = str(value)
-        if value.lower() == 'true':
-            return True
-        elif value.lower() == 'false':
-            return False
-        else:
-            return value.lower()
-
-    #@lru_cache
-    def comp_convert_values(self, value_zero, value_two):
-        if type(value_zero) == decimal.Decimal:
-            if type(value_two) == decimal.Decimal:
-                return value_zero, value_two
-            elif value_two is None:
-                return value_zero, decimal.Decimal(0)
-            else:
-                return value_zero, value_two
-        elif type(value_zero) == str:
-            if type(value_two) == decimal.Decimal:
-                return self.check_str_bool(value_zero), value_two
-            elif value_two is None:
-                return value_zero, ""
-            elif type(value_two) == str:
-                return value_zero.lower(), value_two.lower()
-            else:
-                return value_zero, value_two
-        elif type(value_zero) == bool:
-            if type(value_two) == decimal.Decimal:
-                return value_zero, value_two
-            elif value_two is None:
-                return value_zero, False
-            else:
-                return value_zero, value_two
-        else:
-            if type(value_two) == decimal.Decimal:
-                return decimal.Decimal(0), value_two
-            elif type(value_two) == str:
-                return "", value_two
-            elif type(value_two) == bool:
-                return False, value_two
-            elif value_two is None:
-                return True, True
-
-    #@lru_cache
-    def comp_types(self, value_zero, value_two):
-        if type(value_zero) == bool:
-            return True
-        elif type(value_zero) == str:
-            if type(value_two) == bool:
-                return False
-            else:
-                return True
-        else:
-            return False
-    
-    @visit_children_decor
-    def comp_expr(self, values):
-        #print(values)
-        big_op = values[1]
-        self.check_if_errors(values)
-        self.check_if_cell_range(values)
-        (values[0], values[2]) = self.comp_convert_values(values[0], values[2])
-
-        if big_op == '=' or big_op == '==':
-            if type(values[0]) != type(values[2]):
-                return False
-            elif values[0] == values[2]:
-                return True
-            else:
-                return False
-        elif big_op == '<>' or big_op == '!=':
-            if type(values[0]) != type(values[2]):
-                return True
-            elif values[0] != values[2]:
-                return True
-            else:
-                return False
-        elif big_op == ">":
-            if type(values[0]) != type(values[2]):
-                return self.comp_types(values[0], values[2])
-            elif values[0] > values[2]:
-                return True
-            else:
-                return False
-        elif big_op == "<":
-            if type(values[0]) != type(values[2]):
-                return not self.comp_types(values[0], values[2])
-            elif values[0] < values[2]:
-                return True
-            else:
-                return False
-        elif big_op == ">=":
-            if type(values[0]) != type(values[2]):
-                return self.comp_types(values[0], values[2])
-            elif values[0] >= values[2]:
-                return True
-            else:
-                return False
-        elif big_op == "<=":
-            if type(values[0]) != type(values[2]):
-                return not self.comp_types(values[0], values[2])
-            elif values[0] <= values[2]:
-                return True
-            else:
-                return False
-        return
-    
-    @visit_children_decor
-    def parens(self, values):
+        value = node.children[0][1:-1]
+        return lambda ctx: value
+
+    def bool(self, node):
+        value = node.children[0].lower() == 'true'
+        return lambda ctx: value
+
+    def error(self, node):
         '''
-        Handles parentheses.
+        Handles errors.
         '''
-        return values[0]
+        error = ERROR_DICT[node.children[0].value.upper()]
+
+        def evaluate(ctx):
+            raise CellError(error['type'], error['detail'])
+        return evaluate
 
-    @visit_children_decor
-    def unary_op(self, values):
+    def parens(self, node):
         '''
-        Handles unary operators.
+        Handles parentheses.
         '''
-        # self.check_if_error(values[1])
-        self.check_if_errors(values)
-        self.check_if_cell_range(values)
-        if values[0] == '+':
-            return decimal.Decimal(values[1])
-
-        # subtraction op
-        return decimal.Decimal(-values[1])
+        return self.compile(node.children[0])
 
-    @visit_children_decor
-    def error(self, values):
+    def concat_expr(self, node):
         '''
-        Handles errors.
+        Handles string concatenation.
         '''
-        error_dict = {
-            "#ERROR!": {
-                'type': CellErrorType.PARSE_ERROR,
-                'detail': 'Formula cannot be parsed.'},
-            "#CIRCREF!": {
-                'type': CellErrorType.CIRCULAR_REFERENCE,
-                'detail': 'Cell is part of circular reference.'},
-            "#REF!": {
-                'type': CellErrorType.BAD_REFERENCE,
-                'detail': 'Invalid cell reference in formula. ' +
-                          'Check sheet name and cell location.'},
-            "#NAME?": {
-                'type': CellErrorType.BAD_NAME,
-                'detail': 'Function name in formula is unrecognized.'},
-            "#VALUE!": {
-                'type': CellErrorType.TYPE_ERROR,
-                'detail': 'Incompatible types of values.'},
-            "#DIV/0!": {
-                'type': CellErrorType.DIVIDE_BY_ZERO,
-                'detail': 'Cannot divide by zero.'}}
-        raise CellError(error_dict[values[0].value.upper()]['type'], error_dict[values[0].value.upper()]['detail'])
-
-    @visit_children_decor
-    def string(self, values):
+        left = self.compile(node.children[0])
+        right = self.compile(node.children[1])
+
+        def evaluate(ctx):
+            values = [left(ctx), right(ctx)]
+            check_if_errors(values)
+            check_if_cell_range(values)
+            for i in range(2):
+                if values[i] is None:
+                    values[i] = ''
+                if not isinstance(values[i], str):
+                    values[i] = convert_value_to_string(values[i])
+            return values[0] + values[1]
+        return evaluate
+
+    def comp_expr(self, node):
+        left = self.compile(node.children[0])
+        big_op = node.children[1]
+        right = self.compile(node.children[2])
+
+        def evaluate(ctx):
+            values = (left(ctx), right(ctx))
+            check_if_errors(values)
+            check_if_cell_range(values)
+            return compare(big_op, *comp_convert_values(*values))
+        return evaluate
+
+    def unary_op(self, node):
         '''
-        Handles strings.
+        Handles unary operators.
         '''
-        return values[0][1:-1]
-    
-    @visit_children_decor
-    def bool(self, values):
-        values[0] = values[0].lower()
-        if values[0] == 'true':
+        is_plus = node.children[0] == '+'
+        base = self.compile(node.children[1])
+
+        def evaluate(ctx):
+            value = base(ctx)
+            check_if_errors((value,))
+            check_if_cell_range((value,))
+            if is_plus:
+                return decimal.Decimal(value)
+            return decimal.Decimal(-value)
+        return evaluate
+
+    # ------------------------------------------------------------------
+    # Functions
+
+    def func(self, node):
+        func_name = node.children[0].lower()
+        if func_name in self.func_map:
+            args = [self.compile(child) for child in node.children[1:]]
+            return self.func_map[func_name](node, args)
+
+        def evaluate(ctx):
+            raise CellError(CellErrorType.BAD_NAME,
+                            'Function name in formula is unrecognized.')
+        return evaluate
+
+    def and_func(self, node, args):
+        def evaluate(ctx):
+            values = [arg(ctx) for arg in args]
+            if len(values) < 1:
+                raise wrong_arguments()
+            check_if_errors(values)
+            check_if_cell_range(values)
+            for value in values:
+                if value_bool_converter(value) == False:
+                    return False
             return True
-        else:
-            return False
-    
-    @lru_cache
-    def value_bool_converter(self, value):
-        if value is None:
+        return evaluate
+
+    def or_func(self, node, args):
+        def evaluate(ctx):
+            values = [arg(ctx) for arg in args]
+            if len(values) < 1:
+                raise wrong_arguments()
+            check_if_errors(values)
+            check_if_cell_range(values)
+            found_true = False
+            for value in values:
+                if value_bool_converter(value) == True:
+                    found_true = True
+            return found_true
+        return evaluate
+
+    def not_func(self, node, args):
+        def evaluate(ctx):
+            values = [arg(ctx) for arg in args]
+            if len(values) != 1:
+                raise wrong_arguments()
+            check_if_errors(values)
+            return not value_bool_converter(values[0])
+        return evaluate
+
+    def xor_func(self, node, args):
+        def evaluate(ctx):
+            values = [arg(ctx) for arg in args]
+            if len(values) < 1:
+                raise wrong_arguments()
+            check_if_errors(values)
+            check_if_cell_range(values)
+            ret_value = False
+            for value in values:
+                if value_bool_converter(value) == True:
+                    ret_value = not ret_value
+            return ret_value
+        return evaluate
+
+    def exact_func(self, node, args):
+        def evaluate(ctx):
+            return strings_equal([arg(ctx) for arg in args])
+        return evaluate
+
+    def if_func(self, node, args):
+        '''
+        Only the branch that is taken counts as a dependency. A false
+        condition without an else branch keeps the true branch.
+        '''
+        key = id(node)
+        if len(args) < 2 or len(args) > 3:
+            def evaluate(ctx):
+                raise wrong_arguments()
+            return evaluate
+
+        condition_arg = args[0]
+        branches = args[1:]
+
+        def evaluate(ctx):
+            condition = value_bool_converter(condition_arg(ctx))
+            if condition == True:
+                ctx.kept_branches[key] = (0,)
+                return branches[0](ctx) or decimal.Decimal(0)
+            if len(branches) == 2:
+                ctx.kept_branches[key] = (1,)
+                return branches[1](ctx) or decimal.Decimal(0)
+            ctx.kept_branches[key] = (0,)
             return False
-        if type(value) == bool:
-            return value
-        if type(value) == str:
-            resp = self.check_str_bool(value)
-            if type(resp) != bool:
-                raise CellError(
-                    CellErrorType.TYPE_ERROR,
-                    'Incompatible types of values.')
-            else:
-                return resp
-        elif type(value) == decimal.Decimal:
-            if value == decimal.Decimal(0):
-                return False
-            else:
-                return True
-        else:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Incompatible types of values.')
+        return evaluate
 
-    @visit_children_decor
-    def and_func(self, values):
-        values = values[1:]
-        if len(values) < 1:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Wrong number of arguments.')
-        self.check_if_errors(values)
-        self.check_if_cell_range(values)
-        for value in values:
-            conv_value = self.value_bool_converter(value)
-            if conv_value == False:
-                return False
-        return True
+    def iferror_func(self, node, args):
+        '''
+        The fallback only counts as a dependency when the value is an error.
+        '''
+        key = id(node)
+        if len(args) < 1 or len(args) > 2:
+            def evaluate(ctx):
+                raise wrong_arguments()
+            return evaluate
 
-    @visit_children_decor
-    def or_func(self, values):
-        values = values[1:]
-        if len(values) < 1:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Wrong number of arguments.')
-        self.check_if_errors(values)
-        self.check_if_cell_range(values)
-        found_true = False
-        for value in values:
-            conv_value = self.value_bool_converter(value)
-            if conv_value == True:
-                found_true = True
-        return found_true
-
-    @visit_children_decor
-    def not_func(self, values):
-        values = values[1:]
-        if len(values) != 1:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Wrong number of arguments.')
-        self.check_if_errors(values)
-        conv_value = self.value_bool_converter(values[0])
-        return not conv_value
-
-    @visit_children_decor
-    def xor_func(self, values):
-        values = values[1:]
-        if len(values) < 1:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Wrong number of arguments.')
-        self.check_if_errors(values)
-        self.check_if_cell_range(values)
-        ret_value = False
-        for value in values:
-            conv_value = self.value_bool_converter(value)
-            if conv_value == True:
-                ret_value = not ret_value
-        return ret_value
-
-    @visit_children_decor
-    def exact_func(self, values):
-        values = values[1:]
-        
-        self.check_if_cell_range(values)
-        if len(values) != 2:
-            raise CellError(CellErrorType.TYPE_ERROR, 'Wrong number of arguments.')
-        if values[0] is None:
-            values[0] = ''
-        if values[1] is None:
-            values[1] = ''
-        if not isinstance(values[0], str):
-            values[0] = self.convert_value_to_string(values[0])
-        if not isinstance(values[1], str):
-            values[1] = self.convert_value_to_string(values[1])
-        self.check_if_errors(values)
-        if values[0] == values[1]:
-            return True
-        return False
-    
-    def if_func(self, parent):
-        if len(parent.children) < 3 or len(parent.children) > 4:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Wrong number of arguments.')
-        
-        #copy_tree = Tree(tree.data, deepcopy(tree.children, None))
+        value_arg = args[0]
+        fallback = args[1] if len(args) == 2 else None
 
-        new_children = parent.children[0:2]
-        condition = self.value_bool_converter(self.visit(parent.children[1]))
+        def use_fallback(ctx):
+            if fallback is None:
+                return ""
+            ctx.kept_branches[key] = (0,)
+            return fallback(ctx)
 
-        if not isinstance(condition, bool):
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Conditional is not Valid.')
-        
-        if condition == True:
-            value_tree = parent.children[2]
-            new_children.append(value_tree)
-            parent.children = new_children
-            value = self.visit(value_tree)
-            return value or decimal.Decimal(0)
-        else:
-            if len(parent.children) == 4:
-                value_tree = parent.children[3]
-                new_children.append(value_tree)
-                parent.children = new_children
-                value = self.visit(value_tree)
-                return value or decimal.Decimal(0)
-            else:
+        def evaluate(ctx):
+            if ctx.in_scc:
+                detail = 'Cell is part of circular reference.'
+                raise CellError(CellErrorType.CIRCULAR_REFERENCE, detail)
+            try:
+                value = value_arg(ctx)
+                if not isinstance(value, CellError):
+                    ctx.kept_branches[key] = ()
+                    if value is None:
+                        return 0
+                    return value
+                return use_fallback(ctx)
+            except CellError:
+                return use_fallback(ctx)
+        return evaluate
+
+    def choose_func(self, node, args):
+        def evaluate(ctx):
+            if len(args) < 2:
+                raise wrong_arguments()
+            index_step = args[0](ctx)
+            check_if_errors([index_step])
+            index = int(convert_to_decimal(index_step))
+            if index < 1 or index >= len(args):
+                raise CellError(CellErrorType.TYPE_ERROR,
+                                'Index out of range.')
+            return args[index](ctx)
+        return evaluate
+
+    def isblank_func(self, node, args):
+        def evaluate(ctx):
+            if len(args) != 1:
+                raise wrong_arguments()
+            if ctx.in_scc:
+                detail = 'Cell is part of circular reference.'
+                raise CellError(CellErrorType.CIRCULAR_REFERENCE, detail)
+            try:
+                return args[0](ctx) is None
+            except CellError:
                 return False
+        return evaluate
+
+    def iserror_func(self, node, args):
+        def evaluate(ctx):
+            if len(args) != 1:
+                raise wrong_arguments()
+            if ctx.in_scc:
+                detail = 'Cell is part of circular reference.'
+                raise CellError(CellErrorType.CIRCULAR_REFERENCE, detail)
+            try:
+                check_if_errors([args[0](ctx)])
+                return False
+            except (Exception, CellError):
+                return True
+        return evaluate
 
-    def iferror_func(self, parent):
-        if len(parent.children) < 2 or len(parent.children) > 3:
-            raise CellError(CellErrorType.TYPE_ERROR, 'Wrong number of arguments.')
-        
-        #copy_tree = Tree(tree.data, deepcopy(tree.children, None))
-
-        if scc_member:
-            detail = 'Cell is part of circular reference.'
-            raise CellError(CellErrorType.CIRCULAR_REFERENCE, detail)
-        new_children = parent.children[0:2]
-        try:
-            condition_value = self.visit(parent.children[1])
-            if not isinstance(condition_value, CellError):
-                parent.children = new_children
-                if condition_value is None:
-                    return 0
-                return condition_value
+    def version_func(self, node, args):
+        def evaluate(ctx):
+            values = [arg(ctx) for arg in args]
+            if len(values) > 0:
+                raise wrong_arguments()
+            return version
+        return evaluate
+
+    def indirect_func(self, node, args):
+        '''
+        A cell or range written directly in INDIRECT is read as it is.
+        Anything else is evaluated and its text is compiled as a formula; the
+        references of that formula become dependencies of this one.
+        '''
+        if len(args) != 1:
+            def evaluate(ctx):
+                raise wrong_arguments()
+            return evaluate
+
+        arg = args[0]
+        is_literal = node.children[1].data in ('cell', 'cell_range')
+
+        def evaluate(ctx):
+            if is_literal:
+                ret_value = arg(ctx)
             else:
-                if len(parent.children) == 3:
-                    value_tree = parent.children[2]
-                    new_children.append(value_tree)
-                    parent.children = new_children
-                    value = self.visit(value_tree)
-                    return value
+                formula = compile_formula(f'={arg(ctx)}')
+                kept_branches = ctx.kept_branches
+                ctx.kept_branches = {}
+                try:
+                    ret_value = formula.evaluate(ctx)
+                finally:
+                    ctx.refs.extend(formula.get_refs(ctx.kept_branches))
+                    ctx.kept_branches = kept_branches
+            if ret_value is None:
+                raise CellError(CellErrorType.BAD_REFERENCE,
+                                'Cannot parse input as cell reference.')
+            return ret_value
+        return evaluate
+
+    def min_max_sum_average(self, args, func):
+        '''
+        Returns a closure that evaluates to (aggregate, count) over every
+        argument, where ranges contribute each of their non-empty cells.
+        Ranges of numbers are aggregated from the numeric columns of their
+        sheet when it keeps them.
+        '''
+        def evaluate(ctx):
+            if len(args) < 1:
+                raise wrong_arguments()
+            count = 0
+            ret_value = None
+            for arg in args:
+                calc_child = arg(ctx)
+                if isinstance(calc_child, CellRange):
+                    aggregate = range_aggregate(ctx, calc_child, func,
+                                                ret_value)
+                    if aggregate is not None:
+                        (value, num_values) = aggregate
+                        count += num_values
+                        child_values = [] if value is None else [value]
+                    else:
+                        child_values = cell_range_helper(ctx, calc_child,
+                                                         conv_to_dec=True)
+                        count += len(child_values)
+                elif calc_child is not None:
+                    child_values = [convert_val_to_decimal(calc_child)]
+                    count += 1
                 else:
-                    return ""
-
-        except CellError:
-            if len(parent.children) == 3:
-                value_tree = parent.children[2]
-                new_children.append(value_tree)
-                parent.children = new_children
-                value = self.visit(value_tree)
-                return value
+                    child_values = []
+                for value in child_values:
+                    if ret_value is not None:
+                        ret_value = func([ret_value, value])
+                    else:
+                        ret_value = value
+            if ret_value is None:
+                ret_value = 0
+            return ret_value, count
+        return evaluate
+
+    def min_func(self, node, args):
+        aggregate = self.min_max_sum_average(args, min)
+        return lambda ctx: aggregate(ctx)[0]
+
+    def max_func(self, node, args):
+        aggregate = self.min_max_sum_average(args, max)
+        return lambda ctx: aggregate(ctx)[0]
+
+    def sum_func(self, node, args):
+        aggregate = self.min_max_sum_average(args, sum)
+        return lambda ctx: aggregate(ctx)[0]
+
+    def average_func(self, node, args):
+        aggregate = self.min_max_sum_average(args, sum)
+
+        def evaluate(ctx):
+            total_sum, count = aggregate(ctx)
+            if count == 0:
+                raise CellError(CellErrorType.DIVIDE_BY_ZERO,
+                                'Invalid cell range.')
+            return total_sum / count
+        return evaluate
+
+    def lookup(self, args, is_row):
+        '''
+        Returns a closure for HLOOKUP (is_row) or VLOOKUP. The match can move
+        anywhere along the first row or column, so the lookup depends on all
+        of it and on all of the row or column it returns from.
+        '''
+        if len(args) != 3:
+            def evaluate(ctx):
+                raise wrong_arguments()
+            return evaluate
+
+        key_arg, range_arg, index_arg = args
+
+        def evaluate(ctx):
+            key = key_arg(ctx)
+            index = int(convert_val_to_decimal(index_arg(ctx)))
+
+            calc_child = range_arg(ctx)
+            if not isinstance(calc_child, CellRange):
+                raise CellError(CellErrorType.TYPE_ERROR, 'No range provided.')
+            size = calc_child.height() if is_row else calc_child.width()
+            if index > size or index < 1:
+                raise CellError(CellErrorType.TYPE_ERROR,
+                                'Index out of range.')
+            try:
+                cell_range_helper(ctx, calc_child, conv_to_dec=False)
+            except CellError:
+                # the error, or the cycle, can be anywhere in the range, so
+                # the lookup depends on all of it until the error is gone
+                ctx.refs.append((calc_child.sheet_name,
+                                 num_to_col(calc_child.left_col) +
+                                 str(calc_child.top_row),
+                                 num_to_col(calc_child.right_col) +
+                                 str(calc_child.bot_row)))
+                raise
+
+            add_lookup_ref(ctx, calc_child, 0, 0, is_row)
+            if is_row:
+                add_lookup_ref(ctx, calc_child, 0, index - 1, is_row)
+                for j in range(calc_child.width()):
+                    if strings_equal([key, get_range_value(ctx, calc_child,
+                                                           j, 0)]):
+                        return get_range_value(ctx, calc_child, j, index - 1)
             else:
-                return ""
+                add_lookup_ref(ctx, calc_child, index - 1, 0, is_row)
+                for j in range(calc_child.height()):
+                    if strings_equal([key, get_range_value(ctx, calc_child,
+                                                           0, j)]):
+                        return get_range_value(ctx, calc_child, index - 1, j)
+            raise CellError(CellErrorType.TYPE_ERROR,
+                            'Wrong number of arguments.')
+        return evaluate
 
-    def choose_func(self, parent):
-        if len(parent.children) < 3:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Wrong number of arguments.')
-        new_children = parent.children[0:2]
-        
-        index_step = self.visit(parent.children[1])
-        self.check_if_errors([index_step])
-        index = int(self.convert_to_decimal(index_step))
-
-        if index < 1 or index >= len(parent.children)-1:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Index out of range.')
-        
-        new_children.append(parent.children[index+1])
+    def hlookup_func(self, node, args):
+        return self.lookup(args, is_row=True)
 
-        return self.visit(parent.children[index+1])
+    def vlookup_func(self, node, args):
+        return self.lookup(args, is_row=False)
 
-    #@visit_children_decor
-    def isblank_func(self, parent):
-        if len(parent.children) != 2:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Wrong number of arguments.')
-        if scc_member:
-            detail = 'Cell is part of circular reference.'
-            raise CellError(CellErrorType.CIRCULAR_REFERENCE, detail)
-        try:
-            values = self.visit(parent.children[1])
-            if values == None:
-                return True
-            return False
-        except CellError:
-            return False
 
-    #@visit_children_decor
-    def iserror_func(self, parent):
-        if len(parent.children) != 2:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Wrong number of arguments.')
-        
-        if scc_member:
-            detail = 'Cell is part of circular reference.'
-            raise CellError(CellErrorType.CIRCULAR_REFERENCE, detail)
-        try:
-            value = self.visit(parent.children[1])
-            self.check_if_errors([value])
-            return False
-        except (Exception, CellError):
-            return True
 
-    @visit_children_decor
-    def version_func(self, values):
-        values = values[1:]
-        if len(values) > 0:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Wrong number of arguments.')
-        return version
+#=============================================================================
+# Relocation
+#
+# Moving or copying a formula shifts its relative references, and renaming a
+# sheet changes the sheet names in references to it. The new formula is built
+# from the compiled one: its reference nodes are replaced in the tree, which
+# is compiled again without being parsed, and its text is only written out
+# when the cell's contents are asked for.
 
-    def indirect_func(self, parent):
-        if len(parent.children) != 2:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Wrong number of arguments.')
-        prelim_value = parent.children[1]
-        if prelim_value.data == 'cell' or prelim_value.data == 'cell_range':
-            value = prelim_value
-            new_tree = value
-        else:
-            value = self.visit(prelim_value)
-            new_tree = use_parser.parse(f'={value}')
-            parent.children[1] = new_tree
-            calculated_refs.append(new_tree)
+CORNER_PATTERN = re.compile(r"(\$?)([a-z]+)(\$?)([1-9][0-9]*)$", re.I)
 
-        ret_value = self.visit(new_tree)
-        if ret_value is None:
-            raise CellError(
-                CellErrorType.BAD_REFERENCE,
-                'Cannot parse input as cell reference.')
+MAX_COL = col_to_num('zzzz')
+MAX_ROW = 9999
 
-        return ret_value
+REF_ERROR = '#REF!'
 
-    def parse_cell_ref(self, cell_ref):
-        match = re.match(r"([a-z]+)([1-9][0-9]*)$", cell_ref, re.I)
-        if not match:
-            return False
-            
-        col, row = match.groups()
-        return col, row
-    
-    def num_to_col(self, num):
-        res = ''
-        while num > 0:
-            num, remainder = divmod (num - 1, 26)
-            res = chr(remainder + ord('a')) + res
-        return res
-
-    def col_to_num(self, col: str):
-        num = 0
-        for letter in col:
-            if letter in string.ascii_letters:
-                num = num * 26 + (ord(letter.upper()) - ord('A')) + 1
-        return num
-    
-    def find_top_left_bot_right_corners(self, start_location, end_location):
-        start_col, start_row = self.parse_cell_ref(start_location)
-        end_col, end_row = self.parse_cell_ref(end_location)
-        start_row, end_row = int(start_row), int(end_row)
-        top_row, bot_row = min(start_row, end_row), max(start_row, end_row)
-        
-        start_col_num, end_col_num = self.col_to_num(start_col), self.col_to_num(end_col)
-        left_col_num, right_col_num = min(start_col_num, end_col_num), max(start_col_num, end_col_num)
-
-        top_left = self.num_to_col(left_col_num) + str(top_row)
-        bot_right = self.num_to_col(right_col_num) + str(bot_row)
-        return top_left, bot_right
-    
-    # how do we make sure that a type error is raised if a cell range is returned in a case that should not accept one 
-    @visit_children_decor
-    def cell_range(self, parent):
-        tree_arr = []
-        
-        if parent[0].type == "SHEET_NAME" or parent[0].type == "QUOTED_SHEET_NAME":
-            sheet_name = parent[0]
-            parent = parent[1:]
-        else:
-            sheet_name = None
-
-        top_left, bot_right = self.find_top_left_bot_right_corners(parent[0], parent[1])
-        top_left_col, top_left_row = self.parse_cell_ref(top_left)
-        bot_right_col, bot_right_row = self.parse_cell_ref(bot_right)
-        
-        
-        for row in range(int(top_left_row), int(bot_right_row) + 1):
-            tree_row = []
-            for col_num in range(self.col_to_num(top_left_col), self.col_to_num(bot_right_col) + 1):
-                if sheet_name is None:
-                    temp_tree = use_parser.parse(f'={self.num_to_col(col_num) + str(row)}')
-                else:
-                    temp_tree = use_parser.parse(f'={sheet_name}!{self.num_to_col(col_num) + str(row)}')
-                tree_row.append(temp_tree)
-
-            tree_arr.append(tree_row)
-        return tree_arr
-    
-    def convert_val_to_decimal(self, value):
-        if value is None:
+SHEET_NAME_TOKENS = ('SHEET_NAME', 'QUOTED_SHEET_NAME')
+
+# the sheet names that can be written without quotes, as in the grammar
+UNQUOTED_SHEET_NAME = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+
+def text_pieces(tree, text):
+    '''
+    Splits the text of a formula into the nodes of its references and
+    strings, and the text between them, in the order they are written.
+    '''
+    nodes = [node for node in tree.iter_subtrees()
+             if node.data in ('cell', 'cell_range', 'string')]
+    nodes.sort(key=lambda node: node.children[0].start_pos)
+    pieces = []
+    end = 0
+    for node in nodes:
+        pieces.append(text[end:node.children[0].start_pos])
+        pieces.append(node)
+        end = node.children[-1].end_pos
+    pieces.append(text[end:])
+    return tuple(pieces)
+
+
+def piece_text(node):
+    '''
+    Writes out a node from the pieces of a relocated formula. A reference
+    that moved off the sheet is an error node.
+    '''
+    children = node.children
+    if node.data in ('error', 'string'):
+        return children[0].value
+    if children[0].type in ('SHEET_NAME', 'QUOTED_SHEET_NAME'):
+        return children[0].value + '!' + ':'.join(corner.value
+                                                  for corner in children[1:])
+    return ':'.join(corner.value for corner in children)
+
+
+def move_corner(corner, col_move, row_move):
+    '''
+    Moves a cell location in a reference by the given numbers of columns and
+    rows, leaving the parts marked with $ as they are. Returns the location
+    in upper case, or None if it would be off the sheet.
+    '''
+    col_dollar, col, row_dollar, row = CORNER_PATTERN.match(corner).groups()
+    if not col_dollar and col_move:
+        col_num = col_to_num(col) + col_move
+        if col_num < 1 or col_num > MAX_COL:
             return None
-        return self.convert_to_decimal(value)
-
-    def cell_range_helper(self, tree_arr, conv_to_dec=False):
-        value_arr = []
-        error = None
-        for row in tree_arr:
-            value_row = []
-            for cell in row:
-                value = self.visit(cell)
-                if isinstance(value, CellError):
-                    if value.get_type() == CellErrorType.CIRCULAR_REFERENCE:
-                        raise value
-                    else:
-                        error = value
-                if conv_to_dec:
-                    value_row.append(self.convert_to_decimal(value))
-                else:
-                    value_row.append(value)
-                
-            value_arr.append(value_row)
-        if error:
-            raise error
-        return value_arr
-
-    # lets make a cohesive list of cells then loop through the evaluated
-    # cells for
-    def min_max_sum_average_callable(self, parent, func):
-        if len(parent.children) < 2:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Wrong number of arguments.')
-        
-        new_children = parent.children[0:1]
-        values = []
-        ret_value = None
-        for child in parent.children[1:]:
-            calc_child = self.visit(child)
-            if type(calc_child) == list:
-                value_arr = self.cell_range_helper(calc_child, conv_to_dec=True)
-                #print(value_arr)
-                for i in range(len(value_arr)):
-                    for j in range(len(value_arr[0])):
-                        if value_arr[i][j] is not None:
-                            #print(value_arr[i][j])
-                            values.append(value_arr[i][j])
-                            if ret_value:
-                                ret_value = func([ret_value, value_arr[i][j]])
-                            else:
-                                ret_value = value_arr[i][j]
-                        new_children.append(calc_child[i][j])
-            else:
-                if calc_child is not None:
-                    dec_child = self.convert_val_to_decimal(calc_child)
-                    values.append(dec_child)
-                    if ret_value:
-                        ret_value = func([ret_value, dec_child])
-                    else:
-                        ret_value = dec_child
-                
-                new_children.append(child)
-        parent.children = new_children
-
-        if ret_value is None:
-            ret_value = 0
-        #print(ret_value)
-        return ret_value, values
-    
-    def min_func(self, parent):
-        ret_value, _ = self.min_max_sum_average_callable(parent, min)
-        #print(ret_value)
-        return ret_value
-
-    def max_func(self, parent):
-        ret_value, _ = self.min_max_sum_average_callable(parent, max)
-        #print(ret_value)
-        return ret_value
-
-    def sum_func(self, parent):
-        ret_value, _ = self.min_max_sum_average_callable(parent, sum)
-        #print(ret_value)
-        return ret_value
-
-    def average_func(self, parent):
-        #print('here')
-        total_sum, values = self.min_max_sum_average_callable(parent, sum)
-        #print('here')
-        if len(values) == 0:
-            raise CellError(CellErrorType.DIVIDE_BY_ZERO,
-                            'Invalid cell range.')
-        #print(total_sum, len(values))
-        return total_sum / len(values) 
-    
-    def lookup_exact(self, values):
-        #print(values)
-        self.check_if_cell_range(values)
-        if len(values) != 2:
-            print(values)
-            raise CellError(CellErrorType.TYPE_ERROR, 'Wrong number of arguments.')
-        if values[0] is None:
-            values[0] = ''
-        if values[1] is None:
-            values[1] = ''
-        if not isinstance(values[0], str):
-            values[0] = self.convert_value_to_string(values[0])
-        if not isinstance(values[1], str):
-            values[1] = self.convert_value_to_string(values[1])
-        self.check_if_errors(values)
-        if values[0] == values[1]:
-            return True
-        return False
+        col = num_to_col(col_num)
+    if not row_dollar and row_move:
+        row = int(row) + row_move
+        if row < 1 or row > MAX_ROW:
+            return None
+    return f'{col_dollar}{col.upper()}{row_dollar}{row}'
 
-    def hlookup_func(self, parent):
-        if len(parent.children) != 4:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Wrong number of arguments.')
-        
-        new_children = parent.children[0:2]
-
-        key = self.visit(parent.children[1])
-        index = int(self.convert_val_to_decimal(self.visit(parent.children[3])))
-        new_children.append(parent.children[3])
-        column = None
-
-        calc_child = self.visit(parent.children[2])
-        if type(calc_child) == list:
-            value_arr = self.cell_range_helper(calc_child, conv_to_dec=False)
-            for i in [0]:
-                for j in range(len(value_arr[i])):
-                    new_children.append(calc_child[i][j])
-                    
-                    if self.lookup_exact([key, value_arr[i][j]]):
-                        column = j
-                        break
-                    
-                for k in range(j, len(value_arr[i])):
-                    new_children.append(calc_child[i][k])
 
+def move_ref_node(node, col_move, row_move):
+    '''
+    Returns a cell or cell range node moved by the given numbers of columns
+    and rows, with its sheet name in lower case, or a #REF! error node if any
+    of its corners would be off the sheet.
+    '''
+    children = []
+    for token in node.children:
+        if token.type in ('SHEET_NAME', 'QUOTED_SHEET_NAME'):
+            children.append(Token(token.type, token.value.lower()))
+            continue
+        corner = move_corner(token.value, col_move, row_move)
+        if corner is None:
+            return Tree('error', [Token('ERROR_VALUE', REF_ERROR)])
+        children.append(Token('CELLREF', corner))
+    return Tree(node.data, children)
+
+
+def replace_nodes(node, replacements):
+    '''
+    Returns a tree with the nodes whose ids are in replacements swapped for
+    their replacements. Subtrees without replaced nodes are shared with the
+    old tree, which is fine because trees are never changed.
+    '''
+    if id(node) in replacements:
+        return replacements[id(node)]
+    if isinstance(node, Token):
+        return node
+    children = [replace_nodes(child, replacements) for child in node.children]
+    if all(new is old for (new, old) in zip(children, node.children)):
+        return node
+    return Tree(node.data, children)
+
+
+@lru_cache(maxsize=65536)
+def relocate_formula(formula, col_move, row_move):
+    '''
+    Returns a compiled formula as it reads after being moved or copied by the
+    given numbers of columns and rows. Relative and mixed references are
+    shifted, and references that would be off the sheet become #REF!. The
+    formula is not parsed again, and its text is in the form move and copy
+    have always written: references in upper case, the rest in lower case.
+    '''
+    replacements = {}
+    pieces = []
+    for piece in formula.get_pieces():
+        if isinstance(piece, str):
+            pieces.append(piece.lower())
+            continue
+        if piece.data == 'error':
+            pieces.append(piece)
+            continue
+        moved = piece
+        if piece.data == 'string':
+            # strings are lower cased like the rest of the text, so that the
+            # value matches the text
+            value = piece.children[0].value
+            if value != value.lower():
+                moved = Tree('string', [Token('STRING', value.lower())])
         else:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'No range provided.')
-        
-        if index > len(value_arr) or index < 1:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Index out of range.')
-        
-        for k in range(j, len(value_arr[0])):
-            new_children.append(calc_child[index-1][k])
-        parent.children = new_children
-        if column is None:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Wrong number of arguments.')
-        
-        
-        return value_arr[index-1][column]
+            moved = move_ref_node(piece, col_move, row_move)
+        if moved is not piece:
+            replacements[id(piece)] = moved
+        pieces.append(moved)
+    tree = replace_nodes(formula.tree, replacements)
+    return get_compiler().compile_formula(tree, pieces=tuple(pieces))
 
-    def vlookup_func(self, parent):
-        if len(parent.children) != 4:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Wrong number of arguments.')
-        
-        new_children = parent.children[0:2]
-
-        key = self.visit(parent.children[1])
-        index = int(self.convert_val_to_decimal(self.visit(parent.children[3])))
-        new_children.append(parent.children[3])
-        row = None
-
-        calc_child = self.visit(parent.children[2])
-        if type(calc_child) == list:
-            value_arr = self.cell_range_helper(calc_child, conv_to_dec=False)
-            for i in [0]:
-                for j in range(len(value_arr)):
-                    new_children.append(calc_child[j][i])
-                    if self.lookup_exact([key, value_arr[j][i]]):
-                        row = j
-                        break
-                for k in range(j, len(value_arr[i])):
-                    new_children.append(calc_child[k][i])
 
-        else:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'No range provided.')
-        if index > len(value_arr[0]) or index < 1:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Index out of range.')
-        
-        for k in range(j, len(value_arr)):
-            new_children.append(calc_child[k][index-1])
+def sheet_name_ref(sheet_name):
+    '''
+    Returns a sheet name as it is written in a formula: in single quotes if
+    and only if it is not a valid unquoted sheet name.
+    '''
+    if UNQUOTED_SHEET_NAME.fullmatch(sheet_name):
+        return sheet_name
+    return f"'{sheet_name}'"
 
-        parent.children = new_children
-        if row is None:
-            raise CellError(
-                CellErrorType.TYPE_ERROR,
-                'Wrong number of arguments.')
-        
-        
-        return value_arr[row][index-1]
-    
-    def func(self, values):
-        func_map = {'and': self.and_func, 'or': self.or_func, 'not': self.not_func,
-                    'xor': self.xor_func, 'exact': self.exact_func,
-                    'if': self.if_func, 'iferror': self.iferror_func,
-                    'choose': self.choose_func, 'isblank': self.isblank_func,
-                    'iserror': self.iserror_func, 'version': self.version_func,
-                    'indirect': self.indirect_func, 'min': self.min_func,
-                    'max': self.max_func, 'sum': self.sum_func,
-                    'average': self.average_func, 'hlookup': self.hlookup_func,
-                    'vlookup': self.vlookup_func
-                    }
-
-        self.contains_func = True
-        func_name = values.children[0].lower()
-        if func_name in func_map:
-            return func_map[func_name](values)
-        else:
-            raise CellError(CellErrorType.BAD_NAME, 'Function name in formula is unrecognized.')
-        
-    
+
+@lru_cache(maxsize=65536)
+def rename_formula_sheet(formula, sheet_name, new_sheet_name):
+    '''
+    Returns a compiled formula as it reads after a sheet it refers to is
+    renamed. References to the sheet use the new name, and every sheet name
+    in the formula is quoted only if it has to be. So do references to the
+    sheet written as a string passed straight to INDIRECT, so they still
+    find it. The rest of the text is kept as it was written, and the
+    formula is not parsed again.
+
+    Parameters:
+        formula (CompiledFormula): the formula to rename the sheet in
+        sheet_name (str): the lower case old sheet name
+        new_sheet_name (str): the new sheet name, in its own case
+    '''
+    replacements = {}
+    pieces = []
+    indirect_strings = {id(node.children[1]) for node
+                        in formula.tree.iter_subtrees()
+                        if node.data == 'func' and len(node.children) == 2
+                        and node.children[0].lower() == 'indirect'}
+    for piece in formula.get_pieces():
+        if (not isinstance(piece, str) and piece.data == 'string' and
+                id(piece) in indirect_strings):
+            text = rename_reference_text(piece.children[0][1:-1], sheet_name,
+                                         new_sheet_name)
+            if text is not None:
+                renamed = Tree('string', [Token('STRING', f'"{text}"')])
+                replacements[id(piece)] = renamed
+                piece = renamed
+            pieces.append(piece)
+            continue
+        if (isinstance(piece, str) or piece.data == 'string' or
+                piece.children[0].type not in SHEET_NAME_TOKENS):
+            pieces.append(piece)
+            continue
+        token = piece.children[0]
+        name = token.value
+        if token.type == 'QUOTED_SHEET_NAME':
+            name = name[1:-1]
+        if name.lower() == sheet_name:
+            name = new_sheet_name
+        written = sheet_name_ref(name)
+        if written != token.value:
+            token_type = ('SHEET_NAME' if written == name
+                          else 'QUOTED_SHEET_NAME')
+            renamed = Tree(piece.data, [Token(token_type, written)] +
+                           piece.children[1:])
+            replacements[id(piece)] = renamed
+            piece = renamed
+        pieces.append(piece)
+    tree = replace_nodes(formula.tree, replacements)
+    return get_compiler().compile_formula(tree, pieces=tuple(pieces))
+
+
+def rename_reference_text(text, sheet_name, new_sheet_name):
+    '''
+    Returns the text of a cell or range reference, as INDIRECT reads it,
+    after the sheet it refers to is renamed; or None if the text is not a
+    reference to that sheet.
+    '''
+    formula = try_compile('=' + text)
+    if formula is None or formula.tree.data not in ('cell', 'cell_range'):
+        return None
+    token = formula.tree.children[0]
+    if token.type not in SHEET_NAME_TOKENS:
+        return None
+    name = token.value[1:-1] if token.type == 'QUOTED_SHEET_NAME' else token.value
+    if name.lower() != sheet_name:
+        return None
+    return (sheet_name_ref(new_sheet_name) + '!' +
+            ':'.join(corner.value for corner in formula.tree.children[1:]))
+
+
+def try_compile(contents):
+    '''
+    Returns the compiled formula for the contents, or None if they cannot be
+    parsed.
+    '''
+    try:
+        return compile_formula(contents)
+    except lark.exceptions.UnexpectedInput:
+        return None
 
 
-def parse_contents(parser, parsed_trees, sheet_name, contents, workbook, start_tree=None, in_scc=False):
+def formula_refs(contents):
     '''
-    Parses the contents of a cell and returns a tuple of (cell's value, parsed
-    tree).
+    Returns the references a formula may read, without evaluating it: every
+    branch of its IF and IFERROR functions, but not the rows and columns that
+    lookups read or the cells that INDIRECT builds. A formula that cannot be
+    parsed has no references.
+    '''
+    formula = try_compile(contents)
+    if formula is None:
+        return []
+    return formula.get_refs({})
+
+
+def parse_contents(sheet_name, contents, workbook, in_scc=False):
+    '''
+    Parses and evaluates the contents of a cell and returns a tuple of (cell's
+    value, compiled formula, references). Decimal values have no trailing
+    zeros after the decimal point. The references are relative to the
+    cell's sheet: (sheet name or None, location) for cells and (sheet name or
+    None, start location, end location) for ranges. The compiled formula is
+    None if the contents cannot be parsed.
     '''
-    evaluator = FormulaEvaluator(sheet_name, workbook)
-    global calculated_refs
-    calculated_refs = []
     try:
-        if contents in parsed_trees:
-            old_tree = parsed_trees[contents]['tree']
-            if parsed_trees[contents]['contains_func']:
-                tree = Tree(old_tree.data, deepcopy(old_tree.children, None))
-            else:
-                tree = old_tree
-        else:
-            tree = parser.parse(contents)
-            new_tree = Tree(tree.data, deepcopy(tree.children, None))
-            #new_tree = tree
-            parsed_trees[contents] = {'tree': new_tree, 'contains_func': False}
-        try:
-            global scc_member
-            scc_member = in_scc
-            
-            global use_parser
-            use_parser = parser
-            #print(tree)
-            value = evaluator.visit(tree)
-            #print(value)
-            if evaluator.contains_func:
-                parsed_trees[contents]['contains_func'] = True
-            
-            if tree.data == 'cell' and value is None:
-                value = decimal.Decimal(0)
-            
-            if isinstance(value, Tree):
-                raise CellError(
-                    CellErrorType.TYPE_ERROR,
-                    'Cell range not processed.')
-            
-        except CellError as e:
-            value = e
-        except (ValueError, KeyError) as e:
-            value = '#REF!'
-            detail = 'Invalid cell reference in formula. ' + \
-                    'Check sheet name and cell location.'
-            value = CellError(CellErrorType.BAD_REFERENCE, detail, e)
-        except (ZeroDivisionError) as e:
-            value = '#DIV/0!'
-            detail = 'Cannot divide by zero.'
-            value = CellError(CellErrorType.DIVIDE_BY_ZERO, detail, e)
-        except (TypeError) as e:
-            detail = 'Incompatible types of values.'
-            value = CellError(CellErrorType.TYPE_ERROR, detail, e)
-    except (lark.LexError, lark.UnexpectedEOF) as e:
-        value = '#ERROR!'
+        formula = compile_formula(contents)
+    except lark.exceptions.UnexpectedInput as e:
+        detail = 'Formula cannot be parsed.'
+        return CellError(CellErrorType.PARSE_ERROR, detail, e), None, []
+
+    value, refs = evaluate_formula(sheet_name, formula, workbook, in_scc)
+    return value, formula, refs
+
+
+def evaluate_formula(sheet_name, formula, workbook, in_scc=False):
+    '''
+    Evaluates a compiled formula in a cell on the given sheet and returns a
+    tuple of (cell's value, references), as parse_contents() does.
+    '''
+    ctx = EvalContext(workbook, sheet_name, in_scc)
+    try:
+        value = formula.evaluate(ctx)
+        if formula.is_cell and value is None:
+            value = decimal.Decimal(0)
+        if isinstance(value, CellRange):
+            raise CellError(
+                CellErrorType.TYPE_ERROR,
+                'Cell range not processed.')
+    except CellError as e:
+        value = e
+    except (ValueError, KeyError) as e:
+        value = CellError(CellErrorType.BAD_REFERENCE, BAD_REFERENCE_DETAIL, e)
+    except (ZeroDivisionError) as e:
+        detail = 'Cannot divide by zero.'
+        value = CellError(CellErrorType.DIVIDE_BY_ZERO, detail, e)
+    except (TypeError) as e:
+        detail = 'Incompatible types of values.'
+        value = CellError(CellErrorType.TYPE_ERROR, detail, e)
+    except lark.exceptions.UnexpectedInput as e:
+        # INDIRECT built text that is not a formula
         detail = 'Formula cannot be parsed.'
         value = CellError(CellErrorType.PARSE_ERROR, detail, e)
-        tree = None
-    
-    #print(tree)
-    #print(value)
-    return value, tree, calculated_refs
+    if isinstance(value, decimal.Decimal) and '.' in str(value):
+        value = decimal.Decimal(str(value).rstrip('0').rstrip('.'))
+
+    refs = formula.get_refs(ctx.kept_branches)
+    refs.extend(ctx.refs)
+    return value, refs
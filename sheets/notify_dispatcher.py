@@ -0,0 +1,283 @@
+'''
+This file contains the dispatchers that call a workbook's notify functions
+in the background, so that an edit does not wait for its notify functions to
+return. See Workbook.set_notify_dispatcher().
+
+Each notify function has its own queue of the change sets it has not been
+sent yet. Whenever it is free, it is sent every change set in its queue at
+once, merged into one set of cells, so a burst of edits reaches a slow notify
+function as a single call. Change sets are sent to each notify function in
+the order the edits were made.
+
+A queue holds at most max_pending change sets. What happens to a change set
+that does not fit is up to the dispatcher's policy:
+
+    BLOCK: the edit waits, once it has finished with the workbook, until the
+        queue has room again, so edits never run far ahead of the notify
+        functions.
+    MERGE: the change set is merged into the last one in the queue, so
+        nothing is lost, and the queue does not grow past a set of every
+        cell in the workbook.
+    DROP: the change set is discarded.
+'''
+
+import asyncio
+import inspect
+import threading
+import time
+
+BLOCK = 'block'
+MERGE = 'merge'
+DROP = 'drop'
+
+
+class Subscriber:
+    '''
+    A registered notify function, and the change sets waiting for it.
+    '''
+
+    def __init__(self, workbook, function):
+        self.workbook = workbook
+        self.function = function
+        # the change sets waiting to be sent, oldest first, as sets of
+        # (sheet name, location) tuples
+        self.pending = []
+        # whether a change set taken from pending is still being sent
+        self.busy = False
+
+    def notify(self, cells):
+        '''
+        Calls the notify function, ignoring anything it raises the way
+        Workbook.send_notify_cells_to_functions() does.
+
+        Returns:
+            the value the function returned
+        '''
+        try:
+            return self.function(self.workbook, cells)
+        # pylint: disable=bare-except
+        except:
+            return None
+
+
+class NotifyDispatcher:
+    '''
+    Sends change sets to notify functions from one background thread per
+    notify function, so a slow notify function holds back neither the edits
+    nor the other notify functions.
+
+    A dispatcher belongs to one workbook.
+    '''
+
+    def __init__(self, max_pending: int = 1024, policy: str = MERGE,
+                 interval: float = 0):
+        '''
+        Parameters:
+            max_pending (int): the most change sets that can wait for one
+                notify function
+            policy (str): what happens to a change set when the queue is full,
+                BLOCK, MERGE or DROP
+            interval (float): how many seconds a notify function waits, after
+                the first change set of a burst arrives, for the rest of the
+                burst before it is sent
+        '''
+        if policy not in (BLOCK, MERGE, DROP):
+            raise ValueError("Invalid notification policy.")
+        if max_pending < 1:
+            raise ValueError("A queue must hold at least one change set.")
+        self.max_pending = max_pending
+        self.policy = policy
+        self.interval = interval
+        self.condition = threading.Condition()
+        # one Subscriber for each registered notify function, in the order
+        # they were registered
+        self.subscribers = []
+        self.closed = False
+
+    def dispatch(self, workbook, functions, cell_sets):
+        '''
+        Queues a change set for every notify function that has one. This
+        never waits: a full queue under BLOCK is waited on by wait_for_room().
+
+        Parameters:
+            workbook (Workbook): the workbook the cells changed in
+            functions (list): the workbook's notify functions
+            cell_sets (list): for each notify function, the (sheet name,
+                location) tuples that changed and that it watches
+        '''
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("The dispatcher is closed.")
+            for function in functions[len(self.subscribers):]:
+                subscriber = Subscriber(workbook, function)
+                self.subscribers.append(subscriber)
+                self.start(subscriber)
+            for (subscriber, cells) in zip(self.subscribers, cell_sets):
+                if not cells:
+                    continue
+                cells = set(cells)
+                pending = subscriber.pending
+                if len(pending) < self.max_pending or self.policy == BLOCK:
+                    pending.append(cells)
+                    self.wake(subscriber)
+                elif self.policy == MERGE:
+                    pending[-1] = pending[-1] | cells
+            self.condition.notify_all()
+
+    def wait_for_room(self):
+        '''
+        Under BLOCK, waits until no queue holds more than max_pending change
+        sets. The workbook calls this after an edit has released it, so that
+        notify functions can read the workbook meanwhile.
+        '''
+        if self.policy != BLOCK:
+            return
+        with self.condition:
+            while any(len(subscriber.pending) > self.max_pending
+                      for subscriber in self.subscribers):
+                self.condition.wait()
+
+    def take(self, subscriber):
+        '''
+        Helper method that takes every change set waiting for a notify
+        function, merged into one set of cells, or returns None if there are
+        none.
+        '''
+        with self.condition:
+            if not subscriber.pending:
+                return None
+            cells = subscriber.pending[0]
+            for change_set in subscriber.pending[1:]:
+                cells = cells | change_set
+            subscriber.pending = []
+            subscriber.busy = True
+            self.condition.notify_all()
+            return cells
+
+    def sent(self, subscriber):
+        '''
+        Helper method that records that a notify function returned.
+        '''
+        with self.condition:
+            subscriber.busy = False
+            self.condition.notify_all()
+
+    def join(self, timeout: float = None) -> bool:
+        '''
+        Waits until every change set queued so far has been sent and every
+        notify function has returned.
+
+        Parameters:
+            timeout (float): the most seconds to wait, or None to wait as long
+                as it takes
+
+        Returns:
+            bool: whether everything was sent before the timeout
+        '''
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not any(subscriber.pending or subscriber.busy
+                                for subscriber in self.subscribers),
+                timeout)
+
+    def close(self):
+        '''
+        Sends whatever is still queued, then stops the dispatcher. Queuing
+        more change sets afterwards raises a RuntimeError.
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.join()
+
+    def start(self, subscriber):
+        '''
+        Helper method that starts sending change sets to a new notify
+        function.
+        '''
+        threading.Thread(target=self.run, args=(subscriber,),
+                         daemon=True).start()
+
+    def wake(self, subscriber):
+        '''
+        Helper method called when a change set is queued for a notify
+        function. The threads are woken by the condition dispatch() notifies.
+        '''
+
+    def run(self, subscriber):
+        '''
+        Helper method that sends the change sets of one notify function, on
+        its own thread, until the dispatcher is closed.
+        '''
+        while True:
+            with self.condition:
+                while not subscriber.pending and not self.closed:
+                    self.condition.wait()
+                if not subscriber.pending:
+                    return
+            if self.interval:
+                time.sleep(self.interval)
+            cells = self.take(subscriber)
+            subscriber.notify(cells)
+            self.sent(subscriber)
+
+
+class AsyncioNotifyDispatcher(NotifyDispatcher):
+    '''
+    Sends change sets to notify functions from an asyncio event loop, which
+    usually runs on another thread than the edits. A notify function may be
+    a coroutine function; the next change set is not sent to it until the
+    coroutine finishes.
+    '''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 max_pending: int = 1024, policy: str = MERGE,
+                 interval: float = 0):
+        '''
+        Parameters:
+            loop (asyncio.AbstractEventLoop): the loop to call the notify
+                functions on
+            see NotifyDispatcher for the rest
+        '''
+        super().__init__(max_pending, policy, interval)
+        self.loop = loop
+
+    def start(self, subscriber):
+        # whether a task on the loop is sending this notify function's
+        # change sets, which is only read and written on the loop
+        subscriber.running = False
+
+    def wake(self, subscriber):
+        self.loop.call_soon_threadsafe(self.schedule, subscriber)
+
+    def schedule(self, subscriber):
+        '''
+        Helper method, run on the loop, that starts a task to send a notify
+        function its change sets unless one is running already.
+        '''
+        if not subscriber.running:
+            subscriber.running = True
+            self.loop.create_task(self.run_async(subscriber))
+
+    async def run_async(self, subscriber):
+        '''
+        Helper method that sends a notify function its change sets until its
+        queue is empty.
+        '''
+        try:
+            while True:
+                if self.interval:
+                    await asyncio.sleep(self.interval)
+                cells = self.take(subscriber)
+                if cells is None:
+                    return
+                result = subscriber.notify(cells)
+                if inspect.isawaitable(result):
+                    try:
+                        await result
+                    # pylint: disable=bare-except
+                    except:
+                        pass
+                self.sent(subscriber)
+        finally:
+            subscriber.running = False
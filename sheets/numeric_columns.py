@@ -0,0 +1,198 @@
+'''
+This file contains the numeric columns of a sheet, which let SUM, MIN, MAX
+and AVERAGE aggregate a range of numbers with NumPy instead of reading its
+cells one by one. NumPy is optional: without it sheets keep no columns, and
+every range is aggregated from its cells.
+
+A number is kept as an int64 of its value times 10 ** SCALE, so aggregates
+are exact and equal, digit for digit, to the Decimal ones. Cells that do not
+fit, such as text, errors, or numbers with more decimal places, are marked
+as other values, and a range containing one is aggregated from its cells.
+'''
+import decimal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from lark_impl import MAX_ROW
+
+# the number of decimal places kept
+SCALE = 6
+# the largest scaled number kept, so that a whole column of them sums
+# without overflowing an int64
+MAX_SCALED = (2 ** 63 - 1) // (MAX_ROW + 1)
+
+# ranges with fewer rows than this are read faster cell by cell, since each
+# column costs a few NumPy calls
+MIN_ROWS = 32
+
+# the kinds of the cells in a column
+BLANK = 0
+NUMBER = 1
+OTHER = 2
+
+
+def scale_value(value):
+    '''
+    Returns a number scaled by 10 ** SCALE, and its exponent, or None if the
+    value is not a number that can be kept. Numbers are only kept with no
+    trailing zeros after the decimal point, which is how cell values are
+    stored, so equal numbers are always the same Decimal.
+    '''
+    if not isinstance(value, decimal.Decimal) or not value.is_finite():
+        return None
+    (sign, digits, exponent) = value.as_tuple()
+    if not -SCALE <= exponent <= 0 or (exponent < 0 and digits[-1] == 0):
+        return None
+    if sign and not value:
+        return None
+    scaled = int(value.scaleb(SCALE))
+    if abs(scaled) > MAX_SCALED:
+        return None
+    return (scaled, exponent)
+
+
+def unscale(scaled, exponent):
+    '''
+    Returns the Decimal with the given exponent of a scaled number.
+    '''
+    return decimal.Decimal(scaled // 10 ** (SCALE + exponent)).scaleb(exponent)
+
+
+def unscale_number(scaled):
+    '''
+    Returns the Decimal of a scaled number as it is stored in a cell, with no
+    trailing zeros after the decimal point.
+    '''
+    exponent = -SCALE
+    while exponent < 0 and scaled % 10 ** (SCALE + exponent + 1) == 0:
+        exponent += 1
+    return unscale(scaled, exponent)
+
+
+class NumericColumns:
+    '''
+    The values of a sheet's cells, column by column. Each column is a tuple
+    of (numbers, exponents, kinds) arrays indexed by row, which grow as rows
+    further down are written; rows past their end are blank.
+    '''
+
+    def __init__(self):
+        # maps column numbers to their arrays
+        self.columns = {}
+        # the columns this sheet has not shared with a copy of it, see copy()
+        self.owned = set()
+
+    def copy(self):
+        '''
+        Returns a copy of the columns. The copy shares the arrays, and each
+        column is copied by whichever of the two writes to it first.
+        '''
+        columns = NumericColumns()
+        columns.columns = dict(self.columns)
+        self.owned = set()
+        return columns
+
+    @staticmethod
+    def is_number(value):
+        '''
+        Returns whether a value is a number the columns can keep. Sums of
+        such numbers are exact, whatever order they are added in.
+        '''
+        return scale_value(value) is not None
+
+    def set(self, col, row, value):
+        '''
+        Records the value of a cell, which is None for an empty cell.
+        '''
+        if value is None:
+            (kind, scaled, exponent) = (BLANK, 0, 0)
+        else:
+            number = scale_value(value)
+            if number is None:
+                (kind, scaled, exponent) = (OTHER, 0, 0)
+            else:
+                (kind, (scaled, exponent)) = (NUMBER, number)
+        column = self.columns.get(col)
+        if column is None or row >= len(column[0]):
+            if kind == BLANK:
+                return
+            column = self.new_column(col, row, column)
+        elif col not in self.owned:
+            column = tuple(array.copy() for array in column)
+            self.columns[col] = column
+            self.owned.add(col)
+        (numbers, exponents, kinds) = column
+        numbers[row] = scaled
+        exponents[row] = exponent
+        kinds[row] = kind
+
+    def new_column(self, col, row, column):
+        '''
+        Helper method that gives a column arrays long enough to hold a row,
+        holding what its old arrays held, if it had any.
+        '''
+        length = 16
+        while length <= row:
+            length *= 2
+        length = min(length, MAX_ROW + 1)
+        arrays = (numpy.zeros(length, numpy.int64),
+                  numpy.zeros(length, numpy.int8),
+                  numpy.zeros(length, numpy.uint8))
+        if column is not None:
+            for (array, old) in zip(arrays, column):
+                array[:len(old)] = old
+        self.columns[col] = arrays
+        self.owned.add(col)
+        return arrays
+
+    def aggregate(self, func, left, top, right, bottom):
+        '''
+        Aggregates the numbers in a range with min, max or sum.
+
+        Returns:
+            tuple: (aggregate, count of numbers), where the aggregate is None
+            if the range is blank; or None if the range holds anything but
+            numbers and blank cells, or is too short to be worth it
+        '''
+        if bottom - top + 1 < MIN_ROWS:
+            return None
+        if right - left < len(self.columns):
+            cols = range(left, right + 1)
+        else:
+            cols = [col for col in self.columns if left <= col <= right]
+        count = 0
+        total = 0
+        exponent = 0
+        found = []
+        for col in cols:
+            column = self.columns.get(col)
+            if column is None:
+                continue
+            stop = min(bottom + 1, len(column[0]))
+            if top >= stop:
+                continue
+            kinds = column[2][top:stop]
+            if kinds.max() == OTHER:
+                return None
+            num = int(numpy.count_nonzero(kinds))
+            if not num:
+                continue
+            count += num
+            numbers = column[0][top:stop]
+            if func is sum:
+                # blank rows hold 0, which changes neither the sum nor its
+                # exponent
+                total += int(numbers.sum())
+                exponent = min(exponent, int(column[1][top:stop].min()))
+            else:
+                numbers = numbers[kinds == NUMBER]
+                found.append(int(numbers.min() if func is min
+                                 else numbers.max()))
+        if not count:
+            return (None, 0)
+        if func is sum:
+            return (unscale(total, exponent), count)
+        return (unscale_number(func(found)), count)
@@ -0,0 +1,162 @@
+'''
+This file contains the parts of parallel recalculation that are shared with
+the worker processes. The workbook sends each worker a list of formula cells
+that do not depend on each other, along with a replica of the values those
+cells read when they were last evaluated. The worker evaluates the formulas
+against the replica and sends back their values and references.
+
+A formula can read a cell it did not read before, such as through INDIRECT or
+a lookup that matches a different row. A worker cannot evaluate such a cell
+correctly, so it reports it back and the workbook evaluates it itself.
+'''
+
+import decimal
+
+from cell import Cell
+from lark_impl import parse_contents, is_valid_cell_location
+from sheet import location_to_coords
+
+# the fewest cells a recalculation must reach, and a level must hold, to be
+# split between worker processes, see Workbook.set_workers()
+MIN_PARALLEL_CELLS = 2000
+
+
+class ReplicaMiss(BaseException):
+    '''
+    Raised when a formula evaluated in a worker reads a cell that the replica
+    does not hold. It is not an Exception, so that IFERROR and ISERROR do not
+    catch it the way they catch errors in the formula.
+    '''
+
+
+class ReplicaSheet:
+    '''
+    The cells of one sheet that a worker's formulas read: single cells, and
+    the non-empty cells of whole ranges.
+    '''
+
+    def __init__(self, values, ranges):
+        '''
+        Parameters:
+            values (dict): maps lower case locations to their values
+            ranges (dict): maps (left, top, right, bottom) ranges to lists of
+                (location, value) tuples for their non-empty cells, in
+                row-major order
+        '''
+        self.values = values
+        # each range with its non-empty cells, as a list of (location, Cell)
+        # in row-major order and a dictionary from location to value
+        self.ranges = []
+        for (cell_range, range_cells) in ranges.items():
+            self.ranges.append((cell_range,
+                                [(location, Cell(None, value))
+                                 for (location, value) in range_cells],
+                                dict(range_cells)))
+
+    def get_cell_value(self, location):
+        location = location.lower()
+        if location in self.values:
+            return self.values[location]
+        if self.ranges and is_valid_cell_location(location):
+            (col, row) = location_to_coords(location)
+            for ((left, top, right, bottom), _, values) in self.ranges:
+                if left <= col <= right and top <= row <= bottom:
+                    return values.get(location)
+        raise ReplicaMiss()
+
+    def get_cells_in_range(self, left_col, top_row, right_col, bot_row):
+        for ((left, top, right, bottom), cells, _) in self.ranges:
+            if not (left <= left_col and right_col <= right and
+                    top <= top_row and bot_row <= bottom):
+                continue
+            if (left, top, right, bottom) == (left_col, top_row, right_col,
+                                              bot_row):
+                return cells
+            found = []
+            for (location, cell) in cells:
+                (col, row) = location_to_coords(location)
+                if left_col <= col <= right_col and top_row <= row <= bot_row:
+                    found.append((location, cell))
+            return found
+        raise ReplicaMiss()
+
+
+class ReplicaWorkbook:
+    '''
+    Stands in for the Workbook while formulas are evaluated in a worker. It
+    has every sheet of the workbook, so references to sheets that do not
+    exist fail the same way, but only the cells sent with the task.
+    '''
+
+    def __init__(self, sheet_data):
+        '''
+        Parameters:
+            sheet_data (dict): maps the lower case name of every sheet to the
+                (values, ranges) of a ReplicaSheet
+        '''
+        self.sheets = {sheet_name: ReplicaSheet(values, ranges)
+                       for (sheet_name, (values, ranges))
+                       in sheet_data.items()}
+
+    def get_cell_value(self, sheet_name, location):
+        if sheet_name.lower() not in self.sheets:
+            raise KeyError("Sheet name not found.")
+        return self.sheets[sheet_name.lower()].get_cell_value(location)
+
+
+def build_task(workbook, cells):
+    '''
+    Collects what a worker needs to evaluate some formula cells: their
+    contents and the values of the cells and ranges they depend on.
+
+    Parameters:
+        workbook (Workbook): the workbook the cells are in
+        cells (list): (sheet name, location) tuples of formula cells
+
+    Returns:
+        tuple: the task to pass to evaluate_cells()
+    '''
+    graph = workbook.graph
+    sheet_data = {sheet_name: ({}, {}) for sheet_name in workbook.sheets}
+    task_cells = []
+    for (sheet_name, location) in cells:
+        task_cells.append((sheet_name, location, workbook.sheets[sheet_name]
+                           .get_cell_contents(location)))
+        for (ref_sheet, ref_location) in graph.precedents(sheet_name,
+                                                          location):
+            if ref_sheet in sheet_data:
+                sheet_data[ref_sheet][0][ref_location] = \
+                    workbook.sheets[ref_sheet].get_cell_value(ref_location)
+        for (range_sheet, cell_range) in graph.range_precedents(sheet_name,
+                                                                location):
+            if (range_sheet in sheet_data and
+                    cell_range not in sheet_data[range_sheet][1]):
+                sheet_data[range_sheet][1][cell_range] = [
+                    (range_location, cell.value) for (range_location, cell)
+                    in workbook.sheets[range_sheet].get_cells_in_range(
+                        *cell_range)]
+    return (decimal.getcontext(), sheet_data, task_cells)
+
+
+def evaluate_cells(task):
+    '''
+    Evaluates the formula cells of a task built by build_task(). This runs in
+    a worker process.
+
+    Returns:
+        list: for each cell, its (value, references) as parse_contents()
+              returns them, or None if it read a cell the task did not hold
+    '''
+    (context, sheet_data, cells) = task
+    workbook = ReplicaWorkbook(sheet_data)
+    results = []
+    with decimal.localcontext(context):
+        for (sheet_name, location, contents) in cells:
+            try:
+                (value, _, refs) = parse_contents(sheet_name, contents,
+                                                  workbook)
+            except ReplicaMiss:
+                results.append(None)
+                continue
+            results.append((value, refs))
+    return results
@@ -0,0 +1,131 @@
+'''
+This file contains the lock that lets many threads read a workbook while one
+thread changes it. Readers share the lock, and a writer holds it alone.
+
+A workbook calls its own public methods while it changes, and the functions
+it notifies can read it, so the thread holding the write lock can take the
+lock again to read or write. Reading can be nested too. A thread that only
+holds the read lock cannot start writing, because two readers doing that
+would wait for each other forever.
+'''
+
+import threading
+
+
+class ReadWriteLock:
+    '''
+    A reader-writer lock that takes turns: once a writer is waiting, no new
+    reader gets the lock, so a stream of readers cannot starve it, and when a
+    writer releases the lock, the readers that were waiting for it go before
+    the next writer, so a stream of writers cannot starve them either. A
+    thread that already reads can read again at any time.
+    '''
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        # the number of read locks held, over all threads
+        self.num_readers = 0
+        # the number of threads waiting for the write lock, and for the read
+        # lock
+        self.writers_waiting = 0
+        self.readers_waiting = 0
+        # how many readers get the lock before the next writer, because they
+        # were waiting when the last writer released it
+        self.readers_admitted = 0
+        # the id of the thread holding the write lock, and how many times it
+        # took it
+        self.writer = None
+        self.write_depth = 0
+        # how many read locks the current thread holds
+        self.local = threading.local()
+
+    def acquire_read(self):
+        '''
+        Takes the lock for reading, waiting while another thread writes.
+        '''
+        if self.writer == threading.get_ident():
+            self.write_depth += 1
+            return
+        depth = getattr(self.local, 'depth', 0)
+        with self.condition:
+            if depth == 0:
+                self.readers_waiting += 1
+                try:
+                    while self.writer is not None or (
+                            self.writers_waiting and
+                            not self.readers_admitted):
+                        self.condition.wait()
+                except BaseException:
+                    # let the writers go if this was the last reader they
+                    # were waiting for
+                    self.readers_waiting -= 1
+                    self.readers_admitted = min(self.readers_admitted,
+                                                self.readers_waiting)
+                    self.condition.notify_all()
+                    raise
+                self.readers_waiting -= 1
+                if self.readers_admitted:
+                    self.readers_admitted -= 1
+                    if not self.readers_admitted:
+                        self.condition.notify_all()
+            self.num_readers += 1
+        self.local.depth = depth + 1
+
+    def release_read(self):
+        '''
+        Releases a lock taken with acquire_read().
+        '''
+        if self.writer == threading.get_ident():
+            self.write_depth -= 1
+            return
+        self.local.depth -= 1
+        with self.condition:
+            self.num_readers -= 1
+            if self.num_readers == 0:
+                self.condition.notify_all()
+
+    def acquire_write(self):
+        '''
+        Takes the lock for writing, waiting until no other thread reads or
+        writes.
+
+        If the current thread holds the lock for reading, a RuntimeError is
+        raised.
+        '''
+        ident = threading.get_ident()
+        if self.writer == ident:
+            self.write_depth += 1
+            return
+        if getattr(self.local, 'depth', 0):
+            raise RuntimeError("Cannot write while reading.")
+        with self.condition:
+            self.writers_waiting += 1
+            try:
+                while (self.writer is not None or self.num_readers or
+                       self.readers_admitted):
+                    self.condition.wait()
+            except BaseException:
+                # let the readers that were held back for this writer go
+                self.writers_waiting -= 1
+                self.condition.notify_all()
+                raise
+            self.writers_waiting -= 1
+            self.writer = ident
+            self.write_depth = 1
+
+    def release_write(self):
+        '''
+        Releases a lock taken with acquire_write().
+        '''
+        self.write_depth -= 1
+        if self.write_depth == 0:
+            with self.condition:
+                self.writer = None
+                self.readers_admitted = self.readers_waiting
+                self.condition.notify_all()
+
+    def is_writing(self):
+        '''
+        Returns whether the current thread holds the lock for writing.
+        '''
+        return self.writer == threading.get_ident()
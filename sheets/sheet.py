@@ -3,10 +3,25 @@ This file contains code that handles basic sheet operations, such as getting
 and setting cell values, getting and setting cell contents, and also getting
 the extent of a sheet.
 '''
-from queue import PriorityQueue
+import heapq
 import re
 import string
 from functools import lru_cache
+from cell import Cell, NO_REFS
+import numeric_columns
+from lark_impl import relocate_formula, rename_formula_sheet, try_compile
+
+
+@lru_cache(maxsize=None)
+def location_to_coords(location):
+    '''
+    Converts a cell location such as "b12" to a (col, row) tuple of numbers.
+    '''
+    col, row = re.match(r"([a-z]+)([1-9][0-9]*)", location, re.I).groups()
+    col_num = 0
+    for letter in col.lower():
+        col_num = col_num * 26 + (ord(letter) - ord('a')) + 1
+    return col_num, int(row)
 
 
 class Sheet:
@@ -18,14 +33,90 @@ class Sheet:
         '''
         Initializes a new empty sheet.
         '''
-        # maps cell location to a dictionary with value and contents keys
+        # maps cell location to its Cell. Cells are replaced rather than
+        # changed, so a copy of the sheet can share them, see copy()
         self.cells = {}
-        self.extent_row = PriorityQueue()
-        self.extent_col = PriorityQueue()
+        # whether self.cells is shared with a copy of the sheet, and has to
+        # be copied before it is changed
+        self.shared = False
+        # the values of the cells column by column, for aggregating ranges of
+        # numbers, or None without NumPy
+        self.numbers = (numeric_columns.NumericColumns()
+                        if numeric_columns.numpy is not None else None)
+
+        # the number of cells with contents in each row and column. Every
+        # row or column in these dictionaries is in its heap exactly once,
+        # negated so the largest is on top; rows and columns whose count
+        # drops to zero are only removed when they reach the top of the heap
+        self.row_counts = {}
+        self.col_counts = {}
+        self.row_heap = []
+        self.col_heap = []
+
+    def copy(self):
+        '''
+        Returns a copy of the sheet. The copy shares its cells with the
+        sheet, and whichever of the two is changed first takes its own copy
+        of the cells then.
+        '''
+        sheet = Sheet()
+        sheet.cells = self.cells
+        sheet.numbers = (self.numbers.copy() if self.numbers is not None
+                         else None)
+        sheet.row_counts = dict(self.row_counts)
+        sheet.col_counts = dict(self.col_counts)
+        sheet.row_heap = list(self.row_heap)
+        sheet.col_heap = list(self.col_heap)
+        self.shared = sheet.shared = True
+        return sheet
+
+    def own_cells(self):
+        '''
+        Stops sharing the cells with a copy of the sheet, before they are
+        changed.
+        '''
+        if self.shared:
+            self.cells = dict(self.cells)
+            self.shared = False
 
     def delete_cell(self, cell_location):
         if cell_location in self.cells:
+            self.own_cells()
+            if self.cells[cell_location].has_contents():
+                self.remove_extent(cell_location)
             del self.cells[cell_location]
+            self.set_number(cell_location, None)
+
+    def set_number(self, cell_location, value):
+        '''
+        Records a cell's new value in the numeric columns, if the sheet keeps
+        them.
+        '''
+        if self.numbers is not None:
+            col, row = location_to_coords(cell_location)
+            self.numbers.set(col, row, value)
+
+    def add_extent(self, cell_location):
+        '''
+        Counts a cell that now has contents towards the extent of the sheet.
+        '''
+        col, row = location_to_coords(cell_location)
+        for (counts, heap, num) in [(self.col_counts, self.col_heap, col),
+                                    (self.row_counts, self.row_heap, row)]:
+            if num in counts:
+                counts[num] += 1
+            else:
+                counts[num] = 1
+                heapq.heappush(heap, -num)
+
+    def remove_extent(self, cell_location):
+        '''
+        Stops counting a cell that no longer has contents towards the extent
+        of the sheet.
+        '''
+        col, row = location_to_coords(cell_location)
+        self.col_counts[col] -= 1
+        self.row_counts[row] -= 1
 
     def num_to_col(self, num):
         res = ''
@@ -43,133 +134,85 @@ class Sheet:
         return num
 
     def set_cell_value(self, cell_location: str, refined_contents: str,
-                       value, tree=None, sheet_name_dict=None, calculated_refs=[]):
+                       value, formula=None, sheet_name_dict=None, refs=None):
         '''
         Sets a cell's value to a specified value.
 
         Parameters:
             cell_location (str): the cell's location
-            refined_contents (str): the cell's contents
+            refined_contents (str): the cell's contents, or None for a
+                relocated formula whose text has not been written out
             value (int, str, or CellErrorType): the cell's value to be set
+            formula (CompiledFormula): the cell's compiled formula, if any
+            sheet_name_dict (dict): sheet names and cells in the formula text
+            refs (list): the references the formula read when evaluated
         '''
         cell_location = cell_location.lower()
         if value is None:
             self.delete_cell(cell_location)
 
-        init_cell_dict = {'contents': refined_contents,
-                          'value': value,
-                          'tree': tree,
-                          'sheet_name_dict': sheet_name_dict,
-                          'calculated_refs':calculated_refs}
-        if cell_location in self.cells:
-            new_cell = False
-        else:
-            new_cell = True
-        self.cells[cell_location] = init_cell_dict
-
-        if new_cell:
-            match = re.match(r"([a-z]+)([1-9][0-9]*)", cell_location, re.I)
-            col, row = match.groups()
-            
-            self.extent_col.put((-self.col_to_num(col.lower()), cell_location))
-            self.extent_row.put((-int(row), cell_location))
-
-    def check_quote_name(self, name):
-        '''
-        Returns true if the quoted name can be unquoted.
-        '''
-        if name[0] == "'":
-            if ((name[1].isalpha() or name[1] == '_') and
-                    (name[1:-1].isalnum() or '_' in name)):
-                return True
-        else:
-            if ((name[0].isalpha() or name[0] == '_') and
-               (name.isalnum() or '_' in name)):
-                return True
-        return False
-
-    def change_contents_sheet_ref(self, workbook, cell_location, old_sheet_name,
+        old_cell = self.cells.get(cell_location)
+        had_contents = old_cell is not None and old_cell.has_contents()
+        cell = Cell(refined_contents, value, formula, sheet_name_dict,
+                    refs if refs is not None else NO_REFS)
+        self.own_cells()
+        self.cells[cell_location] = cell
+        self.set_number(cell_location, value)
+
+        if cell.has_contents() and not had_contents:
+            self.add_extent(cell_location)
+        elif not cell.has_contents() and had_contents:
+            self.remove_extent(cell_location)
+
+    def change_contents_sheet_ref(self, cell_location, old_sheet_name,
                                   new_sheet_name):
         '''
-        Changes the sheet name reference in a given cell to the new sheet name
+        Changes the sheet name reference in a given cell to the new sheet
+        name. The compiled formula is renamed without being parsed again,
+        and the cell keeps its value.
 
         Parameters:
             cell_location: the cells whose contents are updated
-            old_sheet_name: the old sheet name that is replaced
+            old_sheet_name: the lower case old sheet name that is replaced
             new_sheet_name: the new sheet name that replaces the old sheet name
         '''
-        temp_contents = self.cells[cell_location.lower()]['contents']
-        sheet_name_dict = self.cells[cell_location.lower()]['sheet_name_dict']
-        # go through quoted sheet names
-        for quoted_name in sheet_name_dict['QUOTED_SHEET_NAMES'].copy():
-            if quoted_name[1:-1].lower() == old_sheet_name.lower():
-                sheet_name_dict['QUOTED_SHEET_NAMES'].remove(quoted_name)
-                if self.check_quote_name(new_sheet_name) is True:
-                    temp_contents = temp_contents.replace(
-                        quoted_name, new_sheet_name)
-                    sheet_name_dict['SHEET_NAMES'].append(new_sheet_name)
-                else:
-                    temp_contents = temp_contents.replace(
-                        quoted_name, f"'{new_sheet_name}'")
-                    sheet_name_dict['QUOTED_SHEET_NAMES'].append(
-                        f"'{new_sheet_name}'")
-            elif self.check_quote_name(quoted_name) is True:
-                temp_contents = temp_contents.replace(
-                    quoted_name, quoted_name[1:-1])
-
-        for name in sheet_name_dict['SHEET_NAMES']:
-            if name.lower() == old_sheet_name.lower():
-                sheet_name_dict['SHEET_NAMES'].remove(name)
-                if self.check_quote_name(new_sheet_name) is True:
-                    temp_contents = temp_contents.replace(name, new_sheet_name)
-                    sheet_name_dict['SHEET_NAMES'].append(new_sheet_name)
-                else:
-                    temp_contents = temp_contents.replace(
-                        name, f"'{new_sheet_name}'")
-                    sheet_name_dict['QUOTED_SHEET_NAMES'].append(
-                        f"'{new_sheet_name}'")
-        self.cells[cell_location.lower()]['contents'] = temp_contents
-        #self.cells[cell_location.lower()]['tree'] = None
-    
-    def update_cell_references(self, workbook, cell_dict, letter_move, number_move):
-        if cell_dict is None:
-            return None
-
-        contents = cell_dict['contents']
-        sheet_name_dict = cell_dict['sheet_name_dict']
-        if sheet_name_dict is None:
-            return contents
-        contents = contents.lower()
-        
-        for (cell, sheet_name) in sheet_name_dict['CELLS']:
-            cell= cell.lower()
-            letters, numbers = re.match(r"(\$?[a-z]+)(\$?[1-9][0-9]*)$", cell, re.I).groups()
-            if letters[0] != '$':
-                letters_num = workbook.col_to_num(letters)
-                letters_num += letter_move
-                if letters_num < workbook.col_to_num('a') or letters_num > workbook.col_to_num('zzzz'):
-                    #print(letters_num)
-                    letters = '#REF!'
-                else:
-                    letters = workbook.num_to_col(letters_num)
-            if numbers[0] != '$':
-                numbers = int(numbers)
-                numbers += number_move
-                if numbers < 1 or numbers > 9999:
-                    #print('num' + numbers)
-                    numbers = '#REF!'
-
-            if numbers == '#REF!' or letters == '#REF!':
-                new_cell = '#REF!'
-                if sheet_name is None:
-                    contents = contents.replace(cell, '#REF!')
-                else:
-                    contents = contents.replace(f'{sheet_name.lower()}!{cell}', '#REF!')
-            else:
-                new_cell = letters + str(numbers)
-                contents = contents.replace(cell, new_cell.upper())
+        cell_location = cell_location.lower()
+        cell = self.cells[cell_location]
+        formula = cell.formula
+        if formula is None:
+            # cells opened from a binary workbook have not compiled their
+            # formula yet
+            formula = try_compile(cell.contents)
+            if formula is None:
+                return
+        formula = rename_formula_sheet(formula, old_sheet_name, new_sheet_name)
+        new_sheet_name = new_sheet_name.lower()
+        refs = [(new_sheet_name,) + ref[1:] if ref[0] == old_sheet_name
+                else ref for ref in cell.refs]
+        self.own_cells()
+        self.cells[cell_location] = Cell(None, cell.value, formula,
+                                         formula.sheet_name_dict, refs)
 
-        return contents
+    def update_cell_references(self, cell, letter_move, number_move):
+        '''
+        Finds the contents a cell has after being moved or copied by the
+        given numbers of columns and rows.
+
+        Returns:
+            tuple: (contents, compiled formula). For a formula the contents
+            are None; the references are shifted in the compiled formula,
+            which writes out its text when the contents are asked for.
+        '''
+        if cell is None:
+            return None, None
+        formula = cell.formula
+        if formula is None and cell.sheet_name_dict is not None:
+            # cells opened from a binary workbook have not compiled their
+            # formula yet
+            formula = try_compile(cell.contents)
+        if formula is None:
+            return cell.contents, None
+        return None, relocate_formula(formula, letter_move, number_move)
 
     def get_cell_contents(self, cell_location: str):
         '''
@@ -183,7 +226,7 @@ class Sheet:
             else None if the specified cell location is not found.
         '''
         if cell_location.lower() in self.cells:
-            return self.cells[cell_location.lower()]['contents']
+            return self.cells[cell_location.lower()].contents
         
         return None
 
@@ -199,16 +242,49 @@ class Sheet:
             else None if the specified cell location is not found.
         '''
         if cell_location.lower() in self.cells:
-            return self.cells[cell_location.lower()]['value']
+            return self.cells[cell_location.lower()].value
         return None
         
-    def get_cell_tree(self, cell_location:str):
+    def get_cells_in_range(self, left_col, top_row, right_col, bot_row):
         '''
-        Gets the parse tree of a given cell
+        Gets the non-empty cells inside a rectangular region, in row-major
+        order, without creating anything for the empty cells.
+
+        Small regions are walked location by location; regions larger than
+        the sheet itself are found by scanning the occupied cells instead.
+
+        Returns:
+            list: (location, Cell) tuples
+        '''
+        area = (right_col - left_col + 1) * (bot_row - top_row + 1)
+        found = []
+        if area <= len(self.cells):
+            cols = [self.num_to_col(col) for col in range(left_col,
+                                                          right_col + 1)]
+            for row in range(top_row, bot_row + 1):
+                for col in cols:
+                    location = col + str(row)
+                    cell = self.cells.get(location)
+                    if cell is not None and cell.value is not None:
+                        found.append((location, cell))
+            return found
+
+        for (location, cell) in self.cells.items():
+            if cell.value is None:
+                continue
+            col, row = location_to_coords(location)
+            if left_col <= col <= right_col and top_row <= row <= bot_row:
+                found.append(((row, col), location, cell))
+        found.sort(key=lambda item: item[0])
+        return [(location, cell) for (_, location, cell) in found]
+
+    def get_cell_formula(self, cell_location:str):
+        '''
+        Gets the compiled formula of a given cell
         '''
         
         if cell_location.lower() in self.cells:
-            return self.cells[cell_location.lower()]['tree']
+            return self.cells[cell_location.lower()].formula
         return None
     
     def get_cell_sheet_name_dict(self, cell_location:str):
@@ -217,7 +293,7 @@ class Sheet:
         '''
         
         if cell_location.lower() in self.cells:
-            return self.cells[cell_location.lower()]['sheet_name_dict']
+            return self.cells[cell_location.lower()].sheet_name_dict
         return None
     
     # def get_inherit_cells(self, cell_location:str):
@@ -238,23 +314,10 @@ class Sheet:
         Returns:
             tuple: the size of the sheet in the form (row, col)
         '''
-        return_row = 0
-        return_col = 0
-
-        while not self.extent_row.empty():
-            temp_row, temp_cell = self.extent_row.queue[0]
-            if (temp_cell in self.cells and self.cells[temp_cell]['contents']
-               is not None):
-                return_row = -temp_row
-                break
-            self.extent_row.get()
-
-        while not self.extent_col.empty():
-            temp_col, temp_cell = self.extent_col.queue[0]
-            if (temp_cell in self.cells and
-               self.cells[temp_cell]['contents'] is not None):
-                return_col = -temp_col
-                break
-            self.extent_col.get()
-
+        for (counts, heap) in [(self.col_counts, self.col_heap),
+                               (self.row_counts, self.row_heap)]:
+            while heap and counts[-heap[0]] == 0:
+                del counts[-heapq.heappop(heap)]
+        return_col = -self.col_heap[0] if self.col_heap else 0
+        return_row = -self.row_heap[0] if self.row_heap else 0
         return return_col, return_row
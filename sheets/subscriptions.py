@@ -0,0 +1,114 @@
+'''
+This file contains the scopes of a workbook's notify functions. A notify
+function can watch the whole workbook, one sheet, or one range of cells on a
+sheet, see Workbook.notify_cells_changed(). The ranges are kept in the same
+kind of spatial index as the ranges formulas depend on, so finding who
+watches a cell only checks the ranges near it.
+
+Recalculation asks watches() about every cell whose value changed, and only
+collects the cells that something watches. When nothing watches a sheet, the
+changes to it are not collected at all.
+'''
+
+from dependency_graph import RangeIndex
+
+
+class Subscriptions:
+    '''
+    The scopes of the notify functions registered on a workbook, indexed by
+    the order the functions were registered. Sheet names are lower case.
+    '''
+
+    def __init__(self):
+        # the scope of each notify function: None for the whole workbook, or
+        # a (sheet name, range) tuple where the range is None for the whole
+        # sheet or a (left, top, right, bottom) tuple
+        self.scopes = []
+        # the notify functions that watch the whole workbook
+        self.workbook_wide = set()
+        # maps sheet names to the notify functions watching the whole sheet
+        self.sheet_wide = {}
+        # maps sheet names to the RangeIndex of the ranges watched on them
+        self.ranges = {}
+
+    def add(self, scope):
+        '''
+        Adds the scope of the next notify function.
+
+        Parameters:
+            scope (tuple): see self.scopes
+        '''
+        index = len(self.scopes)
+        self.scopes.append(scope)
+        if scope is None:
+            self.workbook_wide.add(index)
+            return
+        (sheet_name, cell_range) = scope
+        if cell_range is None:
+            self.sheet_wide.setdefault(sheet_name, set()).add(index)
+        else:
+            if sheet_name not in self.ranges:
+                self.ranges[sheet_name] = RangeIndex()
+            self.ranges[sheet_name].add(cell_range, index)
+
+    def watches(self, sheet_name, location):
+        '''
+        Returns whether any notify function watches a cell.
+
+        Parameters:
+            sheet_name (str): the lower case name of a sheet
+            location (str): the location of a cell
+        '''
+        if self.workbook_wide or sheet_name in self.sheet_wide:
+            return True
+        if sheet_name in self.ranges:
+            return bool(self.ranges[sheet_name].find(location))
+        return False
+
+    def is_scoped(self):
+        '''
+        Returns whether any notify function watches less than the whole
+        workbook.
+        '''
+        return len(self.workbook_wide) < len(self.scopes)
+
+    def split(self, cells):
+        '''
+        Divides changed cells between the notify functions that watch them.
+
+        Parameters:
+            cells (iterable): (sheet name, location) tuples in any case
+
+        Returns:
+            list: for each notify function, the set of the cells it watches
+        '''
+        found = [set() for _ in self.scopes]
+        for cell in cells:
+            sheet_name = cell[0].lower()
+            watching = set(self.workbook_wide)
+            watching.update(self.sheet_wide.get(sheet_name, ()))
+            if sheet_name in self.ranges:
+                for indices in self.ranges[sheet_name].find(cell[1]):
+                    watching.update(indices)
+            for index in watching:
+                found[index].add(cell)
+        return found
+
+    def rename_sheet(self, sheet_name, new_sheet_name):
+        '''
+        Moves the scopes on a sheet to its new name.
+        '''
+        if sheet_name in self.sheet_wide:
+            self.sheet_wide.setdefault(new_sheet_name, set()).update(
+                self.sheet_wide.pop(sheet_name))
+        if sheet_name in self.ranges:
+            ranges = self.ranges.pop(sheet_name)
+            if new_sheet_name not in self.ranges:
+                self.ranges[new_sheet_name] = ranges
+            else:
+                for (cell_range, indices) in ranges.dependents.items():
+                    for index in indices:
+                        self.ranges[new_sheet_name].add(cell_range, index)
+        self.scopes = [(new_sheet_name, scope[1])
+                       if scope is not None and scope[0] == sheet_name
+                       else scope for scope in self.scopes]
@@ -0,0 +1,454 @@
+'''
+This file contains code that keeps the cells of a dependency graph in
+topological order, and keeps track of which cells are in cycles, as formulas
+change. Each change to a formula's dependencies only searches the part of the
+graph between the cells whose order it affects, instead of searching
+everything downstream of the cell on every edit.
+
+The order is kept with the Pearce-Kelly dynamic topological sort, extended
+so that an edge closing a cycle merges the cells on the cycle into a single
+node, and removing an edge from a cycle splits that node again.
+'''
+
+# the order key of cells that do not depend on anything, which come first
+SOURCE_KEY = float('-inf')
+
+# the space left between keys given out at either end of the order, so that
+# most new cells can be given a key between their precedents and dependents
+# without moving any other cells
+KEY_GAP = 1 << 16
+
+
+def depth_first_order(roots, successors):
+    '''
+    Iterative depth first search.
+
+    Parameters:
+        roots (iterable): the cells to search from, in order
+        successors (function): takes a cell and returns the cells it points to
+
+    Returns:
+        list: every cell reachable from the roots, in the order the search
+              finished with them. Unless they are in a cycle, each cell comes
+              after every cell it points to.
+    '''
+    seen = set()
+    postorder = []
+    for root in roots:
+        if root in seen:
+            continue
+        seen.add(root)
+        work = [(root, iter(successors(root)))]
+        while work:
+            for u in work[-1][1]:
+                if u not in seen:
+                    seen.add(u)
+                    work.append((u, iter(successors(u))))
+                    break
+            else:
+                postorder.append(work.pop()[0])
+    return postorder
+
+
+def strongly_connected(roots, successors):
+    '''
+    Iterative form of Tarjan's algorithm.
+
+    Parameters:
+        roots (iterable): the cells to search from
+        successors (function): takes a cell and returns the cells it points to
+
+    Returns:
+        list: the strongly connected components reachable from the roots, as
+              lists of cells, in reverse topological order
+    '''
+    index = {}
+    low = {}
+    scc_stack = []
+    on_stack = set()
+    components = []
+    for root in roots:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        scc_stack.append(root)
+        on_stack.add(root)
+        # each entry is a cell and an iterator over the cells it points to
+        # that have not been looked at yet
+        work = [(root, iter(successors(root)))]
+        while work:
+            v, children = work[-1]
+            for u in children:
+                if u not in index:
+                    index[u] = low[u] = len(index)
+                    scc_stack.append(u)
+                    on_stack.add(u)
+                    work.append((u, iter(successors(u))))
+                    break
+                if u in on_stack:
+                    low[v] = min(low[v], index[u])
+            else:  # Leaving the node
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[v])
+                if low[v] == index[v]:
+                    component = []
+                    while True:
+                        u = scc_stack.pop()
+                        on_stack.discard(u)
+                        component.append(u)
+                        if u == v:
+                            break
+                    components.append(component)
+    return components
+
+
+class TopologicalOrder:
+    '''
+    A topological order of the cells of a DependencyGraph that depend on
+    something. Cells that do not depend on anything have no key, and come
+    before every other cell.
+
+    The order is over nodes: a node is either one cell, or a frozenset of the
+    cells of a cycle. Each node has an integer key, and for every edge from a
+    cell to a cell that depends on it, the first cell's node has a smaller key
+    unless both are in the same node. Keys are not consecutive, and nodes are
+    only moved when a new node or edge does not fit between the keys that are
+    already there.
+    '''
+
+    def __init__(self, graph):
+        '''
+        Parameters:
+            graph (DependencyGraph): the graph to keep the order of
+        '''
+        self.graph = graph
+        # maps each node to its key, and the set of keys in use
+        self.keys = {}
+        self.used_keys = set()
+        # maps each cell in a cycle of more than one cell to its node
+        self.cycles = {}
+        # the cells that depend on themselves
+        self.self_loops = set()
+        # the smallest and largest keys given out so far
+        self.low = 0
+        self.high = 0
+        # while suspended the graph does not update the order, see
+        # DependencyGraph.bulk_update()
+        self.suspended = False
+
+    def node(self, cell):
+        '''
+        Returns the node a cell belongs to.
+        '''
+        return self.cycles.get(cell, cell)
+
+    def key(self, cell):
+        '''
+        Returns the order key of a cell. Sorting cells by key puts every cell
+        after the cells it depends on, except for cells in the same cycle,
+        which share a key.
+        '''
+        return self.keys.get(self.cycles.get(cell, cell), SOURCE_KEY)
+
+    def is_cyclic(self, cell):
+        '''
+        Returns whether a cell is part of a cycle, including a cell that
+        depends on itself.
+        '''
+        return cell in self.cycles or cell in self.self_loops
+
+    @staticmethod
+    def node_cells(node):
+        '''
+        Returns the cells of a node.
+        '''
+        return node if isinstance(node, frozenset) else (node,)
+
+    def successors(self, node):
+        '''
+        Returns a list of the nodes with a cell that depends on a cell of
+        node, which may include node itself and repeats.
+        '''
+        cycles = self.cycles
+        return [cycles.get(dependent, dependent)
+                for cell in self.node_cells(node)
+                for dependent in self.graph.dependents(*cell)]
+
+    def predecessors(self, node):
+        '''
+        Returns a list of the nodes with a cell that a cell of node depends
+        on, which may include node itself and repeats.
+        '''
+        cycles = self.cycles
+        return [cycles.get(precedent, precedent)
+                for cell in self.node_cells(node)
+                for precedent in self.graph.ordered_precedents(*cell)]
+
+    def rebuild(self):
+        '''
+        Computes the order and the cycles of the whole graph from scratch.
+        '''
+        self.keys = {}
+        self.cycles = {}
+        graph = self.graph
+        cells = graph.cells_with_precedents()
+        self.self_loops = {cell for cell in cells
+                           if graph.depends_on_itself(*cell)}
+        components = strongly_connected(
+            cells, lambda cell: graph.dependents(*cell))
+        self.low = 0
+        self.high = len(components) * KEY_GAP
+        for (i, component) in enumerate(components):
+            if len(component) == 1:
+                node = component[0]
+            else:
+                node = frozenset(component)
+                for cell in node:
+                    self.cycles[cell] = node
+            self.keys[node] = self.high - i * KEY_GAP
+        self.used_keys = set(self.keys.values())
+
+    def append(self, cells):
+        '''
+        Gives keys to cells that have just started depending on something,
+        such as the cells of a copied sheet, after every other cell. Only
+        the edges between the new cells are searched, so nothing that was
+        in the order before may depend on them.
+
+        Parameters:
+            cells (iterable): the new cells that depend on something
+        '''
+        cells = set(cells)
+        graph = self.graph
+        self.self_loops.update(cell for cell in cells
+                               if graph.depends_on_itself(*cell))
+        components = strongly_connected(
+            cells, lambda cell: [dependent for dependent
+                                 in graph.dependents(*cell)
+                                 if dependent in cells])
+        for component in reversed(components):
+            if len(component) == 1:
+                node = component[0]
+            else:
+                node = frozenset(component)
+                for cell in node:
+                    self.cycles[cell] = node
+            self.high += KEY_GAP
+            self.keys[node] = self.high
+            self.used_keys.add(self.high)
+
+    def restore(self, keys, self_loops):
+        '''
+        Uses keys saved from another TopologicalOrder of the same graph,
+        instead of computing them.
+
+        Parameters:
+            keys (dict): maps each node to its key
+            self_loops (set): the cells that depend on themselves
+        '''
+        self.keys = keys
+        self.used_keys = set(keys.values())
+        self.cycles = {cell: node for node in keys
+                       if isinstance(node, frozenset) for cell in node}
+        self.self_loops = self_loops
+        self.low = min(self.used_keys, default=0)
+        self.high = max(self.used_keys, default=0)
+
+    def rename_cells(self, cells, renamed):
+        '''
+        Gives cells new names without moving them in the order, for when a
+        sheet is renamed and the edges between the cells stay the same.
+
+        Parameters:
+            cells (iterable): the cells to rename that have precedents
+            renamed (function): takes a cell and returns its new name
+        '''
+        nodes = {self.node(cell) for cell in cells}
+        for node in nodes:
+            if node not in self.keys:
+                continue
+            key = self.keys.pop(node)
+            if isinstance(node, frozenset):
+                new_node = frozenset(renamed(cell) for cell in node)
+                for cell in node:
+                    del self.cycles[cell]
+                for cell in new_node:
+                    self.cycles[cell] = new_node
+            else:
+                new_node = renamed(node)
+            self.keys[new_node] = key
+        for cell in [cell for cell in self.self_loops if renamed(cell) != cell]:
+            self.self_loops.discard(cell)
+            self.self_loops.add(renamed(cell))
+
+    def precedents_removed(self, cell):
+        '''
+        Updates the order after some of the precedents of a cell were removed.
+        The graph must already be without them.
+
+        Parameters:
+            cell (tuple): the (sheet name, location) that lost precedents
+        '''
+        if cell in self.self_loops and not self.graph.depends_on_itself(*cell):
+            self.self_loops.discard(cell)
+        node = self.node(cell)
+        if node not in self.keys:
+            return
+        if isinstance(node, frozenset):
+            self.split(node)
+        elif not self.graph.has_precedents(*cell):
+            self.used_keys.discard(self.keys.pop(node))
+
+    def precedents_added(self, cell, added):
+        '''
+        Updates the order after a cell got new precedents. The graph must
+        already hold them.
+
+        Parameters:
+            cell (tuple): the (sheet name, location) that got new precedents
+            added (list): the new precedents that have precedents themselves
+        '''
+        if cell in added:
+            self.self_loops.add(cell)
+        if self.node(cell) not in self.keys:
+            self.add_node(cell)
+            return
+        for precedent in added:
+            self.add_edge(precedent, cell)
+
+    def add_node(self, cell):
+        '''
+        Gives a key to a cell that has just started depending on something.
+        The key is put between the keys of its precedents and dependents if
+        there is room, and otherwise it goes after everything and the cells
+        that depend on it are moved after it.
+        '''
+        after = max((self.key(precedent) for precedent
+                     in self.graph.ordered_precedents(*cell)
+                     if precedent != cell), default=None)
+        dependents = [dependent for dependent in self.graph.dependents(*cell)
+                      if dependent != cell]
+        before = min((self.key(dependent) for dependent in dependents),
+                     default=None)
+        if after is None:
+            self.low -= KEY_GAP
+            key = self.low
+        elif (before is not None and before - after >= 2 and
+              (after + before) // 2 not in self.used_keys):
+            key = (after + before) // 2
+        else:
+            self.high += KEY_GAP
+            key = self.high
+        self.keys[cell] = key
+        self.used_keys.add(key)
+        if before is not None and key > before:
+            for dependent in dependents:
+                self.add_edge(cell, dependent)
+
+    def add_edge(self, precedent, dependent):
+        '''
+        Restores the order after dependent started depending on precedent,
+        merging the nodes of any cycle that the new edge closes.
+        '''
+        x = self.node(precedent)
+        y = self.node(dependent)
+        if x == y or self.keys[x] < self.keys[y]:
+            return
+        lower = self.keys[y]
+        upper = self.keys[x]
+
+        # the nodes between y and x that y reaches, and that reach x
+        forward = self.search(y, self.successors, x,
+                              lambda key: key < upper)
+        backward = self.search(x, self.predecessors, y,
+                               lambda key: key > lower)
+        pool = sorted(self.keys[n] for n in forward.keys() | backward.keys())
+        if x not in forward:
+            nodes = (sorted(backward, key=self.keys.get) +
+                     sorted(forward, key=self.keys.get))
+            for (n, key) in zip(nodes, pool):
+                self.keys[n] = key
+            return
+
+        # the new edge closes a cycle through every node on a path from y
+        # to x, and these nodes become one node
+        members = forward.keys() & backward.keys()
+        before = sorted((n for n in backward if n not in members),
+                        key=self.keys.get)
+        after = sorted((n for n in forward if n not in members),
+                       key=self.keys.get)
+        for n in members:
+            del self.keys[n]
+        # the members only need one key between them
+        self.used_keys.difference_update(pool[len(before) + 1:
+                                              len(pool) - len(after)])
+        cycle = frozenset(cell for n in members for cell in self.node_cells(n))
+        for cell in cycle:
+            self.cycles[cell] = cycle
+        for (n, key) in zip(before, pool):
+            self.keys[n] = key
+        self.keys[cycle] = pool[len(before)]
+        for (n, key) in zip(after, pool[len(pool) - len(after):]):
+            self.keys[n] = key
+
+    def search(self, start, neighbors, target, in_bounds):
+        '''
+        Helper method that finds the nodes reachable from start through nodes
+        whose keys are in bounds. The target is included if it is reached,
+        but not searched past.
+
+        Returns:
+            dict: the nodes found, in the order they were found
+        '''
+        found = {start: None}
+        stack = [start]
+        while stack:
+            for n in neighbors(stack.pop()):
+                if n in found:
+                    continue
+                if n == target:
+                    found[n] = None
+                elif in_bounds(self.keys[n]):
+                    found[n] = None
+                    stack.append(n)
+        return found
+
+    def split(self, node):
+        '''
+        Splits a cycle node after one of the edges between its cells was
+        removed, into the cycles and single cells that remain.
+        '''
+        key = self.keys.pop(node)
+        self.used_keys.discard(key)
+        for cell in node:
+            del self.cycles[cell]
+        components = strongly_connected(
+            node, lambda cell: [dependent for dependent
+                                in self.graph.dependents(*cell)
+                                if dependent in node])
+        new_nodes = []
+        for component in reversed(components):
+            if len(component) > 1:
+                new_node = frozenset(component)
+                for cell in new_node:
+                    self.cycles[cell] = new_node
+            elif self.graph.has_precedents(*component[0]):
+                new_node = component[0]
+            else:
+                continue
+            # the first node can keep the key of the whole cycle, and the
+            # rest go after everything in the order they depend on each other
+            if new_nodes:
+                self.high += KEY_GAP
+                key = self.high
+            self.keys[new_node] = key
+            self.used_keys.add(key)
+            new_nodes.append(new_node)
+
+        # the cells that depend on the moved nodes are moved after them
+        for new_node in new_nodes[1:]:
+            for cell in self.node_cells(new_node):
+                for dependent in list(self.graph.dependents(*cell)):
+                    self.add_edge(cell, dependent)
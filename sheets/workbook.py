@@ -5,55 +5,173 @@ sheets, populating cells, and calculating formulas). Currently, the engine
 handles both string and integers in the cells.
 '''
 
-from typing import List, Optional, Tuple, TextIO, Any
+from typing import List, Optional, Tuple, TextIO, BinaryIO, Any
 import re
+import heapq
 import decimal
 import json
 import string
-import lark
-from lark_impl import parse_contents
-from row import Row
-from lark import Token
-from functools import lru_cache, cmp_to_key
-from copy import deepcopy
-
-from sheet import Sheet
+from lark_impl import (parse_contents, evaluate_formula, get_parser,
+                       formula_refs, try_compile)
+from json_stream import iter_json_sheets, write_json_sheets
+import binary_format
+from functools import lru_cache, wraps
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+from sheet import Sheet, location_to_coords
+from cell import Cell
+from dependency_graph import DependencyGraph
+from read_write_lock import ReadWriteLock
+from notify_dispatcher import NotifyDispatcher
+from subscriptions import Subscriptions
+from parallel_recalc import MIN_PARALLEL_CELLS, build_task, evaluate_cells
+from topological_order import depth_first_order
 from cellerror import CellErrorType, CellError
 
 
+def eager(method):
+    '''
+    Decorator for workbook operations that always evaluate eagerly. In lazy
+    mode the workbook is flushed first, and lazy evaluation is switched off
+    until the operation returns.
+    '''
+    @wraps(method)
+    def eager_method(self, *args, **kwargs):
+        if not self.lazy:
+            return method(self, *args, **kwargs)
+        self.flush()
+        self.lazy = False
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.lazy = True
+    return eager_method
+
+
+def reader(method):
+    '''
+    Decorator for workbook operations that only read the workbook. They hold
+    the workbook's lock for reading, so many threads can run them at once,
+    but not while another thread changes the workbook.
+    '''
+    @wraps(method)
+    def reader_method(self, *args, **kwargs):
+        self.lock.acquire_read()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.lock.release_read()
+    return reader_method
+
+
+def writer(method):
+    '''
+    Decorator for workbook operations that change the workbook. They hold the
+    workbook's lock for writing, so no other thread reads or changes the
+    workbook until they return. Once the lock is released, the notify
+    dispatcher can hold the operation back, see set_notify_dispatcher().
+    '''
+    @wraps(method)
+    def writer_method(self, *args, **kwargs):
+        self.lock.acquire_write()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.lock.release_write()
+            if (self.notify_dispatcher is not None and
+                    not self.lock.is_writing()):
+                self.notify_dispatcher.wait_for_room()
+    return writer_method
+
+
+# stands in for the empty cells of a region being sorted
+EMPTY_CELL = Cell(None, None)
+
+
+def sort_key(value):
+    '''
+    Returns a key for sorting a cell value, so that values sort with native
+    tuple comparisons: empty cells first, then errors by type, numbers,
+    strings ignoring case, and booleans last.
+    '''
+    if value is None:
+        return (0,)
+    if isinstance(value, CellError):
+        return (1, value.get_type().value)
+    if isinstance(value, bool):
+        return (4, value)
+    if isinstance(value, str):
+        return (3, value.lower())
+    return (2, value)
+
+
 class Workbook:
     '''
     A workbook containing zero or more named spreadsheets.
 
     Any and all operations on a workbook that may affect calculated cell
     values should cause the workbook's contents to be updated properly.
+
+    A workbook can be shared between threads. Any number of threads can read
+    cell values and contents at once, while an operation that changes the
+    workbook runs alone, so readers only see the workbook as it is between
+    operations.
     '''
 
-    def __init__(self):
+    def __init__(self, lazy: bool = False):
         '''
         Initialize a new empty workbook.
+
+        Parameters:
+            lazy (bool): whether cells are evaluated lazily, see set_lazy()
         '''
-        self.parser = lark.Lark.open('sheets/formulas.lark', start='formula')
+        self.parser = get_parser()
         self.cell_parser = re.compile(r'([a-z]+)([1-9][0-9]*)', re.I)
-        self.parsed_trees = {}
         # dictionary of sheets mapping name to Sheet object
         self.sheets = {}
 
         # maps lower case names to case-sensitive name
         self.sheet_names = {}
 
-        # maps cell to cells that depend on it
-        self.forward_graph = {}
-
-        # maps cell to cells that it depends on
-        self.backward_graph = {}
+        # the cells that each cell depends on, and that depend on it
+        self.graph = DependencyGraph()
 
         # maps sheet that does not exist to all cells that are referenced from
         # other sheets in that sheet
         self.notify_functions = []
+        # the parts of the workbook each notify function watches
+        self.subscriptions = Subscriptions()
         self.test_notify_cells = {}
         self.notify_cells_master = set()
-
+        # sends notifications in the background, see set_notify_dispatcher()
+        self.notify_dispatcher = None
+
+        # number of open batch() blocks, and the cells set inside them mapped
+        # to their values from before the batch
+        self.batch_depth = 0
+        self.batch_cells = {}
+
+        # in lazy mode, the cells that need to be evaluated before they are
+        # read, mapped to whether their precedents are still every reference
+        # their formula may read rather than the ones it read when evaluated;
+        # the cells changed since the last flush() mapped to their values
+        # before that; and whether dirty cells are being evaluated
+        self.lazy = lazy
+        self.dirty_cells = {}
+        self.lazy_changed = {}
+        self.evaluating_dirty = False
+
+        # the pool of worker processes for parallel recalculation, and how
+        # many cells a recalculation needs to use it, see set_workers()
+        self.num_workers = 0
+        self.pool = None
+        self.parallel_min_cells = MIN_PARALLEL_CELLS
+
+        # lets many threads read the workbook while one thread changes it
+        self.lock = ReadWriteLock()
+
+    @reader
     def num_sheets(self) -> int:
         '''
         Gets the number of sheets in a workbook.
@@ -63,6 +181,7 @@ class Workbook:
         '''
         return len(self.sheets.keys())
 
+    @reader
     def list_sheets(self) -> List[str]:
         '''
         Return a list of the spreadsheet names in the workbook, with the
@@ -122,6 +241,8 @@ class Workbook:
                 return f'Sheet{counter}'
             counter += 1
 
+    @writer
+    @eager
     def new_sheet(self, sheet_name: Optional[str] = None, is_copy=False) -> Tuple[int, str]:
         '''
         Adds a new sheet to the workbook.
@@ -145,12 +266,12 @@ class Workbook:
             raise ValueError("Invalid spreadsheet name.")
 
         if not is_copy:
-            if sheet_name.lower() in self.forward_graph:
-                for cell in self.forward_graph[sheet_name.lower()]:
-                    self.update_workbook(sheet_name.lower(), cell)
+            self.update_sheet_dependents(sheet_name.lower())
 
         return (len(self.sheets.keys()) - 1, sheet_name)
 
+    @writer
+    @eager
     def del_sheet(self, sheet_name: str) -> None:
         '''
         Delete the spreadsheet with the specified name.
@@ -166,19 +287,17 @@ class Workbook:
         # first we need to handle all refereneces in and out of the sheet
         sheet_name = sheet_name.lower()
         if sheet_name in self.sheets:
-            update_cell = []
-            if sheet_name in self.forward_graph:
-                for cell_key in self.forward_graph[sheet_name].keys():
-                    for cell in self.forward_graph[sheet_name][cell_key]:
-                        update_cell.append(cell)
+            update_cell = self.graph.sheet_dependents(sheet_name)
 
             del self.sheets[sheet_name]
             del self.sheet_names[sheet_name]
+            self.graph.remove_sheet(sheet_name)
             for v in update_cell:
                 self.update_workbook(v[0], v[1])
         else:
             raise KeyError("Sheet name not found.")
 
+    @reader
     def get_sheet_extent(self, sheet_name: str) -> Tuple[int, int]:
         '''
         Return a tuple (num-cols, num-rows) indicating the current extent of
@@ -197,79 +316,55 @@ class Workbook:
 
         return self.sheets[sheet_name.lower()].get_extent()
 
-    def tarjan_iter(self, sheet_name, location, graph):
+    def mark_cycle_cells(self, cells):
         '''
-        Helper method that implements an iterative form of Tarjan's algorithm.
+        Helper method that sets the value of every given cell in a cycle to a
+        circular reference error.
 
         Parameters:
-            sheet_name (str): the name of a sheet
-            location (str): the location of a cell
+            cells (iterable): the cells as (sheet name, location) tuples
 
         Returns:
-            (list, list): a tuple of a list of cycles and a list of
-                          dependencies
-        '''
-        #print(graph)
-        stack = [(sheet_name, location)]
-        on_stack = {(sheet_name, location): None}
-        visited = {}
-        #backtrack = {}
-        topo_sort = []
-        sccs = []
-        disc_time = {}
-        low = {}
-        stack_cpy = [(sheet_name, location)]
-        while stack:
-            #print(stack)
-            #print(low)
-            v = stack[-1]
-            #
-            if v not in visited:
-                visited[v] = None
-                disc_time[v] = len(stack) - 1
-                low[v] = len(stack) - 1
-                if (v[0] in graph and
-                   v[1] in graph[v[0]]):
-                    for u in graph[v[0]][v[1]]:
-                        if u not in visited:
-                            stack.append(u)
-                            on_stack[u] = None
-                            stack_cpy.append(u)
-                        elif u in on_stack:
-                            low[v] = min(low[v], low[u])
-            else:  # Leaving the node
-                if (v[0] in graph and
-                   v[1] in graph[v[0]]):
-                    for u in graph[v[0]][v[1]]:
-                        low[v] = min(low[v], low[u])
-                if low[v] == disc_time[v]:
-                    temp = -1
-                    scc = []
-                    while temp != v:
-                        temp = stack_cpy.pop()
-                        scc.append(temp)
-                    sccs.append(scc)
-                
-
-                k = stack.pop()
-                if k in on_stack:
-                    del on_stack[k]
-                topo_sort.append(k)
-            cycles = []
-            for i in sccs:
-                if len(i) > 1:
-                    cycles.append(i)
-        return (cycles, topo_sort[::-1])
+            set: the cells that were marked
+        '''
+        cycle_cells = set()
+        for v in cells:
+            if not self.graph.order.is_cyclic(v) or v[0] not in self.sheet_names:
+                continue
+            detail = 'Cell is part of circular reference.'
+            value = self.sheets[v[0]].get_cell_value(v[1])
+            if not (isinstance(value, CellError) and value.get_type() == CellErrorType.BAD_NAME):
+                cell = self.sheets[v[0]].cells.get(v[1], EMPTY_CELL)
+                cycle_cells.add(v)
+                circ_ref = CellError(CellErrorType.CIRCULAR_REFERENCE, detail)
+                self.sheets[v[0].lower()].set_cell_value(
+                    v[1], cell.text, circ_ref, cell.formula,
+                    cell.sheet_name_dict, cell.refs)
+        return cycle_cells
 
     def update_notify_cells_master(self, notify_cells):
+        watches = self.subscriptions.watches
         for cell in notify_cells:
-            if cell not in self.notify_cells_master:
+            if (cell not in self.notify_cells_master and
+                    watches(cell[0].lower(), cell[1])):
                 self.notify_cells_master.add(cell)
     
     def send_notify_cells_to_functions(self):
-        for func in self.notify_functions:
+        if not self.notify_functions:
+            return
+        if self.subscriptions.is_scoped():
+            cell_sets = self.subscriptions.split(self.notify_cells_master)
+        else:
+            cell_sets = [self.notify_cells_master] * len(self.notify_functions)
+        if self.notify_dispatcher is not None:
+            self.notify_dispatcher.dispatch(self, self.notify_functions,
+                                            cell_sets)
+            return
+        for (func, cells) in zip(self.notify_functions, cell_sets):
+            if not cells:
+                continue
             try:
-                func(self, self.notify_cells_master)
+                func(self, cells)
             # Note that the following try except block is bad coding practice.
             # This is because we want the notify function to ignore ALL errors
             # or exceptions that may be thrown so that the next notify function
@@ -278,8 +373,7 @@ class Workbook:
             except:
                 continue
 
-    def update_workbook(self, sheet_name: str, location: str,
-                        notify_base_cell=False):
+    def update_workbook(self, sheet_name: str, location: str):
         '''
         Helper method that updates the workbook after a change is made.
 
@@ -287,55 +381,575 @@ class Workbook:
             sheet_name (str): the name of a sheet
             location (str): the location of a cell
         '''
+        self.update_cells([(sheet_name, location)])
 
-        #topo_sort = self.topo_sort(sheet_name, location, self.forward_graph)
-        
-        cycles, topo_sort = self.tarjan_iter(sheet_name, location, self.forward_graph)
+    def update_sheet_dependents(self, sheet_name):
+        '''
+        Helper method that recalculates every cell that depends on a cell in
+        a sheet, for when the sheet is created, copied or renamed.
 
-        cycle_cells = set()
-        for cycle in cycles:
-            for v in cycle:
-                if v[0] not in self.sheet_names:
-                    continue
-                detail = 'Cell is part of circular reference.'
-                value = self.get_cell_value(v[0], v[1])
-                if not (isinstance(value, CellError) and value.get_type() == CellErrorType.BAD_NAME):
-                    contents = self.get_cell_contents(v[0], v[1])
-                    cycle_cells.add(v)
-                    circ_ref = CellError(CellErrorType.CIRCULAR_REFERENCE, detail)
-                    self.sheets[v[0].lower()].set_cell_value(
-                        v[1], contents, circ_ref)
-    
-        if (sheet_name in self.forward_graph and
-           sheet_name in self.sheet_names and
-           location in self.forward_graph[sheet_name] and
-           (sheet_name, location) in self.forward_graph[sheet_name][location]):
-            detail = 'Cell is part of circular reference.'
-            contents = self.get_cell_contents(sheet_name, location)
-            cycle_cells.add((sheet_name, location))
-            circ_ref = CellError(CellErrorType.CIRCULAR_REFERENCE, detail)
-            self.sheets[sheet_name].set_cell_value(
-                location, contents, circ_ref)
+        Parameters:
+            sheet_name (str): the lower case name of a sheet
+        '''
+        dependents = self.graph.sheet_dependents(sheet_name)
+        if dependents:
+            self.update_cells(list(dependents))
+
+    def update_cells(self, cells, evaluated_values=None, parallel=True):
+        '''
+        Helper method that recalculates a group of changed cells and what
+        depends on them. Cells are taken from a heap in topological order,
+        and a dependent is only evaluated if the value of something it depends
+        on actually changed, so a change that is absorbed close to the changed
+        cells does not recalculate everything downstream of them. Each cell is
+        evaluated at most once, and the cells of a cycle are marked and
+        evaluated together.
+
+        With worker processes, large updates are done by
+        update_cells_in_parallel() instead.
+
+        Parameters:
+            cells (list): the changed cells as (sheet name, location) tuples
+            evaluated_values (dict): for cells that were already evaluated when
+                their contents were set, maps each one to its value from
+                before it was set. These cells are only evaluated again if
+                something they depend on was set or changed too.
+            parallel (bool): whether the update may use the worker processes
+        '''
+        if evaluated_values is None:
+            evaluated_values = {}
+        if (parallel and self.pool is not None and
+                self.update_cells_in_parallel(cells, evaluated_values)):
+            return
+
+        order = self.graph.order
+        # maps the cells that are evaluated to their values from before
+        old_values = dict(evaluated_values)
+        # the cells whose values may differ from what their dependents last
+        # read, which are the cells that were set and the cells that changed
+        touched = set(evaluated_values)
+        heap = []
+        scheduled = set()
+        done = set()
+        count = 0
+
+        def schedule(v):
+            nonlocal count
+            if v not in scheduled and v not in done:
+                scheduled.add(v)
+                heapq.heappush(heap, (order.key(v), count, v))
+                count += 1
+
+        for v in cells:
+            schedule(v)
 
         notify_cells = []
-        #print(topo_sort)
-        for v in topo_sort:
-            if v[0] not in self.sheet_names:
+        watches = self.subscriptions.watches
+        while heap:
+            (key, _, v) = heapq.heappop(heap)
+            if v in done:
+                continue
+            if key != order.key(v):
+                # evaluating earlier cells changed their dependencies and
+                # moved this cell in the order
+                heapq.heappush(heap, (order.key(v), count, v))
+                count += 1
                 continue
-            old_value = self.sheets[v[0].lower()].get_cell_value(v[1])
-            contents = self.sheets[v[0].lower()].get_cell_contents(v[1])
-            if v not in cycle_cells:
-                self.internal_set_cell_contents(v[0], v[1], contents, is_new=False, internal_call=True)
+            scheduled.discard(v)
+
+            if order.is_cyclic(v):
+                group = self.cycle_evaluation_order(v, scheduled)
             else:
-                self.internal_set_cell_contents(v[0], v[1], contents, is_new=False, internal_call=True, in_scc = True)
-            new_value = self.sheets[v[0].lower()].get_cell_value(v[1])
-            if isinstance(old_value, CellError) and isinstance(new_value, CellError):
-                if old_value.get_type() != new_value.get_type() or (v == (sheet_name, location) and notify_base_cell):
-                    notify_cells.append((self.sheet_names[v[0]], v[1].upper()))
-            elif new_value != old_value or (v == (sheet_name, location) and notify_base_cell):
-                notify_cells.append((self.sheet_names[v[0]], v[1].upper()))
+                group = [v]
+            done.update(group)
+
+            group = [u for u in group if u[0] in self.sheet_names]
+            for u in group:
+                if u not in old_values:
+                    old_values[u] = self.sheets[u[0]].get_cell_value(u[1])
+            cycle_cells = self.mark_cycle_cells(group)
+            changed = []
+            for u in group:
+                if (u not in evaluated_values or u in cycle_cells or
+                        self.graph.precedents_in(u[0], u[1], touched)):
+                    was_cyclic = order.is_cyclic(u)
+                    self.reevaluate_cell(u[0], u[1], in_scc=u in cycle_cells)
+                    if not was_cyclic and order.is_cyclic(u):
+                        # the references the cell just read put it in a
+                        # cycle, so it is evaluated again with the cycle
+                        done.discard(u)
+                        schedule(u)
+                        continue
+                new_value = self.sheets[u[0]].get_cell_value(u[1])
+                if self.value_changed(old_values[u], new_value):
+                    changed.append(u)
+                    if watches(u[0], u[1]):
+                        notify_cells.append((self.sheet_names[u[0]],
+                                             u[1].upper()))
+                elif (isinstance(new_value, CellError) and new_value.get_type()
+                        == CellErrorType.CIRCULAR_REFERENCE):
+                    # the same error can mean the cells that read it have
+                    # just left a cycle, which changes how they evaluate
+                    changed.append(u)
+
+            touched.update(changed)
+            for u in changed:
+                for dependent in self.graph.dependents(u[0], u[1]):
+                    if (dependent in done and dependent not in group and
+                            order.key(dependent) > order.key(u)):
+                        # the dependent only started reading u when it was
+                        # evaluated, before u, so it read u's old value
+                        done.discard(dependent)
+                    schedule(dependent)
+
+        self.update_notify_cells_master(notify_cells)
+
+    def cycle_evaluation_order(self, cell, scheduled):
+        '''
+        Helper method that returns the cells of the cycle a cell is in, in the
+        order update_cells() evaluates them. They are evaluated in depth first
+        order from the cell, following only the edges within the cycle.
+
+        Parameters:
+            cell (tuple): a (sheet name, location) tuple in a cycle
+            scheduled (set): the cells waiting to be evaluated, which the
+                cells of the cycle are removed from
+
+        Returns:
+            list: the cells of the cycle
+        '''
+        node = self.graph.order.node(cell)
+        if not isinstance(node, frozenset):
+            return [cell]
+        scheduled.difference_update(node)
+        dependents = self.graph.dependents
+        return depth_first_order(
+            [cell], lambda v: [u for u in dependents(v[0], v[1])
+                               if u in node])[::-1]
+
+    def update_cells_in_parallel(self, cells, evaluated_values):
+        '''
+        Helper method that does the work of update_cells() with the worker
+        processes. The cells the update can reach are split into topological
+        levels, where each cell comes after every cell it depends on, so the
+        cells of a level do not depend on each other. The cells of a level
+        that need evaluating are divided between the workers, and their
+        results are stored in the order of the level, so the values and
+        notifications are the same as update_cells() gives serially.
+
+        If evaluating a cell changes the edges of the graph, the levels may be
+        wrong, so the rest of the update is done serially from the values the
+        cells had before the update.
+
+        Parameters:
+            cells (list): the changed cells as (sheet name, location) tuples
+            evaluated_values (dict): see update_cells()
+
+        Returns:
+            bool: False if the update was left to update_cells(), because it
+                  reaches too few cells or a cycle
+        '''
+        graph = self.graph
+        order = graph.order
+        # the cells the update can reach, mapped to their dependents
+        dependents = {}
+        stack = list(cells)
+        while stack:
+            v = stack.pop()
+            if v in dependents:
+                continue
+            if order.is_cyclic(v):
+                return False
+            dependents[v] = graph.dependents(v[0], v[1])
+            stack.extend(dependents[v])
+        if len(dependents) < self.parallel_min_cells:
+            return False
+
+        # each cell's level is the length of the longest path to it
+        levels = dict.fromkeys(dependents, 0)
+        for v in sorted(dependents, key=lambda v: (order.key(v), v)):
+            for u in dependents[v]:
+                if levels[u] <= levels[v]:
+                    levels[u] = levels[v] + 1
+        level_cells = [[] for _ in range(max(levels.values()) + 1)]
+        for v in sorted(dependents):
+            level_cells[levels[v]].append(v)
+
+        old_values = dict(evaluated_values)
+        touched = set(evaluated_values)
+        scheduled = set(cells)
+        notify_cells = []
+        for level in level_cells:
+            level = [v for v in level
+                     if v in scheduled and v[0] in self.sheet_names]
+            for v in level:
+                if v not in old_values:
+                    old_values[v] = self.sheets[v[0]].get_cell_value(v[1])
+            evaluate = [v for v in level if v not in evaluated_values or
+                        graph.precedents_in(v[0], v[1], touched)]
+            if not self.evaluate_in_parallel(evaluate):
+                # the cells set without being evaluated that were not reached
+                # yet are evaluated by the serial update
+                self.update_cells(list(set(old_values).union(cells)),
+                                  old_values, parallel=False)
+                return True
+
+            changed = []
+            for v in level:
+                new_value = self.sheets[v[0]].get_cell_value(v[1])
+                if self.value_changed(old_values[v], new_value):
+                    changed.append(v)
+                    if self.subscriptions.watches(v[0], v[1]):
+                        notify_cells.append((self.sheet_names[v[0]],
+                                             v[1].upper()))
+                elif (isinstance(new_value, CellError) and new_value.get_type()
+                        == CellErrorType.CIRCULAR_REFERENCE):
+                    changed.append(v)
+            touched.update(changed)
+            for v in changed:
+                scheduled.update(dependents[v])
 
         self.update_notify_cells_master(notify_cells)
+        return True
+
+    def evaluate_in_parallel(self, cells):
+        '''
+        Helper method that evaluates cells that do not depend on each other,
+        dividing them between the worker processes if there are enough of
+        them. A cell that a worker could not evaluate, or whose worker failed,
+        is evaluated in this process.
+
+        Parameters:
+            cells (list): (sheet name, location) tuples of formula cells
+
+        Returns:
+            bool: False if evaluating a cell changed its precedents
+        '''
+        graph = self.graph
+        results = [None] * len(cells)
+        if len(cells) >= self.parallel_min_cells:
+            chunk_size = -(-len(cells) // self.num_workers)
+            futures = [self.pool.submit(evaluate_cells,
+                                        build_task(self, cells[i:i + chunk_size]))
+                       for i in range(0, len(cells), chunk_size)]
+            for (i, future) in zip(range(0, len(cells), chunk_size), futures):
+                # pylint: disable=broad-except
+                try:
+                    results[i:i + chunk_size] = future.result()
+                except Exception:
+                    continue
+
+        edges_changed = False
+        for (v, result) in zip(cells, results):
+            # set_precedents() only replaces these sets if the edges change
+            precedents = (graph.precedents(v[0], v[1]),
+                          graph.range_precedents(v[0], v[1]))
+            if result is None:
+                self.reevaluate_cell(v[0], v[1])
+            else:
+                (value, refs) = result
+                cell = self.sheets[v[0]].cells[v[1]]
+                formula = cell.formula
+                if formula is None:
+                    formula = try_compile(cell.contents)
+                self.store_cell(v[0], v[1], cell.text, value, formula, refs)
+            if (graph.precedents(v[0], v[1]) is not precedents[0] or
+                    graph.range_precedents(v[0], v[1]) is not precedents[1]):
+                edges_changed = True
+        return not edges_changed
+
+    def value_changed(self, old_value, new_value):
+        '''
+        Helper method that checks whether a cell's value changed. Errors only
+        count as changed if their type changed. A boolean and a number always
+        differ, although Python compares TRUE equal to 1 and FALSE to 0.
+        '''
+        if isinstance(old_value, CellError) and isinstance(new_value, CellError):
+            return old_value.get_type() != new_value.get_type()
+        return type(old_value) is not type(new_value) or old_value != new_value
+
+    @contextmanager
+    def batch(self):
+        '''
+        Context manager that defers recalculation while many cells are set.
+
+        Inside the block, set_cell_contents() evaluates each cell it sets but
+        does not update the cells that depend on it or notify anyone. When the
+        outermost block exits, every changed cell and everything that depends
+        on them is recalculated in a single pass, and the notify functions are
+        called once with all of the cells whose values changed.
+
+            with wb.batch():
+                for i in range(1, 10001):
+                    wb.set_cell_contents('Sheet1', f'A{i}', str(i))
+
+        The block holds the workbook's lock for writing, so other threads
+        cannot read the workbook until it is recalculated.
+        '''
+        self.lock.acquire_write()
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            try:
+                if self.batch_depth == 0:
+                    self.finish_batch()
+            finally:
+                self.lock.release_write()
+                if (self.notify_dispatcher is not None and
+                        not self.lock.is_writing()):
+                    self.notify_dispatcher.wait_for_room()
+
+    def finish_batch(self):
+        '''
+        Helper method that recalculates and notifies for the cells set inside
+        a batch.
+        '''
+        batch_cells = self.batch_cells
+        self.batch_cells = {}
+        self.notify_cells_master = set()
+        batch_cells = {cell: value for (cell, value) in batch_cells.items()
+                       if cell[0] in self.sheets}
+        if batch_cells:
+            self.update_cells(list(batch_cells), batch_cells)
+        if self.notify_cells_master:
+            self.send_notify_cells_to_functions()
+
+    @writer
+    def set_cells_contents(self, sheet_name: str, contents: dict) -> None:
+        '''
+        Sets the contents of many cells on one sheet, recalculating the
+        workbook once at the end instead of once per cell. See batch().
+
+        If the specified sheet name is not found, a KeyError is raised.
+        If a cell location is invalid, a ValueError is raised; the cells set
+        before it keep their new contents.
+
+        Parameters:
+            sheet_name (str): the name of a sheet
+            contents (dict): maps cell locations to their new contents
+        '''
+        with self.batch():
+            for (location, cell_contents) in contents.items():
+                self.set_cell_contents(sheet_name, location, cell_contents)
+
+    @writer
+    def set_workers(self, num_workers: int,
+                    min_cells: int = MIN_PARALLEL_CELLS) -> None:
+        '''
+        Turns parallel recalculation on or off.
+
+        With more than one worker, a recalculation that reaches at least
+        min_cells cells is split into topological levels, whose cells do not
+        depend on each other. A level with at least min_cells cells to
+        evaluate is divided between a pool of worker processes, and each
+        worker evaluates its cells against a replica of the values they read.
+        The values, errors and notifications are the same as recalculating
+        serially. Recalculations that are smaller or that reach a cycle are
+        done serially.
+
+        Parameters:
+            num_workers (int): the number of worker processes, or 0 to
+                recalculate serially
+            min_cells (int): the fewest cells a recalculation must reach, and
+                a level must have to evaluate, to use the workers
+        '''
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        self.num_workers = num_workers
+        self.parallel_min_cells = min_cells
+        if num_workers > 1:
+            self.pool = ProcessPoolExecutor(max_workers=num_workers)
+
+    @writer
+    def set_lazy(self, lazy: bool) -> None:
+        '''
+        Turns lazy evaluation on or off.
+
+        In lazy mode set_cell_contents() does not evaluate anything: it stores
+        the new contents and marks the cell, and every cell that depends on
+        it, as dirty. A dirty cell is evaluated the first time its value is
+        read, along with the dirty cells it depends on. No notifications are
+        sent as cells change; flush() evaluates every dirty cell and notifies
+        once about all of the cells whose values changed since the last flush.
+
+        Other operations, such as rename_sheet() or move_cells(), flush the
+        workbook first and then run as they do outside lazy mode.
+
+        Turning lazy mode off flushes the workbook.
+
+        Parameters:
+            lazy (bool): whether cells should be evaluated lazily
+        '''
+        if self.lazy and not lazy:
+            self.flush()
+        self.lazy = lazy
+
+    @writer
+    def flush(self) -> None:
+        '''
+        Evaluates every dirty cell, then calls the notify functions once with
+        the cells whose values changed since the last flush. Outside of lazy
+        mode there is never anything to flush.
+        '''
+        self.evaluate_dirty_cells(list(self.dirty_cells))
+        lazy_changed = self.lazy_changed
+        self.lazy_changed = {}
+        self.notify_cells_master = set()
+        for ((sheet_name, location), old_value) in lazy_changed.items():
+            if sheet_name not in self.sheets:
+                continue
+            new_value = self.sheets[sheet_name].get_cell_value(location)
+            if (self.value_changed(old_value, new_value) and
+                    self.subscriptions.watches(sheet_name, location)):
+                self.notify_cells_master.add((self.sheet_names[sheet_name],
+                                              location.upper()))
+        if self.notify_cells_master:
+            self.send_notify_cells_to_functions()
+
+    def set_cell_lazily(self, sheet_name, location, contents, formula=None):
+        '''
+        Helper method that sets a cell's contents in lazy mode. Contents that
+        are not a formula do not depend on anything, so their value is stored
+        straight away. A formula is stored with every reference it may read,
+        including the branches of an IF it may not take, and is left dirty
+        until evaluate_dirty_cells() finds the references it does read.
+        Either way every cell that depends on the cell is marked dirty.
+
+        Parameters:
+            sheet_name (str): the lower case name of a sheet
+            location (str): the lower case location of a cell
+            contents (str, None): the new contents of the cell
+            formula (CompiledFormula): the cell's formula if it is already
+                compiled, in which case the contents may be None
+        '''
+        cell = (sheet_name, location)
+        sheet = self.sheets[sheet_name]
+        old_value = sheet.get_cell_value(location)
+        if (formula is None and contents is not None and
+                contents.strip()[:1] == '='):
+            contents = contents.strip()
+            formula = try_compile(contents)
+
+        if formula is None:
+            contents, value, _, _ = self.calculate_contents(sheet_name,
+                                                            contents)
+            sheet.set_cell_value(location, contents, value)
+            self.graph.clear_precedents(sheet_name, location)
+            self.dirty_cells.pop(cell, None)
+        else:
+            refs = formula.get_refs({})
+            sheet.set_cell_value(location, contents, old_value, formula,
+                                 formula.sheet_name_dict, refs)
+            self.graph.set_precedents(sheet_name, location,
+                                      *self.resolve_refs(sheet_name, refs))
+            self.dirty_cells[cell] = True
+        self.lazy_changed.setdefault(cell, old_value)
+
+        # the dependents of a dirty cell are always dirty already
+        stack = list(self.graph.dependents(sheet_name, location))
+        while stack:
+            v = stack.pop()
+            if v in self.dirty_cells or v[0] not in self.sheets:
+                continue
+            self.dirty_cells[v] = None
+            self.lazy_changed.setdefault(
+                v, self.sheets[v[0]].get_cell_value(v[1]))
+            stack.extend(self.graph.dependents(v[0], v[1]))
+
+    def evaluate_dirty_cells(self, cells):
+        '''
+        Helper method that evaluates the given dirty cells, after the dirty
+        cells they depend on, the same way update_cells() would have.
+
+        A formula written in lazy mode depends on every reference it may
+        read, which can put it in a cycle it is not in. Like a formula
+        written outside lazy mode, it is first evaluated as if it were not
+        in a cycle, which makes its precedents the references it read. The
+        dirty cells are then evaluated in topological order, with each cycle
+        marked and evaluated together, and a cell that the references it
+        just read put in a cycle is evaluated again with its cycle.
+
+        A formula can read a cell it was not known to depend on, through a
+        lookup or INDIRECT. If that cell was still dirty, the formula read a
+        stale value, so it stays dirty and another pass is made.
+
+        Parameters:
+            cells (list): the cells to evaluate as (sheet name, location)
+        '''
+        if self.evaluating_dirty:
+            # a formula being evaluated reads whatever value is stored
+            return
+        self.evaluating_dirty = True
+        try:
+            cells = [cell for cell in cells if cell in self.dirty_cells]
+            while cells:
+                # the dirty cells that the cells depend on
+                # formulas written in lazy mode are evaluated first, as
+                # they would have been when they were set
+                for v in self.dirty_precedents_order(cells):
+                    if not self.dirty_cells.get(v) or v[0] not in self.sheets:
+                        continue
+                    self.dirty_cells[v] = None
+                    self.reevaluate_cell(v[0], v[1])
+                    if not (self.graph.order.is_cyclic(v) or
+                            self.graph.precedents_in(v[0], v[1],
+                                                     self.dirty_cells)):
+                        del self.dirty_cells[v]
+
+                for v in self.dirty_precedents_order(cells):
+                    if v not in self.dirty_cells:
+                        # evaluated with its cycle
+                        continue
+                    if v[0] not in self.sheets:
+                        del self.dirty_cells[v]
+                        continue
+                    for u in self.evaluate_dirty_group(v):
+                        # the cells before u have been evaluated, so a dirty
+                        # cell it read was read too early
+                        if self.graph.precedents_in(u[0], u[1],
+                                                    self.dirty_cells):
+                            self.dirty_cells[u] = None
+                cells = [cell for cell in cells if cell in self.dirty_cells]
+        finally:
+            self.evaluating_dirty = False
+
+    def dirty_precedents_order(self, cells):
+        '''
+        Helper method that returns the dirty cells that the given cells depend
+        on, each after the ones it depends on unless they are in a cycle.
+        '''
+        return depth_first_order(
+            cells, lambda v: self.graph.precedents_in(v[0], v[1],
+                                                      self.dirty_cells))
+
+    def evaluate_dirty_group(self, cell):
+        '''
+        Helper method that evaluates a dirty cell, or every dirty cell of the
+        cycle it is in, the way update_cells() does. A cell that was not in a
+        cycle, but the references it just read put it in one, is left dirty
+        so the next pass evaluates it with its cycle.
+
+        Returns:
+            list: the cells that were evaluated
+        '''
+        order = self.graph.order
+        if order.is_cyclic(cell):
+            group = [v for v in self.cycle_evaluation_order(cell, set())
+                     if v in self.dirty_cells]
+        else:
+            group = [cell]
+        for v in group:
+            del self.dirty_cells[v]
+        cycle_cells = self.mark_cycle_cells(group)
+        for v in group:
+            was_cyclic = order.is_cyclic(v)
+            self.reevaluate_cell(v[0], v[1], in_scc=v in cycle_cells)
+            if not was_cyclic and order.is_cyclic(v):
+                self.dirty_cells[v] = None
+        return group
 
     def is_string_float(self, val):
         '''
@@ -408,29 +1022,34 @@ class Workbook:
         else:
             return value
 
-    def calculate_contents(self, sheet_name, contents: Optional[str], old_tree=None, in_scc= False):
+    def calculate_contents(self, sheet_name, contents: Optional[str], in_scc=False,
+                           formula=None):
         '''
         Helper method that returns tuple of the (contents, value) for a cell.
 
         Parameters:
             sheet_name (str): the name of a sheet
             contents (str, None): contents of a cell
+            formula (CompiledFormula): the cell's formula if it is already
+                compiled, which is evaluated instead of parsing the contents;
+                the contents may then be None
 
         Returns:
-            (str, int or str, Tree): tuple containing a cell's contents, value,
-                                     and parsed tree.
+            (str, int or str, CompiledFormula, list): tuple containing a cell's
+                contents, value, compiled formula and the references the
+                formula read.
         '''
+        if formula is not None:
+            value, refs = evaluate_formula(sheet_name, formula, self, in_scc)
+            return contents, value, formula, refs
         if contents is None or contents == '' or contents.isspace():
             return None, None, None, None
         contents = contents.strip()
         value = contents
         if contents[0] == '=':
-            value, tree, calculated_refs = parse_contents(self.parser, self.parsed_trees, sheet_name, contents, self, old_tree, in_scc)
-            if isinstance(value, decimal.Decimal) and '.' in str(value):
-                temp = str(value).rstrip('0').rstrip('.')
-                value = decimal.Decimal(temp)
+            value, formula, refs = parse_contents(sheet_name, contents, self, in_scc)
             #print(value)
-            return contents, value, tree, calculated_refs
+            return contents, value, formula, refs
         value = self.convert_to_error(contents)
 
         if contents[0] == "'":
@@ -479,61 +1098,121 @@ class Workbook:
 
         return True
 
-    @lru_cache()
-    def tree_dfs(self, tree, sheet_name, calculated_refs):
+    def resolve_refs(self, sheet_name, refs):
         '''
-        Helper method that implements DFS on a parsed tree to find cell
-        references.
+        Helper method that turns the references a formula read into the cells
+        and cell ranges it depends on. Ranges are kept whole rather than
+        listing every cell they cover.
 
         Parameters:
-            tree (Tree): a parsed tree
-            sheet_name (str): the name of a sheet
+            sheet_name (str): the lower case name of the formula's sheet
+            refs (list): references recorded by parse_contents, where a sheet
+                         name of None means the formula's own sheet
 
         Returns:
-            (list, list): a tuple of a list of cycles and a list of
-                          dependencies
+            (list, list): (sheet name, location) tuples and
+                          (sheet name, range) tuples, see range_ref()
         '''
-        calculated_refs = list(calculated_refs)
-        #print(calculated_refs)
-        stack = [tree]
         cell_refs = []
-        sheet_name_dict = {'QUOTED_SHEET_NAMES': [], 'SHEET_NAMES': [], 'CELLS': []}
-        while stack:
-            while_sheet_name = sheet_name
-            node = stack.pop()
-            if isinstance(node, Token):
+        range_refs = []
+        for ref in refs:
+            ref_sheet_name = sheet_name if ref[0] is None else ref[0]
+            if len(ref) == 2:
+                cell_refs.append((ref_sheet_name, ref[1]))
+            else:
+                cell_range = self.range_ref(ref[1], ref[2])
+                if cell_range is not None:
+                    range_refs.append((ref_sheet_name, cell_range))
+        return cell_refs, range_refs
+
+    def range_ref(self, start_location, end_location):
+        '''
+        Helper method that converts the corners of a cell range into the
+        numbers of its edges.
+
+        Parameters:
+            start_location (str): one corner of the range
+            end_location (str): the opposite corner of the range
+
+        Returns:
+            tuple: (left col, top row, right col, bottom row), or None if a
+                   corner is not a valid location
+        '''
+        start_location = start_location.replace('$', '').lower()
+        end_location = end_location.replace('$', '').lower()
+        if (not self.is_valid_cell_location(start_location) or
+                not self.is_valid_cell_location(end_location)):
+            return None
+        (start_col, start_row) = location_to_coords(start_location)
+        (end_col, end_row) = location_to_coords(end_location)
+        return (min(start_col, end_col), min(start_row, end_row),
+                max(start_col, end_col), max(start_row, end_row))
+
+    @writer
+    @eager
+    def load_cells(self, cells) -> None:
+        '''
+        Sets the contents of many cells at once, for filling a workbook from a
+        file. All of the contents are stored and their formulas compiled first,
+        then the dependency graph is built in one pass from the references the
+        formulas may read, and finally every formula is evaluated once in a
+        single topological pass with cycles found across the whole workbook.
+
+        Formulas whose evaluation read cells the first pass could not know
+        about (lookups and INDIRECT), and cells found in cycles, are then
+        recalculated once more now that their exact dependencies are known.
+
+        No notifications are sent.
+
+        If a sheet name is not found, a KeyError is raised.
+        If a cell location is invalid, a ValueError is raised.
+
+        Parameters:
+            cells (iterable): (sheet name, location, contents) tuples
+        '''
+        # maps each formula cell to the references it may read
+        loaded_refs = {}
+        for (sheet_name, location, contents) in cells:
+            sheet_name = sheet_name.lower()
+            location = location.lower()
+            if sheet_name not in self.sheets:
+                raise KeyError("Sheet name not found.")
+            if not self.is_valid_cell_location(location):
+                raise ValueError("Invalid cell location.")
+            if contents is None or contents == '' or contents.isspace():
                 continue
-            if node.data == 'cell':
-                temp_sheet_name = None
-                #print(node)
-                if node.children[0].type == 'SHEET_NAME':
-                    temp_sheet_name = node.children[0].value
-                    cell = node.children[1].value
-                    if node not in calculated_refs:
-                        sheet_name_dict['CELLS'].append((cell, temp_sheet_name))
-                        sheet_name_dict['SHEET_NAMES'].append(temp_sheet_name)
-                elif node.children[0].type == 'QUOTED_SHEET_NAME':
-                    temp_sheet_name = node.children[0].value[1:-1]
-                    cell = node.children[1].value
-                    if node not in calculated_refs:
-                        sheet_name_dict['CELLS'].append((cell, node.children[0].value))
-                        sheet_name_dict['QUOTED_SHEET_NAMES'].append(
-                            node.children[0].value)
-                else:
-                    cell = node.children[0].value
-                    
-                    if node not in calculated_refs:
-                        sheet_name_dict['CELLS'].append((cell, None))
-
-                if temp_sheet_name is not None:
-                    while_sheet_name = temp_sheet_name
-                cell_refs.append((while_sheet_name.lower(), cell.lower()))
+            contents = contents.strip()
+            if contents[0] == '=':
+                self.sheets[sheet_name].set_cell_value(location, contents, None)
+                loaded_refs[(sheet_name, location)] = formula_refs(contents)
             else:
-                for i in node.children:
-                    stack.append(i)
-        #print(sheet_name_dict)
-        return cell_refs, sheet_name_dict
+                _, value, _, _ = self.calculate_contents(sheet_name, contents)
+                self.sheets[sheet_name].set_cell_value(location, contents,
+                                                       value)
+                loaded_refs.pop((sheet_name, location), None)
+
+        with self.graph.bulk_update():
+            for ((sheet_name, location), refs) in loaded_refs.items():
+                self.graph.set_precedents(sheet_name, location,
+                                          *self.resolve_refs(sheet_name, refs))
+
+        if not loaded_refs:
+            return
+        self.update_cells(list(loaded_refs))
+
+        recheck = []
+        for ((sheet_name, location), refs) in loaded_refs.items():
+            cell = self.sheets[sheet_name].cells[location]
+            value = cell.value
+            if ((isinstance(value, CellError) and
+                    value.get_type() == CellErrorType.CIRCULAR_REFERENCE) or
+                    not set(cell.refs).issubset(refs)):
+                recheck.append((sheet_name, location))
+        if recheck:
+            self.update_cells(recheck)
+        self.notify_cells_master = set()
 
+    @writer
     def set_cell_contents(self, sheet_name: str, location: str,
                           contents: Optional[str]) -> None:
         '''
@@ -571,9 +1250,10 @@ class Workbook:
                                    contents: Optional[str],
                                    is_new: Optional[bool],
                                    internal_call: Optional[bool],
-                                   in_scc = False) -> None:
+                                   in_scc = False, formula=None) -> None:
         '''
-        Internal set_cell_contents method.
+        Internal set_cell_contents method. A formula that is already compiled
+        can be given instead of the contents; see calculate_contents().
         '''
         location = location.lower()
         sheet_name = sheet_name.lower()
@@ -582,71 +1262,68 @@ class Workbook:
         if not self.is_valid_cell_location(location):
             raise ValueError("Invalid cell location.")
 
+        if is_new and self.lazy:
+            self.set_cell_lazily(sheet_name, location, contents, formula)
+            return
+
         old_value = self.sheets[sheet_name.lower()].get_cell_value(location)
         
-        old_tree = self.sheets[sheet_name].get_cell_tree(location)
-        if is_new:
-            old_tree = None
+        if is_new and self.batch_depth > 0:
+            # recalculation is left to the end of the batch
+            internal_call = True
+        elif is_new:
             if not internal_call:
                 self.notify_cells_master = set()
-                    
-        contents, value, tree, calculated_refs  = self.calculate_contents(sheet_name, contents, old_tree, in_scc)
-        if tree is None:
-            self.sheets[sheet_name].set_cell_value(location, contents, value)
-            if contents is None:
-                return
 
-        if tree is not None:
-            inherit_cells, sheet_name_dict = self.tree_dfs(tree, sheet_name, tuple(calculated_refs))
-            
-            self.sheets[sheet_name].set_cell_value(location, contents, value, tree, sheet_name_dict, calculated_refs)
-            if sheet_name in self.backward_graph:
-                if location in self.backward_graph[sheet_name]:
-                    for c in self.backward_graph[sheet_name][location]:
-                        if c[0] in self.forward_graph and c[1] in self.forward_graph[c[0]]:
-                            if (sheet_name, location) in set(self.forward_graph[c[0]][c[1]]):
-                                self.forward_graph[c[0]][c[1]].remove((sheet_name, location))
-            #     self.backward_graph[sheet_name][location] = []
-            
-            for i in inherit_cells:
-                curr_name = i[0].lower()
-                curr_loc = i[1].lower()
-                if curr_name in self.forward_graph:
-                    if curr_loc in self.forward_graph[curr_name]:
-                        if (sheet_name, location) not in self.forward_graph[curr_name][curr_loc]:
-                            self.forward_graph[curr_name][curr_loc].append((sheet_name, location))
-                    else:
-                        self.forward_graph[curr_name][curr_loc] = [(sheet_name, location)]
-                        
-                else:
-                    self.forward_graph[curr_name] = {curr_loc: [(sheet_name, location)]}
-
-            if sheet_name in self.backward_graph:
-                self.backward_graph[sheet_name][location] = inherit_cells
-            else:
-                self.backward_graph[sheet_name] = {location: inherit_cells}
-        else:
-            if sheet_name in self.backward_graph:
-                if location in self.backward_graph[sheet_name]:
-                    for c in self.backward_graph[sheet_name][location]:
-                        if c[0] in self.forward_graph and c[1] in self.forward_graph[c[0]]:
-                            if (sheet_name, location) in set(self.forward_graph[c[0]][c[1]]):
-                                self.forward_graph[c[0]][c[1]].remove((sheet_name, location))
-                    del self.backward_graph[sheet_name][location]
-        if is_new:
-            if isinstance(old_value, CellError) and isinstance(value, CellError):
-                if old_value.get_type() == value.get_type():
-                    self.update_workbook(sheet_name, location)
-                else:
-                    self.update_workbook(sheet_name, location, True)
-            elif old_value != value:
-                self.update_workbook(sheet_name, location, True)
-            else:
-                self.update_workbook(sheet_name, location)
+        contents, value, formula, refs = self.calculate_contents(
+            sheet_name, contents, in_scc, formula)
+        self.store_cell(sheet_name, location, contents, value, formula, refs)
+        if is_new and self.batch_depth > 0:
+            if (sheet_name, location) not in self.batch_cells:
+                self.batch_cells[(sheet_name, location)] = old_value
+        elif is_new:
+            # the cell was just evaluated, so it is compared with its old value
+            # instead of being evaluated again, and what depends on it is only
+            # recalculated if its value changed
+            cell = (sheet_name, location)
+            self.update_cells([cell], {cell: old_value})
 
         if not internal_call:
             self.send_notify_cells_to_functions()
 
+    def store_cell(self, sheet_name, location, contents, value, formula,
+                   refs):
+        '''
+        Helper method that stores a cell's evaluated contents, as returned by
+        calculate_contents(), and makes the cells its formula read its
+        precedents.
+        '''
+        if formula is None:
+            self.sheets[sheet_name].set_cell_value(location, contents, value)
+            self.graph.clear_precedents(sheet_name, location)
+        else:
+            inherit_cells, inherit_ranges = self.resolve_refs(sheet_name, refs)
+            self.sheets[sheet_name].set_cell_value(location, contents, value, formula, formula.sheet_name_dict, refs)
+            self.graph.set_precedents(sheet_name, location, inherit_cells,
+                                      inherit_ranges)
+
+    def reevaluate_cell(self, sheet_name, location, in_scc=False):
+        '''
+        Helper method that evaluates a cell again with its compiled formula,
+        so the formula is not parsed again. Cells whose formula has not been
+        compiled yet have their contents parsed.
+
+        Parameters:
+            sheet_name (str): the lower case name of a sheet
+            location (str): the lower case location of a cell
+            in_scc (bool): whether the cell is in a cycle
+        '''
+        cell = self.sheets[sheet_name].cells.get(location, EMPTY_CELL)
+        self.internal_set_cell_contents(
+            sheet_name, location, cell.text, is_new=False, internal_call=True,
+            in_scc=in_scc, formula=cell.formula)
+
+    @reader
     def get_cell_contents(self, sheet_name: str,
                           location: str) -> Optional[str]:
         '''
@@ -701,6 +1378,9 @@ class Workbook:
         whole number.  For example, this function would not return
         Decimal('1.000'); rather it would return Decimal('1').
 
+        In lazy mode a dirty cell, and the dirty cells it depends on, are
+        evaluated here before the value is returned.
+
         Parameters:
             sheet_name (str): the name of a sheet
             location (str): a cell's location
@@ -708,19 +1388,41 @@ class Workbook:
         Returns:
             str, int, CellValue: the value of the cell
         '''
-        if sheet_name.lower() not in self.sheets:
-            raise KeyError("Sheet name not found.")
-        if not self.is_valid_cell_location(location):
-            raise ValueError("Invalid cell location.")
-        #if self.sheets[sheet_name.lower()].get_cell_uncalc_status(location):
-        #    self.internal_set_cell_contents(sheet_name, location, self.cells[sheet_name])
-        return self.sheets[sheet_name.lower()].get_cell_value(location)
+        self.lock.acquire_read()
+        try:
+            sheet = self.sheets.get(sheet_name.lower())
+            if (sheet is not None and self.is_valid_cell_location(location)
+                    and (not self.dirty_cells or
+                         (sheet_name.lower(), location.lower())
+                         not in self.dirty_cells)):
+                return sheet.get_cell_value(location)
+        finally:
+            self.lock.release_read()
+
+        # evaluating a dirty cell changes the workbook, so it is done holding
+        # the lock for writing, and so are the checks that raise
+        self.lock.acquire_write()
+        try:
+            if sheet_name.lower() not in self.sheets:
+                raise KeyError("Sheet name not found.")
+            if not self.is_valid_cell_location(location):
+                raise ValueError("Invalid cell location.")
+            if self.dirty_cells:
+                cell = (sheet_name.lower(), location.lower())
+                if cell in self.dirty_cells:
+                    self.evaluate_dirty_cells([cell])
+            return self.sheets[sheet_name.lower()].get_cell_value(location)
+        finally:
+            self.lock.release_write()
 
     @staticmethod
     def load_workbook(fp: TextIO):
         '''
         Loads a workbook from a text file or file-like object in JSON format.
 
+        The input is read incrementally, one sheet at a time, so only the
+        sheet currently being loaded is held in memory as JSON.
+
         If the contents of the input cannot be parsed by the Python json
         module then a json.JSONDecodeError is raised.
         If an IO read error occurs (unlikely but possible), any raised
@@ -739,17 +1441,18 @@ class Workbook:
         Returns:
             Workbook: the new Workbook instance loaded from the file
         '''
-        # json.load(fp) outputs a dictionary with one key 'sheets'
-        try:
-            # list of dictionaries w/keys 'name' and 'cell-contents'
-            sheets_lst = json.load(fp)['sheets']
-            wb = Workbook()
-            for sheet_dict in sheets_lst:
+        # the document is read one sheet at a time, and each sheet's cells are
+        # fed to load_cells as soon as they have been read
+        wb = Workbook()
+
+        def read_cells():
+            for sheet_dict in iter_json_sheets(fp):
                 name = sheet_dict['name']
                 wb.new_sheet(name)
-                for cell_loc in sheet_dict['cell-contents'].keys():
-                    wb.set_cell_contents(
-                        name, cell_loc, sheet_dict['cell-contents'][cell_loc])
+                for (cell_loc, contents) in sheet_dict['cell-contents'].items():
+                    yield (name, cell_loc, contents)
+        try:
+            wb.load_cells(read_cells())
             return wb
         except KeyError:
             raise KeyError('JSON missing expected values.')
@@ -758,30 +1461,116 @@ class Workbook:
         except (TypeError, AttributeError):
             raise TypeError('JSON contains values with unexpected types.')
 
-    def save_workbook(self, fp: TextIO) -> None:
+    @reader
+    def save_workbook(self, fp: TextIO, indent: Optional[int] = 4) -> None:
         '''
         Saves a workbook to a text file or file-like object in JSON format.
 
+        The JSON is written to fp one cell at a time rather than built up as
+        one string, so saving a large workbook does not need a second copy of
+        it in memory.
+
         If an IO write error occurs (unlikely but possible), any raised
         exception propagates through.
 
         Parameters:
-            fp (TextIO): the already opened json file to load workbook from
+            fp (TextIO): the already opened json file to save workbook to
+            indent (int or None): spaces per indentation level, or None to
+                write the whole workbook on one line
         '''
-        wb_dict = {}
-        sheets_lst = []
+        def sheet_cells(sheet):
+            for (cell_loc, cell) in sheet.cells.items():
+                yield (cell_loc.upper(), cell.contents)
+        write_json_sheets(fp, ((self.sheet_names[sheet_name],
+                                sheet_cells(sheet))
+                               for (sheet_name, sheet) in self.sheets.items()),
+                          indent)
+
+    @staticmethod
+    def load_workbook_binary(fp: BinaryIO):
+        '''
+        Loads a workbook saved by save_workbook_binary from a binary file or
+        file-like object.
+
+        The cached cell values and dependency graphs are used as they are, so
+        no formulas are parsed or evaluated. If the file was written by a
+        different version of the engine or with a different formula grammar,
+        the cached data may be stale, so it is ignored and the workbook is
+        recalculated from the stored contents instead.
+
+        If the input is not a binary workbook, or it is truncated or corrupt,
+        a ValueError is raised.
+
+        Parameters:
+            fp (BinaryIO): the already opened binary file to load from
+
+        Returns:
+            Workbook: the new Workbook instance loaded from the file
+        '''
+        with binary_format.gc_paused():
+            is_current, body = binary_format.read_workbook(fp)
+            wb = Workbook()
+            try:
+                for (name, _) in body['sheets']:
+                    wb.new_sheet(name, is_copy=True)
+                if is_current:
+                    for (name, cells) in body['sheets']:
+                        sheet = wb.sheets[name.lower()]
+                        for (location, contents, value, sheet_name_dict,
+                             refs) in cells:
+                            value = binary_format.decode_value(value)
+                            sheet.set_cell_value(location, contents, value,
+                                                 None, sheet_name_dict, refs)
+                    wb.graph = DependencyGraph(body['forward_graph'],
+                                               body['backward_graph'],
+                                               body['range_graph'],
+                                               body['order_keys'],
+                                               body['self_loops'])
+                    return wb
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError('Binary workbook file is corrupt.') from e
+
+        try:
+            wb.load_cells((name, location, contents)
+                          for (name, cells) in body['sheets']
+                          for (location, contents, _, _, _) in cells)
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError('Binary workbook file is corrupt.') from e
+        return wb
+
+    @writer
+    @eager
+    def save_workbook_binary(self, fp: BinaryIO) -> None:
+        '''
+        Saves a workbook to a binary file or file-like object. Along with the
+        cell contents this stores every cell's current value, the references
+        its formula read and the dependency graphs, so that
+        load_workbook_binary can open the workbook without recalculating it.
+
+        If an IO write error occurs (unlikely but possible), any raised
+        exception propagates through.
+
+        Parameters:
+            fp (BinaryIO): the already opened binary file to save workbook to
+        '''
+        sheets = []
         for (sheet_name, sheet) in self.sheets.items():
-            sheet_dict = {}
-            contents_dict = {}
-            for (cell_loc, content_value) in sheet.cells.items():
-                contents_dict[cell_loc.upper()] = content_value['contents']
-            sheet_dict['name'] = self.sheet_names[sheet_name]
-            sheet_dict['cell-contents'] = contents_dict
-            sheets_lst.append(sheet_dict)
-        wb_dict['sheets'] = sheets_lst
-        fp.write(json.dumps(wb_dict, indent=4))
-
-    def notify_cells_changed(self, notify_function) -> None:
+            cells = [(location, cell.contents,
+                      binary_format.encode_value(cell.value),
+                      cell.sheet_name_dict, cell.refs)
+                     for (location, cell) in sheet.cells.items()]
+            sheets.append((self.sheet_names[sheet_name], cells))
+        binary_format.write_workbook(fp, sheets, self.graph.forward,
+                                     self.graph.backward,
+                                     self.graph.get_range_dependents(),
+                                     self.graph.order.keys,
+                                     self.graph.order.self_loops)
+
+    @writer
+    def notify_cells_changed(self, notify_function,
+                             sheet_name: Optional[str] = None,
+                             start_location: Optional[str] = None,
+                             end_location: Optional[str] = None) -> None:
         '''
         Requests that all changes to cell values in the workbook are reported
         to the specified notify_function. The values passed to the notify
@@ -803,13 +1592,69 @@ class Workbook:
         iterable that it is passed to it.  If a notification function violates
         this requirement, the behavior is undefined.
 
+        A notify function can watch only part of the workbook: a whole sheet
+        if sheet_name is given, or the range of cells between start_location
+        and end_location on that sheet. It is then only passed the changed
+        cells it watches, and is not called when none of them changed. The
+        sheet keeps being watched under its new name if it is renamed.
+        Changes to cells that no notify function watches are not collected
+        at all.
+
+        If the specified sheet name is not found, a KeyError is raised.
+        If only one corner of the range is given, or a corner is not a valid
+        cell location, a ValueError is raised.
+
         Parameters:
             notify_function (func): the notify function to report new cell
                                     changes ([sheet name], [cell location]) to
+            sheet_name (str): the name of the sheet to watch, or None to watch
+                              the whole workbook
+            start_location (str): one corner of the range to watch
+            end_location (str): the opposite corner of the range to watch
         '''
+        scope = None
+        if sheet_name is not None:
+            if sheet_name.lower() not in self.sheets:
+                raise KeyError("Sheet name not found.")
+            cell_range = None
+            if start_location is not None or end_location is not None:
+                if start_location is None or end_location is None:
+                    raise ValueError("Invalid cell range.")
+                cell_range = self.range_ref(start_location, end_location)
+                if cell_range is None:
+                    raise ValueError("Invalid cell location.")
+            scope = (sheet_name.lower(), cell_range)
+        self.subscriptions.add(scope)
         self.notify_functions.append(notify_function)
 
+    @writer
+    def set_notify_dispatcher(self,
+                              dispatcher: Optional[NotifyDispatcher]) -> None:
+        '''
+        Sends notifications through a dispatcher, which calls the notify
+        functions in the background, instead of calling them before each
+        operation returns. A notify function then gets the cells that changed
+        in a burst of operations in one call, and can read the workbook from
+        its own thread. See notify_dispatcher.py for how the dispatchers merge
+        and bound the notifications waiting for each notify function.
+
+            dispatcher = sheets.NotifyDispatcher(policy=sheets.BLOCK)
+            wb.set_notify_dispatcher(dispatcher)
+            ...
+            dispatcher.join()
+
+        A dispatcher that is replaced keeps sending what it had queued until
+        it is closed.
+
+        Parameters:
+            dispatcher (NotifyDispatcher): the dispatcher, or None to call the
+                notify functions directly again
+        '''
+        self.notify_dispatcher = dispatcher
+
     # @lru_cache()
+    @writer
+    @eager
     def rename_sheet(self, sheet_name: str, new_sheet_name: str) -> None:
         '''
         Renames the specified sheet to the new sheet name. All cell formulas
@@ -838,10 +1683,6 @@ class Workbook:
             raise ValueError('Invalid new spreadsheet name.')
 
         sheet_name = sheet_name.lower()
-        #print(sheet_name)
-        #print(self.forward_graph)
-
-
         self.notify_cells_master = set()
 
         new_sheet_name_lower = new_sheet_name.lower()
@@ -852,59 +1693,47 @@ class Workbook:
                 break
             index += 1
 
+        def renamed(cell):
+            if cell[0] == sheet_name:
+                return (new_sheet_name_lower, cell[1])
+            return cell
+
+        # formulas that referred to the new name before any sheet had it now
+        # read the renamed sheet, and formulas that build a sheet's name for
+        # INDIRECT may no longer find the old one; every other value stays
+        # the same, since only the name of the sheet changed
+        update_cells = {renamed(cell) for cell
+                        in self.graph.sheet_dependents(new_sheet_name_lower)}
+
         # updating cell contents/references to new sheet name
-        if sheet_name in self.forward_graph:
-            for start_cell in self.forward_graph[sheet_name].keys():
-                for cell_tuple in self.forward_graph[sheet_name][start_cell]:
-                    if cell_tuple[1] not in self.sheets[cell_tuple[0]].cells:
-                        continue
-                    self.sheets[cell_tuple[0]].change_contents_sheet_ref(
-                        self,
-                        cell_tuple[1],
-                        sheet_name,
-                        new_sheet_name)
-
-        # updating backward graph
-        if sheet_name in self.backward_graph:
-            for start_cell in self.backward_graph[sheet_name].keys():
-                for cell_tuple in self.backward_graph[sheet_name][start_cell]:
-                    forward_cells = self.forward_graph[cell_tuple[0]]
-                    if (cell_tuple[0] in self.forward_graph and
-                       cell_tuple[1] in forward_cells):
-                        for i in range(len(forward_cells[cell_tuple[1]])):
-                            if forward_cells[cell_tuple[1]][i] == (sheet_name,
-                                                                   start_cell):
-                                forward_cells[cell_tuple[1]][i] = (
-                                    new_sheet_name_lower, start_cell)
-            del self.backward_graph[sheet_name]
+        for cell_tuple in self.graph.sheet_dependents(sheet_name):
+            if (cell_tuple[0] not in self.sheets or
+                    cell_tuple[1] not in self.sheets[cell_tuple[0]].cells):
+                continue
+            sheet = self.sheets[cell_tuple[0]]
+            sheet.change_contents_sheet_ref(cell_tuple[1], sheet_name,
+                                            new_sheet_name)
+            formula = sheet.cells[cell_tuple[1]].formula
+            if formula is not None and formula.uses_indirect():
+                update_cells.add(renamed(cell_tuple))
+
+        self.graph.rename_sheet(sheet_name, new_sheet_name_lower)
+        self.subscriptions.rename_sheet(sheet_name, new_sheet_name_lower)
+        # cells set in an open batch are recalculated under the new name
+        self.batch_cells = {renamed(cell): value for (cell, value)
+                            in self.batch_cells.items()}
         self.sheets[new_sheet_name_lower] = self.sheets[sheet_name]
         del self.sheets[sheet_name]
         self.sheet_names[new_sheet_name_lower] = new_sheet_name
         del self.sheet_names[sheet_name]
-
-        # updating forward graph
         self.move_sheet(new_sheet_name_lower, index)
-        if sheet_name in self.forward_graph:
-            if new_sheet_name_lower not in self.forward_graph:
-                self.forward_graph[new_sheet_name_lower] = \
-                    self.forward_graph[sheet_name]
-            else:
-                new_forward_graph = self.forward_graph[new_sheet_name_lower]
-                for (key, value) in self.forward_graph[sheet_name].items():
-                    if key in new_forward_graph:
-                        for i in value:
-                            if i not in new_forward_graph[key]:
-                                new_forward_graph[key].append(i)
-                    else:
-                        self.forward_graph[new_sheet_name_lower][key] = value
-            del self.forward_graph[sheet_name]
-
-        if new_sheet_name_lower in self.forward_graph:
-            for cell in self.forward_graph[new_sheet_name_lower]:
-                self.update_workbook(new_sheet_name_lower, cell)
+
+        if update_cells:
+            self.update_cells(list(update_cells))
 
         self.send_notify_cells_to_functions()
 
+    @writer
     def move_sheet(self, sheet_name: str, index: int) -> None:
         '''
         Moves the specified sheet to the specified index in the workbook's
@@ -952,6 +1781,8 @@ class Workbook:
         self.sheets = new_sheets
         self.sheet_names = new_sheet_names
 
+    @writer
+    @eager
     def copy_sheet(self, sheet_name: str) -> Tuple[int, str]:
         '''
         Makes a copy of the specified sheet, storing the copy at the end of
@@ -995,61 +1826,37 @@ class Workbook:
         case_sheet_name = self.sheet_names[sheet_name]
         curr_case = case_sheet_name + '_' + str(counter)
 
-        curr_lower = curr_case.lower()
-        # the thing with copy is that we are not recalculating any cells, and we only need to copy the values
-        # over and then repo
-
+        # the copy shares its cells with the sheet until either is changed,
+        # and has the same values, except in formulas that refer to the copy
+        # by its name, which did not exist when they were evaluated
         self.new_sheet(curr_case, is_copy=True)
+        self.sheets[curr] = self.sheets[sheet_name].copy()
+        update_cells = self.graph.sheet_dependents(curr)
+
+        # references to the sheet itself now point at the copy
+        added = []
+        for (location, cell) in self.sheets[curr].cells.items():
+            # cells opened from a binary workbook keep their sheet_name_dict
+            # but have not compiled their formula yet
+            if cell.sheet_name_dict is None:
+                continue
+            added.append((curr, location) +
+                         self.resolve_refs(curr, cell.refs))
+            if any(ref[0] == curr for ref in cell.refs):
+                update_cells.add((curr, location))
+        self.graph.add_cells(added)
 
-        for (location, cell_dict) in self.sheets[sheet_name].cells.items():
-            tree = cell_dict['tree']
-            contents = cell_dict['contents']
-            value = cell_dict['value']
-            calculated_refs = cell_dict['calculated_refs']
-
-            #self.set_cell_contents(curr_lower, location, contents)
-
-            if tree is None:
-                self.sheets[curr_lower].set_cell_value(location, contents, value)
-                if contents is None:
-                    return
-            if tree is not None:
-                inherit_cells, sheet_name_dict = self.tree_dfs(tree, sheet_name, tuple(calculated_refs))
-                self.sheets[curr_lower].set_cell_value(location, contents, value, tree, sheet_name_dict)
-                
-                for i in inherit_cells:
-                    curr_name = i[0].lower()
-                    curr_loc = i[1].lower()
-                    if curr_name in self.forward_graph:
-                        if curr_loc in self.forward_graph[curr_name]:
-                            if (curr_lower, location) not in self.forward_graph[curr_name][curr_loc]:
-                                self.forward_graph[curr_name][curr_loc].append((curr_lower, location))
-                        else:
-                            self.forward_graph[curr_name][curr_loc] = [(curr_lower, location)]
-                            
-                    else:
-                        self.forward_graph[curr_name] = {curr_loc: [(curr_lower, location)]}
-
-                if curr_lower in self.backward_graph:
-                    self.backward_graph[curr_lower][location] = inherit_cells
-                else:
-                    self.backward_graph[curr_lower] = {location: inherit_cells}
-            
-        
         notify_cells = []
         for cell in self.sheets[curr].cells:
-            notify_cells.append((self.sheet_names[curr], cell.upper()))
+            notify_cells.append((curr_case, cell.upper()))
 
-        if curr in self.forward_graph:
-            curr_forward_graph = deepcopy(self.forward_graph[curr])
-            for cell in curr_forward_graph:
-                self.update_workbook(curr, cell)
-            
+        if update_cells:
+            self.update_cells(list(update_cells))
 
         self.update_notify_cells_master(notify_cells)
         self.send_notify_cells_to_functions()
-    
-        return (len(self.sheets) - 1, case_sheet_name + '_' + str(counter))
+
+        return (len(self.sheets) - 1, curr_case)
 
     def num_to_col(self, num):
         res = ''
@@ -1086,6 +1893,107 @@ class Workbook:
         bot_right = self.num_to_col(right_col_num) + str(bot_row)
         return top_left, bot_right
 
+    def write_cells(self, writes, emptied=(), reported=()):
+        '''
+        Helper method that writes many cells as one change, for moving,
+        copying and sorting. Every cell is stored first, then the workbook is
+        recalculated once and the notify functions are called once. Compiled
+        formulas are stored without being evaluated, so the recalculation
+        evaluates each of them once, after the cells it depends on.
+
+        In lazy mode and inside a batch the cells are set one by one, since
+        recalculation is deferred there already.
+
+        Parameters:
+            writes (list): (sheet name, location, contents, formula) tuples
+                with lower case names and locations, where formula is the
+                compiled formula of the contents or None
+            emptied (list): (sheet name, location) tuples of cells to empty
+            reported (list): (sheet name, location) tuples of cells to report
+                to the notify functions even if their values did not change
+        '''
+        if self.lazy or self.batch_depth > 0:
+            for (sheet_name, location) in emptied:
+                self.internal_set_cell_contents(sheet_name, location, None,
+                                                is_new=True, internal_call=True)
+            for (sheet_name, location, contents, formula) in writes:
+                self.internal_set_cell_contents(sheet_name, location, contents,
+                                                is_new=True, internal_call=True,
+                                                formula=formula)
+            return
+
+        self.notify_cells_master = set()
+        # maps the cells that were evaluated as they were stored to their
+        # values from before
+        evaluated_values = {}
+        cells = []
+        for (sheet_name, location) in emptied:
+            evaluated_values[(sheet_name, location)] = \
+                self.sheets[sheet_name].get_cell_value(location)
+            self.sheets[sheet_name].delete_cell(location)
+            self.graph.clear_precedents(sheet_name, location)
+            cells.append((sheet_name, location))
+        staged = []
+        for (sheet_name, location, contents, formula) in writes:
+            old_value = self.sheets[sheet_name].get_cell_value(location)
+            if self.stage_cell(sheet_name, location, contents, formula):
+                evaluated_values[(sheet_name, location)] = old_value
+            else:
+                staged.append((sheet_name, location, contents, formula))
+            cells.append((sheet_name, location))
+
+        # a formula with IF or IFERROR is staged with the references of all
+        # its branches, which can put it in a cycle it is not in; like a
+        # formula that is set, it is first evaluated as if it were not in a
+        # cycle, so it only depends on the references it reads
+        for (sheet_name, location, contents, formula) in staged:
+            if formula.has_branches():
+                self.restage_cell(sheet_name, location, contents, formula)
+
+        self.update_cells(cells, evaluated_values)
+        self.update_notify_cells_master(
+            [(self.sheet_names[sheet_name], location.upper())
+             for (sheet_name, location) in reported])
+        self.send_notify_cells_to_functions()
+
+    def stage_cell(self, sheet_name, location, contents, formula):
+        '''
+        Helper method that stores a cell's new contents for write_cells().
+        Contents without a compiled formula are evaluated straight away. A
+        compiled formula is stored with the references it may read, and the
+        cell keeps its old value until update_cells() evaluates it.
+
+        Returns:
+            bool: whether the cell was evaluated
+        '''
+        if formula is None:
+            contents, value, formula, refs = self.calculate_contents(
+                sheet_name, contents)
+            self.store_cell(sheet_name, location, contents, value, formula,
+                            refs)
+            return True
+        sheet = self.sheets[sheet_name]
+        refs = formula.get_refs({})
+        sheet.set_cell_value(location, contents, sheet.get_cell_value(location),
+                             formula, formula.sheet_name_dict, refs)
+        self.graph.set_precedents(sheet_name, location,
+                                  *self.resolve_refs(sheet_name, refs))
+        return False
+
+    def restage_cell(self, sheet_name, location, contents, formula):
+        '''
+        Helper method that evaluates a formula staged by stage_cell() outside
+        any cycle, and makes the references it read its precedents. The cell
+        keeps its old value until update_cells() evaluates it again.
+        '''
+        _, _, _, refs = self.calculate_contents(sheet_name, contents,
+                                                formula=formula)
+        sheet = self.sheets[sheet_name]
+        sheet.set_cell_value(location, contents, sheet.get_cell_value(location),
+                             formula, formula.sheet_name_dict, refs)
+        self.graph.set_precedents(sheet_name, location,
+                                  *self.resolve_refs(sheet_name, refs))
+
     def move_copy_helper(self, sheet_name: str, start_location: str,
             end_location: str, to_location: str, to_sheet: Optional[str] = None, is_move = False):
         
@@ -1122,38 +2030,34 @@ class Workbook:
         if final_col > self.col_to_num('zzzz') or final_row > 9999:
             raise ValueError("Cells are out of bounds.")
         
-        # map from initial cell to final cell
-        change_cells = {}
-
-        notify_cells = []
+        # the relocated contents of every cell in the source area, found
+        # before anything is written because the areas may overlap
+        sheet = self.sheets[sheet_name]
+        writes = []
+        targets = set()
+        moved = []
         for row in range(int(top_left_row), int(bot_right_row) + 1):
             for col_num in range(self.col_to_num(top_left_col), self.col_to_num(bot_right_col) + 1):
                 cell_location = self.num_to_col(col_num) + str(row)
-                if cell_location in self.sheets[sheet_name].cells:
-                    change_cells[(col_num, row)] = self.sheets[sheet_name].cells[cell_location]
-                    if is_move:
-                        notify_cells.append((self.sheet_names[sheet_name], cell_location.upper()))
-                        del self.sheets[sheet_name].cells[cell_location]
-                else:
-                    change_cells[(col_num, row)] = None
-
-        for ((col_num, row), cell_dict) in change_cells.items():
-            new_contents = self.sheets[sheet_name].update_cell_references(self, cell_dict, col_diff, row_diff)
-            new_col = self.num_to_col(col_num + col_diff)
-            new_row = row + row_diff
-            new_ref = new_col + str(new_row)
-            prev_val = self.get_cell_value(to_sheet, new_ref)
-            self.set_cell_contents(to_sheet, new_ref, new_contents)
-            new_val = self.get_cell_value(to_sheet, new_ref)
-            if not isinstance(prev_val, CellError):
-                if prev_val != new_val:
-                    notify_cells.append((self.sheet_names[to_sheet], new_ref.upper()))
-            elif isinstance(new_val, CellError) and prev_val.get_type() != new_val.get_type():
-                notify_cells.append((self.sheet_names[to_sheet], new_ref.upper()))
-
-        self.update_notify_cells_master(notify_cells)
-        self.send_notify_cells_to_functions()
-
+                cell = sheet.cells.get(cell_location)
+                if cell is not None:
+                    moved.append((sheet_name, cell_location))
+                new_contents, formula = sheet.update_cell_references(
+                    cell, col_diff, row_diff)
+                new_ref = self.num_to_col(col_num + col_diff) + str(row + row_diff)
+                writes.append((to_sheet, new_ref, new_contents, formula))
+                targets.add((to_sheet, new_ref))
+
+        if not is_move:
+            self.write_cells(writes)
+            return
+        # the moved cells that are not also in the target area are emptied,
+        # and every moved cell is reported
+        self.write_cells(writes, [cell for cell in moved if cell not in targets],
+                         moved)
+
+    @writer
+    @eager
     def move_cells(self, sheet_name: str, start_location: str,
             end_location: str, to_location: str, to_sheet: Optional[str] = None) -> None:
         '''
@@ -1200,6 +2104,8 @@ class Workbook:
         '''
         self.move_copy_helper(sheet_name, start_location, end_location, to_location, to_sheet, is_move=True)
         
+    @writer
+    @eager
     def copy_cells(self, sheet_name: str, start_location: str,
             end_location: str, to_location: str, to_sheet: Optional[str] = None) -> None:
         '''
@@ -1246,50 +2152,8 @@ class Workbook:
         '''
         self.move_copy_helper(sheet_name, start_location, end_location, to_location, to_sheet, is_move=False)
         
-    def cmp_rows(self, x, y):
-        x_cell_val = x.get_cell_to_compare()
-        y_cell_val = y.get_cell_to_compare()
-
-        if x_cell_val == y_cell_val: 
-            return 0 
-        if x_cell_val is None:
-            return -1
-        if y_cell_val is None:
-            return 1
-        if isinstance(x_cell_val, CellError) and isinstance(y_cell_val, CellError):
-            x_error_type = x_cell_val.get_type().value
-            y_error_type = y_cell_val.get_type().value
-            if x_error_type == y_error_type:
-                return 0
-            if x_error_type < y_error_type:
-                return -1
-            return 1
-        # only one value is a CellError
-        if isinstance(x_cell_val, CellError):
-            return -1
-        if isinstance(y_cell_val, CellError):
-            return 1
-        if type(x_cell_val) != type(y_cell_val):
-            if type(x_cell_val) == bool:
-                return 1
-            elif type(x_cell_val) == str:
-                if type(y_cell_val) == bool:
-                    return -1
-                else:
-                    return 1
-            else:
-                return -1
-        elif type(x_cell_val) == str:
-            if x_cell_val.lower() == y_cell_val.lower():
-                return 0
-            if x_cell_val.lower() < y_cell_val.lower():
-                return -1
-            return 1
-        if x_cell_val < y_cell_val:
-            return -1
-        if x_cell_val > y_cell_val:
-            return 1
-
+    @writer
+    @eager
     def sort_region(self, sheet_name: str, start_location: str, end_location: str, sort_cols: List[int]):
         '''
         Sort the specified region of a spreadsheet with a stable sort, using
@@ -1361,88 +2225,46 @@ class Workbook:
                 or 0 in abs_sort_cols):
             raise ValueError("Invalid columns to be sorted on.")
 
-        # start sorting
-        row_lst = []
         num_top_left_col = self.col_to_num(top_left_col)
         num_bot_right_col = self.col_to_num(bot_right_col)
-        for i in range(int(top_left_row), int(bot_right_row) + 1):
-            cell_values = []
-            cell_dict_lst = []
-            for j in range(num_top_left_col, num_bot_right_col + 1):
-                curr_loc = f'{self.num_to_col(j)}{i}'
-                cell_values.append(self.get_cell_value(sheet_name, curr_loc))
-                if curr_loc not in self.sheets[sheet_name].cells:
-                    cell_dict = {'contents': None,
-                                'value': None,
-                                'tree': None,
-                                'sheet_name_dict': None,
-                                'calculated_refs':[]}
-                    cell_dict_lst.append(cell_dict)
-                else:
-                    cell_dict_lst.append(self.sheets[sheet_name].cells[curr_loc])
-            row_lst.append(Row(cell_values, i, sort_cols.copy(), cell_dict_lst))
-        
-        #sorted_rows = [i for i in range(top_left_row, bot_right_row + 1)]
-        range_of_equals = [(0, int(bot_right_row) - int(top_left_row) + 1)]
         len_cols = num_bot_right_col - num_top_left_col + 1
-        is_reverse = False
-        col_counter = 0
-        while col_counter < len(sort_cols) and range_of_equals != []:
-            col = sort_cols[col_counter]
-            #print(col_counter)
-            if abs(col) > len_cols:
-                raise ValueError("Column out of bounds.")
+        if max(abs_sort_cols) > len_cols:
+            raise ValueError("Column out of bounds.")
+
+        # each row of the region as its number and its cells
+        sheet = self.sheets[sheet_name]
+        cols = [self.num_to_col(j)
+                for j in range(num_top_left_col, num_bot_right_col + 1)]
+        rows = [(i, [sheet.cells.get(col + str(i), EMPTY_CELL)
+                     for col in cols])
+                for i in range(int(top_left_row), int(bot_right_row) + 1)]
+
+        # the keys of each sort column; a descending column is keyed by the
+        # negated rank of each value among the column's distinct values
+        col_keys = []
+        for col in sort_cols:
+            keys = [sort_key(cells[abs(col) - 1].value) for (_, cells) in rows]
             if col < 0:
-                #print(f'hello: {col}')
-                is_reverse = True
-            else: 
-                #print(f'hi: {col}')
-                is_reverse = False
-
-            # how are we going to do the sorting, we need to be able to sort the list
-            for (start, end) in range_of_equals:
-                row_lst[start:end + 1] = sorted(row_lst[start:end + 1], key=cmp_to_key(self.cmp_rows), reverse=is_reverse)
-            # finding the ones that need to be resorted
-            new_range_of_equals = []
-            # range_stack = []
-            for (start, end) in range_of_equals:
-                #print(start, end)
-                range_stack = []
-                for i in range(start + 1, end):
-                    #print(row_lst[i].cell_values)
-                    #print(row_lst[i - 1].cell_values)
-                    if self.cmp_rows(row_lst[i], row_lst[i - 1]) == 0:
-                        row_lst[i - 1].increment_col()
-                        if len(range_stack) == 0:
-                            range_stack.append(i - 1)
-                            range_stack.append(i)
-                        else:
-                            range_stack.append(i)
-                        # if i == end - 1:
-                        #     new_range_of_equals.append((range_stack[0], range_stack[-1]))
-                if len(range_stack) != 0:
-                    new_range_of_equals.append((range_stack[0], range_stack[-1]))
-                # CHECK IF CORRECT
-                row_lst[end - 1].increment_col()
-                    #   range_stack.append(i)   
-            #print(new_range_of_equals)
-            range_of_equals = new_range_of_equals
-            col_counter += 1
-
-        notify_cells = []
-        for row_idx in range(0, len(row_lst)):
-            row = row_lst[row_idx]
-            old_row = row.row
+                ranks = {key: -rank
+                         for (rank, key) in enumerate(sorted(set(keys)))}
+                keys = [ranks[key] for key in keys]
+            col_keys.append(keys)
+        row_keys = list(zip(*col_keys))
+        row_lst = [rows[i] for i in sorted(range(len(rows)),
+                                           key=row_keys.__getitem__)]
+
+        writes = []
+        for (row_idx, (old_row, cells)) in enumerate(row_lst):
             new_row = row_idx + int(top_left_row)
             for j in range(num_top_left_col, num_bot_right_col + 1):
-                cell_dict = row.cell_dict_lst[j - num_top_left_col]
-                new_contents = self.sheets[sheet_name].update_cell_references(self, cell_dict, 0, new_row-old_row)
+                cell = cells[j - num_top_left_col]
+                new_contents, formula = sheet.update_cell_references(
+                    cell, 0, new_row - old_row)
                 new_loc = f'{self.num_to_col(j)}{new_row}'
-                self.set_cell_contents(sheet_name, new_loc, new_contents)
-                notify_cells.append((sheet_name, new_loc))
+                writes.append((sheet_name, new_loc, new_contents, formula))
 
-        self.update_notify_cells_master(notify_cells)
-        self.send_notify_cells_to_functions()
+        self.write_cells(writes, reported=[(sheet_name, location) for
+                                           (sheet_name, location, _, _) in writes])
 
 
 
@@ -1451,12 +2273,12 @@ wb = Workbook()
 _, sheet1 = wb.new_sheet()
 
 #wb.set_cell_contents(sheet1, 'a1', '=MIN(b2:c5)')
-#print(parse_contents(wb.parser, wb.parsed_trees, sheet1, '=a1', wb))
-#print(parse_contents(wb.parser, wb.parsed_trees, sheet1, f'=a2:a5>7', wb))
-#print(parse_contents(wb.parser, wb.parsed_trees, sheet1, '=SUM(choose(1, a4:c5))', wb))
+#print(parse_contents(sheet1, '=a1', wb))
+#print(parse_contents(sheet1, f'=a2:a5>7', wb))
+#print(parse_contents(sheet1, '=SUM(choose(1, a4:c5))', wb))
 #wb.set_cell_contents(sheet1, 'b1', '1')
 #wb.copy_sheet()
 #wb.set_cell_contents('sheet1_1', 'b1', 'b1')
 
-#print(parse_contents(wb.parser, wb.parsed_trees, sheet1, '=ISERROR(b1 & 5)', wb))
-#print(parse_contents(wb.parser, wb.parsed_trees, sheet1, '=isblank("a2")', wb))
+#print(parse_contents(sheet1, '=ISERROR(b1 & 5)', wb))
+#print(parse_contents(sheet1, '=isblank("a2")', wb))
@@ -1,6 +1,14 @@
 from pstats import Stats
 import unittest
 import cProfile
+import io
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+import lark
 import sheets
 
 
@@ -53,6 +61,190 @@ class TestLargeOpPerformance(unittest.TestCase):
             wb.load_workbook(f)
             self.disable_profile(profiler, 10)
 
+    def test_load_workbook_scaling(self):
+        '''
+        Test how loading scales with the number of cells, for sheets of
+        formulas that refer to cells loaded after them.
+        '''
+        num_cols = 10
+        for num_rows in [500, 2000, 9000]:
+            cells = {}
+            for i in range(1, num_cols + 1):
+                col = self.num_to_col(i)
+                for j in range(1, num_rows + 1):
+                    if j == num_rows:
+                        cells[f'{col}{j}'] = str(i)
+                    elif i == 1:
+                        cells[f'{col}{j}'] = f'={col}{j + 1} + 1'
+                    else:
+                        prev_col = self.num_to_col(i - 1)
+                        cells[f'{col}{j}'] = f'={col}{j + 1} + {prev_col}{j}'
+            document = json.dumps({'sheets': [{'name': 'Sheet1',
+                                               'cell-contents': cells}]})
+
+            start = time.perf_counter()
+            sheets.Workbook.load_workbook(io.StringIO(document))
+            load_time = time.perf_counter() - start
+            print(f'load {len(cells)} cells: {load_time * 1000:.0f} ms, '
+                  f'{load_time * 1e6 / len(cells):.1f} us per cell')
+
+    def test_cell_memory(self):
+        '''
+        Test how many bytes each cell takes up, for literal cells and for
+        formula cells, not counting the compiled formulas they share.
+        '''
+        num_cells = 9000
+        for kind in ['literal', 'formula']:
+            wb = sheets.Workbook()
+            (_, name) = wb.new_sheet()
+            if kind == 'literal':
+                contents = {f'a{i}': str(i) for i in range(1, num_cells + 1)}
+            else:
+                contents = {f'b{i}': '=a1 * 2' for i in range(1, num_cells + 1)}
+                # compile the formula before measuring
+                wb.set_cell_contents(name, 'c1', '=a1 * 2')
+            tracemalloc.start()
+            wb.set_cells_contents(name, contents)
+            used = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print(f'{kind} cells: {used / num_cells:.0f} bytes per cell')
+
+    def test_range_dependency_memory(self):
+        '''
+        Test the memory used by the dependency graph and the time to update
+        a workbook of many formulas that each aggregate a wide range.
+        '''
+        num_formulas = 200
+        range_rows = 5000
+        formulas = {f'b{i}': f'=SUM(a1:a{range_rows}) + {i}'
+                    for i in range(1, num_formulas + 1)}
+        times = []
+        for trace in [False, True]:
+            wb = sheets.Workbook()
+            (_, name) = wb.new_sheet()
+            wb.set_cells_contents(name, {f'a{i}': '1'
+                                         for i in range(1, range_rows + 1)})
+            if trace:
+                tracemalloc.start()
+            start = time.perf_counter()
+            wb.set_cells_contents(name, formulas)
+            times.append(time.perf_counter() - start)
+            if trace:
+                used = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+        start = time.perf_counter()
+        wb.set_cell_contents(name, 'a10', '2')
+        edit_time = time.perf_counter() - start
+        print(f'{num_formulas} formulas over {range_rows} cells: '
+              f'{used / 1e6:.2f} MB, set {times[0] * 1000:.1f} ms, '
+              f'edit {edit_time * 1000:.1f} ms')
+
+    def test_save_load_memory(self):
+        '''
+        Test the peak memory of saving and loading a workbook with many
+        sheets, comparing the streamed JSON against building the whole
+        document with json.dumps and json.load.
+        '''
+        num_sheets = 20
+        num_rows = 2500
+        wb = sheets.Workbook()
+        for _ in range(num_sheets):
+            (_, name) = wb.new_sheet()
+            wb.set_cells_contents(name, {f'a{i}': f'text in row {i}'
+                                         for i in range(1, num_rows + 1)})
+        document = {'sheets': [
+            {'name': wb.sheet_names[sheet_name], 'cell-contents':
+             {loc.upper(): cell.contents for (loc, cell) in
+              sheet.cells.items()}} for (sheet_name, sheet) in
+            wb.sheets.items()]}
+        (fd, path) = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            with open(path, 'w') as f:
+                tracemalloc.start()
+                f.write(json.dumps(document, indent=4))
+                dumps_peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            with open(path, 'w') as f:
+                tracemalloc.start()
+                wb.save_workbook(f)
+                stream_peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            print(f'save {num_sheets * num_rows} cells: json.dumps peak '
+                  f'{dumps_peak / 1e6:.1f} MB, streamed peak '
+                  f'{stream_peak / 1e6:.1f} MB')
+
+            with open(path, 'r') as f:
+                tracemalloc.start()
+                json.load(f)
+                load_peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            with open(path, 'r') as f:
+                tracemalloc.start()
+                start = time.perf_counter()
+                loaded_wb = sheets.Workbook.load_workbook(f)
+                load_time = time.perf_counter() - start
+                wb_size = tracemalloc.get_traced_memory()[0]
+                stream_peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.assertEqual(loaded_wb.num_sheets(), num_sheets)
+            print(f'load {num_sheets * num_rows} cells: json.load alone peak '
+                  f'{load_peak / 1e6:.1f} MB, streamed load peak '
+                  f'{stream_peak / 1e6:.1f} MB (of which '
+                  f'{(stream_peak - wb_size) / 1e6:.1f} MB above the loaded '
+                  f'workbook), {load_time * 1000:.0f} ms')
+        finally:
+            os.remove(path)
+
+    def test_binary_workbook_load(self):
+        '''
+        Test performance of opening a saved workbook of formulas, comparing
+        the JSON format, which recalculates every cell, against the binary
+        format, which reads the cached values and dependency graph.
+        '''
+        num_cols = 10
+        num_rows = 2000
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        cells = {}
+        for i in range(1, num_cols + 1):
+            col = self.num_to_col(i)
+            for j in range(1, num_rows + 1):
+                if j == num_rows:
+                    cells[f'{col}{j}'] = str(i)
+                elif i == 1:
+                    cells[f'{col}{j}'] = f'={col}{j + 1} + 1'
+                else:
+                    prev_col = self.num_to_col(i - 1)
+                    cells[f'{col}{j}'] = f'={col}{j + 1} + {prev_col}{j}'
+        wb.set_cells_contents(name, cells)
+
+        json_file = io.StringIO()
+        wb.save_workbook(json_file)
+        binary_file = io.BytesIO()
+        wb.save_workbook_binary(binary_file)
+
+        json_file.seek(0)
+        start = time.perf_counter()
+        sheets.Workbook.load_workbook(json_file)
+        json_time = time.perf_counter() - start
+
+        binary_file.seek(0)
+        start = time.perf_counter()
+        loaded_wb = sheets.Workbook.load_workbook_binary(binary_file)
+        binary_time = time.perf_counter() - start
+
+        binary_file.seek(0)
+        profiler = self.enable_profile()
+        sheets.Workbook.load_workbook_binary(binary_file)
+        self.disable_profile(profiler, 10)
+        self.assertEqual(loaded_wb.get_cell_value(name, 'j1'),
+                         wb.get_cell_value(name, 'j1'))
+        print(f'open {len(cells)} cells: json {json_time * 1000:.0f} ms '
+              f'({len(json_file.getvalue()) / 1e6:.1f} MB), binary '
+              f'{binary_time * 1000:.0f} ms '
+              f'({len(binary_file.getvalue()) / 1e6:.1f} MB)')
+
     def test_copy_sheet_performance(self):
         '''
         Test performance of a test that where a sheet with many cells is
@@ -70,6 +262,26 @@ class TestLargeOpPerformance(unittest.TestCase):
         #print(wb.sheets[name.lower()].cells)
         self.disable_profile(profiler, 10)
 
+    def test_copy_template_sheet_performance(self):
+        '''
+        Test performance of copying a sheet of formulas many times. The
+        copies share the cells of the sheet, and none of their formulas are
+        evaluated again.
+        '''
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        self.create_sheet(wb, name, 100, 100, None)
+        num_copies = 20
+
+        profiler = self.enable_profile()
+        start = time.perf_counter()
+        for _ in range(num_copies):
+            wb.copy_sheet(name)
+        copy_time = time.perf_counter() - start
+        self.disable_profile(profiler, 10)
+        print(f'{num_copies} copies of a 100x100 sheet: '
+              f'{copy_time * 1000:.1f} ms')
+
     def test_rename_sheet_no_cell_ref_performance(self):
         '''
         Test performance of a test that where a sheet with many cells is
@@ -89,7 +301,8 @@ class TestLargeOpPerformance(unittest.TestCase):
     def test_rename_sheet_cell_ref_update_performance(self):
         '''
         Test performance of a test that where a sheet with many cells is
-        renamed and all cells need to be recalculated.
+        renamed and every formula referring to it is rewritten, without
+        being parsed or recalculated.
         '''
         wb = sheets.Workbook()
         (_, name) = wb.new_sheet()
@@ -119,5 +332,97 @@ class TestLargeOpPerformance(unittest.TestCase):
         wb.move_cells(name, 'a1', 'a99', 'a100', new_name)
         self.disable_profile(profiler, 10)
 
+    def test_sort_region_performance(self):
+        '''
+        Test performance of sorting a 9,999-row region on several columns,
+        with many ties on the first columns and mixed value types.
+        '''
+        num_rows = 9999
+        values = ['1', '2', 'abc', 'ABD', 'true', '=1/0', '', '3.5']
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        contents = {}
+        for i in range(1, num_rows + 1):
+            contents[f'a{i}'] = values[i * 7 % len(values)]
+            contents[f'b{i}'] = values[i * 5 % len(values)]
+            contents[f'c{i}'] = str(i * 7919 % num_rows)
+        wb.set_cells_contents(name, contents)
+
+        profiler = self.enable_profile()
+        start = time.perf_counter()
+        wb.sort_region(name, 'a1', f'c{num_rows}', [1, -2, 3])
+        elapsed = time.perf_counter() - start
+        self.disable_profile(profiler, 10)
+        print(f'sort {num_rows} rows on 3 columns: {elapsed * 1000:.1f} ms')
+
+    def test_move_copy_block_parses(self):
+        '''
+        Test performance of copying and then moving a 500x500 block of
+        formulas, which relocates the compiled formulas instead of parsing
+        their text again.
+        '''
+        size = 500
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        contents = {}
+        for i in range(1, size + 1):
+            contents[f'a{i}'] = str(i)
+            for j in range(2, size + 1):
+                contents[f'{self.num_to_col(j)}{i}'] = \
+                    f'={self.num_to_col(j - 1)}{i} + $a$1'
+        wb.set_cells_contents(name, contents)
+        last_col = self.num_to_col(size)
+
+        parses = []
+        parse = lark.Lark.parse
+
+        def counting_parse(parser, text, *args, **kwargs):
+            parses.append(text)
+            return parse(parser, text, *args, **kwargs)
+
+        with mock.patch.object(lark.Lark, 'parse', counting_parse):
+            profiler = self.enable_profile()
+            start = time.perf_counter()
+            wb.copy_cells(name, 'a1', f'{last_col}{size}', f'a{size + 1}')
+            copy_time = time.perf_counter() - start
+            start = time.perf_counter()
+            wb.move_cells(name, 'a1', f'{last_col}{size}',
+                          f'{self.num_to_col(size + 1)}1')
+            move_time = time.perf_counter() - start
+            self.disable_profile(profiler, 10)
+        print(f'copy {size}x{size}: {copy_time * 1000:.1f} ms, '
+              f'move {size}x{size}: {move_time * 1000:.1f} ms, '
+              f'{len(parses)} parses')
+        self.assertEqual(parses, [])
+
+    def test_overlapping_move_performance(self):
+        '''
+        Test performance of moving a 200x200 block of formulas onto itself,
+        one row and one column over, which recalculates the workbook and
+        notifies once for the whole move.
+        '''
+        size = 200
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        contents = {}
+        for i in range(1, size + 1):
+            contents[f'a{i}'] = str(i)
+            for j in range(2, size + 1):
+                contents[f'{self.num_to_col(j)}{i}'] = \
+                    f'={self.num_to_col(j - 1)}{i} + $a$1'
+        wb.set_cells_contents(name, contents)
+        calls = []
+        wb.notify_cells_changed(lambda _, cells: calls.append(len(cells)))
+
+        profiler = self.enable_profile()
+        start = time.perf_counter()
+        wb.move_cells(name, 'a1', f'{self.num_to_col(size)}{size}', 'b2')
+        move_time = time.perf_counter() - start
+        self.disable_profile(profiler, 10)
+        print(f'overlapping move {size}x{size}: {move_time * 1000:.1f} ms, '
+              f'{len(calls)} notifications')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(wb.get_cell_contents(name, 'c2'), '=B2 + $A$1')
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,11 @@
 from pstats import Stats
 import unittest
 import cProfile
+import threading
+import time
+import lark
 import sheets
+from sheets.lark_impl import GRAMMAR_PATH
 
 
 class TestPerformance(unittest.TestCase):
@@ -63,6 +67,30 @@ class TestPerformance(unittest.TestCase):
         wb.set_cell_contents(name, 'a24', '20')
         self.disable_profile(profiler, 10)
 
+    def test_chain_recalculation(self):
+        '''
+        Test performance of repeatedly re-evaluating the same formulas along
+        long chains, both plain arithmetic and chains through functions.
+        '''
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        self.create_long_chains_refs(wb, name, 100, 1)
+        (_, func_name) = wb.new_sheet()
+        for i in range(1, 100):
+            wb.set_cell_contents(func_name, f'a{i}',
+                                 f'=IF(a{i + 1} > 0, a{i + 1} + 1, 0)')
+        wb.set_cell_contents(func_name, 'a100', '1')
+
+        num_updates = 20
+        profiler = self.enable_profile()
+        start = time.perf_counter()
+        for i in range(num_updates):
+            wb.set_cell_contents(name, 'a99', str(i))
+            wb.set_cell_contents(func_name, 'a100', str(i + 1))
+        update_time = (time.perf_counter() - start) / num_updates
+        self.disable_profile(profiler, 10)
+        print(f'chain recalculation: {update_time * 1000:.3f} ms per update')
+
     def test_long_cycles(self):
         '''
         Test performance of workbook with large cycles that contain many cells,
@@ -151,6 +179,328 @@ class TestPerformance(unittest.TestCase):
             wb.get_cell_value(name, f'a{i}')
         self.disable_profile(profiler, 10)
 
+    def test_large_range_aggregates(self):
+        '''
+        Test performance of recalculating aggregates over large, mostly empty
+        cell ranges.
+        '''
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        for i in range(1, 1001, 10):
+            wb.set_cell_contents(name, f'a{i}', str(i))
+        wb.set_cell_contents(name, 'ab1', '=SUM(A1:Z1000)')
+        wb.set_cell_contents(name, 'ab2', '=MAX(A1:Z1000)')
+        wb.set_cell_contents(name, 'ab3', '=AVERAGE(A1:Z1000)')
+
+        profiler = self.enable_profile()
+        for i in range(1, 101, 10):
+            wb.set_cell_contents(name, f'a{i}', str(i * 2))
+        self.disable_profile(profiler, 10)
+
+    def test_dense_range_aggregates(self):
+        '''
+        Test performance of recalculating aggregates over large ranges full
+        of numbers, which are taken from the sheet's numeric columns when
+        NumPy is installed.
+        '''
+        num_rows = 5000
+        num_edits = 20
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.set_cells_contents(name, {f'{col}{row}': str(row * 1.5 + i)
+                                     for (i, col) in enumerate('abcdefghij')
+                                     for row in range(1, num_rows + 1)})
+        wb.set_cells_contents(name, {
+            f'z{i}': f'={func}(A1:J{num_rows})' for (i, func) in
+            enumerate(['SUM', 'MIN', 'MAX', 'AVERAGE'] * 5, 1)})
+
+        profiler = self.enable_profile()
+        start = time.perf_counter()
+        for i in range(num_edits):
+            wb.set_cell_contents(name, 'b7', str(i))
+        elapsed = time.perf_counter() - start
+        self.disable_profile(profiler, 10)
+        print(f'{num_edits} edits under 20 aggregates of '
+              f'{num_rows * 10} cells: {elapsed * 1000:.1f} ms')
+
+    def test_batch_set_cells(self):
+        '''
+        Test performance of pasting many cells that feed shared formulas,
+        comparing one set_cell_contents call per cell against a batch.
+        '''
+        num_cells = 500
+        contents = {f'a{i}': str(i) for i in range(1, num_cells + 1)}
+        times = []
+        for use_batch in [False, True]:
+            wb = sheets.Workbook()
+            (_, name) = wb.new_sheet()
+            wb.set_cell_contents(name, 'b1', f'=SUM(a1:a{num_cells})')
+            for i in range(2, 51):
+                wb.set_cell_contents(name, f'b{i}', f'=b{i - 1} + a{i}')
+
+            profiler = self.enable_profile()
+            start = time.perf_counter()
+            if use_batch:
+                wb.set_cells_contents(name, contents)
+            else:
+                for (location, cell_contents) in contents.items():
+                    wb.set_cell_contents(name, location, cell_contents)
+            times.append(time.perf_counter() - start)
+            self.disable_profile(profiler, 10)
+        print(f'set {num_cells} cells: one at a time {times[0] * 1000:.1f} ms, '
+              f'batch {times[1] * 1000:.1f} ms')
+
+    def test_lazy_writes(self):
+        '''
+        Test performance of a workload that writes far more often than it
+        reads, comparing eager evaluation against lazy evaluation.
+        '''
+        num_writes = 200
+        times = []
+        for lazy in [False, True]:
+            wb = sheets.Workbook(lazy=lazy)
+            (_, name) = wb.new_sheet()
+            self.create_long_chains_refs(wb, name, 100, 1)
+
+            profiler = self.enable_profile()
+            start = time.perf_counter()
+            for i in range(num_writes):
+                wb.set_cell_contents(name, 'a99', str(i))
+                if i % 50 == 0:
+                    wb.get_cell_value(name, 'a1')
+            wb.flush()
+            times.append(time.perf_counter() - start)
+            self.disable_profile(profiler, 10)
+        print(f'{num_writes} writes, {num_writes // 50} reads: eager '
+              f'{times[0] * 1000:.1f} ms, lazy {times[1] * 1000:.1f} ms')
+
+    def test_shared_precedent_edits(self):
+        '''
+        Test performance of editing many formulas that all depend on the same
+        cell, so that every edit changes edges of a cell with many dependents.
+        '''
+        num_cells = 5000
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.set_cell_contents(name, 'a1', '1')
+        wb.set_cells_contents(name, {f'b{i}': '=a1 + 1'
+                                     for i in range(1, num_cells + 1)})
+
+        profiler = self.enable_profile()
+        start = time.perf_counter()
+        for i in range(1, num_cells + 1):
+            wb.set_cell_contents(name, f'b{i}', '=a1 * 2')
+        elapsed = time.perf_counter() - start
+        self.disable_profile(profiler, 10)
+        print(f'{num_cells} edits of cells sharing a precedent: '
+              f'{elapsed * 1000:.1f} ms')
+
+    def test_absorbed_fan_out_edits(self):
+        '''
+        Test performance of editing the inputs of a wide fan-out model where
+        most edits are absorbed close to the edited cell, by a value that does
+        not change, a clamp, or an IF branch that is not taken.
+        '''
+        num_dependents = 2000
+        num_edits = 200
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.set_cell_contents(name, 'a1', '0')
+        wb.set_cell_contents(name, 'a2', '=IF(a1 > 1000, a1, 0)')
+        wb.set_cell_contents(name, 'a3', '=MIN(a1, 10)')
+        contents = {}
+        for i in range(1, num_dependents + 1):
+            contents[f'b{i}'] = f'=a2 + a3 * {i}'
+            contents[f'c{i}'] = f'=b{i} * 2'
+        wb.set_cells_contents(name, contents)
+
+        profiler = self.enable_profile()
+        start = time.perf_counter()
+        for i in range(num_edits):
+            # only the first few edits change a3, the rest are absorbed
+            wb.set_cell_contents(name, 'a1', str(10 + i))
+        absorbed = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(10):
+            wb.set_cell_contents(name, 'a1', str(i % 2))
+        propagated = (time.perf_counter() - start) / 10
+        self.disable_profile(profiler, 10)
+        print(f'{num_edits} absorbed edits above {2 * num_dependents} '
+              f'dependents: {absorbed * 1000:.1f} ms, one propagated edit '
+              f'{propagated * 1000:.1f} ms')
+
+    def test_parallel_recalculation_scaling(self):
+        '''
+        Test performance of recalculating wide levels of independent formulas
+        with different numbers of worker processes.
+        '''
+        num_cells = 5000
+        num_edits = 5
+        for num_workers in [0, 1, 2, 4]:
+            wb = sheets.Workbook()
+            (_, name) = wb.new_sheet()
+            contents = {'a1': '1'}
+            for i in range(1, num_cells + 1):
+                contents[f'b{i}'] = f'=a1 * {i} + {i} / 7'
+                contents[f'c{i}'] = f'=IF(b{i} > {i}, b{i} - {i}, b{i})'
+                contents[f'd{i}'] = f'=IFERROR(c{i} * c{i} / {i}, 0) & ""'
+            wb.set_cells_contents(name, contents)
+            wb.set_workers(num_workers)
+
+            profiler = self.enable_profile()
+            start = time.perf_counter()
+            for edit in range(num_edits):
+                wb.set_cell_contents(name, 'a1', str(edit + 2))
+            elapsed = time.perf_counter() - start
+            self.disable_profile(profiler, 10)
+            wb.set_workers(0)
+            print(f'{num_edits} edits reaching {3 * num_cells} cells with '
+                  f'{num_workers} workers: {elapsed * 1000:.1f} ms')
+
+    def test_concurrent_reads(self):
+        '''
+        Test read throughput with different numbers of reader threads, while
+        another thread edits a cell that every value depends on every 10 ms.
+        '''
+        num_cells = 1000
+        duration = 1
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.set_cell_contents(name, 'a1', '0')
+        wb.set_cells_contents(name, {f'b{i}': f'=a1 + {i}'
+                                     for i in range(1, num_cells + 1)})
+
+        for num_readers in [1, 2, 4]:
+            done = threading.Event()
+            edits = []
+            reads = []
+
+            def write():
+                while not done.wait(0.01):
+                    wb.set_cell_contents(name, 'a1', str(len(edits)))
+                    edits.append(None)
+
+            def read():
+                num_reads = 0
+                while not done.is_set():
+                    wb.get_cell_value(name, f'b{num_reads % num_cells + 1}')
+                    num_reads += 1
+                reads.append(num_reads)
+
+            threads = [threading.Thread(target=write)]
+            threads += [threading.Thread(target=read)
+                        for _ in range(num_readers)]
+            for thread in threads:
+                thread.start()
+            time.sleep(duration)
+            done.set()
+            for thread in threads:
+                thread.join()
+            print(f'{num_readers} readers: {sum(reads) / duration:.0f} '
+                  f'reads/s, {len(edits)} edits')
+
+    def test_slow_notify_function(self):
+        '''
+        Test performance of edits while a notify function takes 5 ms to
+        return, calling it directly and through a notify dispatcher.
+        '''
+        num_edits = 200
+        for dispatcher in [None, sheets.NotifyDispatcher()]:
+            wb = sheets.Workbook()
+            (_, name) = wb.new_sheet()
+            wb.set_cell_contents(name, 'b1', '=a1 * 2')
+            calls = []
+            wb.notify_cells_changed(
+                lambda _, cells: (time.sleep(0.005), calls.append(cells)))
+            wb.set_notify_dispatcher(dispatcher)
+
+            profiler = self.enable_profile()
+            start = time.perf_counter()
+            for i in range(num_edits):
+                wb.set_cell_contents(name, 'a1', str(i))
+            elapsed = time.perf_counter() - start
+            self.disable_profile(profiler, 10)
+            if dispatcher is not None:
+                dispatcher.close()
+            mode = 'direct' if dispatcher is None else 'dispatcher'
+            print(f'{num_edits} edits with a slow notify function, {mode}: '
+                  f'{elapsed * 1000:.1f} ms, {len(calls)} calls')
+
+    def test_scoped_notifications(self):
+        '''
+        Test performance of edits that recalculate many cells, with no notify
+        function, one that watches a small range away from the edits, and one
+        that watches the whole workbook.
+        '''
+        num_cells = 2000
+        num_edits = 20
+        for scope in [None, ('Sheet1', 'z1', 'z10'), ()]:
+            wb = sheets.Workbook()
+            (_, name) = wb.new_sheet()
+            contents = {'a1': '0'}
+            for i in range(1, num_cells + 1):
+                contents[f'b{i}'] = f'=a1 + {i}'
+            for i in range(1, 11):
+                contents[f'z{i}'] = f'=b{i} * 2'
+            wb.set_cells_contents(name, contents)
+            if scope is not None:
+                wb.notify_cells_changed(lambda *_: None, *scope)
+
+            profiler = self.enable_profile()
+            start = time.perf_counter()
+            for edit in range(num_edits):
+                wb.set_cell_contents(name, 'a1', str(edit + 1))
+            elapsed = time.perf_counter() - start
+            self.disable_profile(profiler, 10)
+            watching = ('nothing' if scope is None else
+                        'a range' if scope else 'the workbook')
+            print(f'{num_edits} edits watching {watching}: '
+                  f'{elapsed * 1000:.1f} ms')
+
+    def test_workbook_construction(self):
+        '''
+        Test performance of creating many short-lived workbooks, comparing the
+        shared LALR parser against compiling an Earley parser per workbook.
+        '''
+        num_workbooks = 20
+        start = time.perf_counter()
+        for _ in range(num_workbooks):
+            lark.Lark.open(GRAMMAR_PATH, start='formula')
+        earley_time = (time.perf_counter() - start) / num_workbooks
+
+        profiler = self.enable_profile()
+        start = time.perf_counter()
+        for _ in range(num_workbooks):
+            sheets.Workbook()
+        lalr_time = (time.perf_counter() - start) / num_workbooks
+        self.disable_profile(profiler, 10)
+        print(f'workbook construction: earley {earley_time * 1000:.3f} ms, '
+              f'shared lalr {lalr_time * 1000:.3f} ms')
+
+    def test_formula_parsing(self):
+        '''
+        Test performance of parsing many distinct formulas, comparing the
+        Earley parser against the shared LALR parser.
+        '''
+        formulas = [f'=a{i} + b{i} * Sheet1!c{i} - SUM(d1:d5, {i})'
+                    for i in range(1, 501)]
+        earley_parser = lark.Lark.open(GRAMMAR_PATH, start='formula')
+        lalr_parser = sheets.Workbook().parser
+
+        start = time.perf_counter()
+        for formula in formulas:
+            earley_parser.parse(formula)
+        earley_time = (time.perf_counter() - start) / len(formulas)
+
+        profiler = self.enable_profile()
+        start = time.perf_counter()
+        for formula in formulas:
+            lalr_parser.parse(formula)
+        lalr_time = (time.perf_counter() - start) / len(formulas)
+        self.disable_profile(profiler, 10)
+        print(f'formula parse: earley {earley_time * 1e6:.1f} us, '
+              f'lalr {lalr_time * 1e6:.1f} us')
+
 
 if __name__ == '__main__':
     unittest.main()
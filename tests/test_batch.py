@@ -0,0 +1,134 @@
+import decimal
+import unittest
+import sheets
+
+
+class TestBatch(unittest.TestCase):
+    '''
+    This class contains the tests relating to setting many cells at once with
+    batch() and set_cells_contents().
+    '''
+    def count_evaluations(self, wb):
+        '''
+        Wraps the workbook's calculate_contents so that every cell evaluation
+        is recorded, and returns the list of recorded contents.
+        '''
+        evaluated = []
+        calculate_contents = wb.calculate_contents
+
+        def counting_calculate_contents(sheet_name, contents, in_scc=False,
+                                        formula=None):
+            evaluated.append(contents)
+            return calculate_contents(sheet_name, contents, in_scc, formula)
+        wb.calculate_contents = counting_calculate_contents
+        return evaluated
+
+    def test_batch_values(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.set_cell_contents(name, 'c1', '=a1 + b1')
+        with wb.batch():
+            wb.set_cell_contents(name, 'd1', '=c1 * 2')
+            wb.set_cell_contents(name, 'a1', '1')
+            wb.set_cell_contents(name, 'b1', '2')
+            # dependents are not updated until the batch ends
+            self.assertEqual(wb.get_cell_value(name, 'c1'), decimal.Decimal(0))
+        self.assertEqual(wb.get_cell_value(name, 'c1'), decimal.Decimal(3))
+        self.assertEqual(wb.get_cell_value(name, 'd1'), decimal.Decimal(6))
+
+        # cycles made inside a batch are found when it ends
+        wb.set_cells_contents(name, {'e1': '=f1', 'f1': '=e1', 'g1': '=f1'})
+        for location in ['e1', 'f1', 'g1']:
+            value = wb.get_cell_value(name, location)
+            self.assertEqual(value.get_type(),
+                             sheets.CellErrorType.CIRCULAR_REFERENCE)
+        wb.set_cells_contents(name, {'f1': '5'})
+        self.assertEqual(wb.get_cell_value(name, 'e1'), decimal.Decimal(5))
+        self.assertEqual(wb.get_cell_value(name, 'g1'), decimal.Decimal(5))
+
+        # clearing cells in a batch updates the cells that depend on them
+        wb.set_cells_contents(name, {'a1': None, 'b1': ''})
+        self.assertEqual(wb.get_cell_value(name, 'd1'), decimal.Decimal(0))
+
+        self.assertRaises(KeyError, wb.set_cells_contents, 'unknown',
+                          {'a1': '1'})
+        self.assertRaises(ValueError, wb.set_cells_contents, name,
+                          {'a1': '7', 'a0': '1'})
+        self.assertEqual(wb.get_cell_value(name, 'c1'), decimal.Decimal(7))
+
+    def test_batch_evaluates_once(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.set_cell_contents(name, 'b1', '=SUM(a1:a100)')
+        wb.set_cell_contents(name, 'b2', '=b1 + a1')
+        evaluated = self.count_evaluations(wb)
+
+        wb.set_cells_contents(name, {f'a{i}': str(i) for i in range(1, 101)})
+        self.assertEqual(wb.get_cell_value(name, 'b1'), decimal.Decimal(5050))
+        self.assertEqual(wb.get_cell_value(name, 'b2'), decimal.Decimal(5051))
+        self.assertEqual(evaluated.count('=SUM(a1:a100)'), 1)
+        self.assertEqual(evaluated.count('=b1 + a1'), 1)
+        self.assertEqual(len(evaluated), 102)
+
+        # a cell set in the batch is evaluated again only if something it
+        # depends on was also set
+        evaluated.clear()
+        wb.set_cells_contents(name, {'c1': '=c2', 'c2': '4', 'c3': '=b1'})
+        self.assertEqual(wb.get_cell_value(name, 'c1'), decimal.Decimal(4))
+        self.assertEqual(evaluated, ['=c2', '4', '=b1', '=c2'])
+
+    def test_batch_notify(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        notifications = []
+        wb.notify_cells_changed(
+            lambda _, cells: notifications.append(set(cells)))
+        wb.set_cell_contents(name, 'c1', '=a1 + b1')
+        wb.set_cell_contents(name, 'd1', '5')
+        notifications.clear()
+
+        with wb.batch():
+            with wb.batch():
+                wb.set_cell_contents(name, 'a1', '1')
+                wb.set_cell_contents(name, 'b1', '2')
+            self.assertEqual(notifications, [])
+            # setting a cell back to its value before the batch is not a change
+            wb.set_cell_contents(name, 'd1', '6')
+            wb.set_cell_contents(name, 'd1', '5')
+        self.assertEqual(notifications,
+                         [{('Sheet1', 'A1'), ('Sheet1', 'B1'),
+                           ('Sheet1', 'C1')}])
+
+        # a batch that changes nothing sends no notifications
+        notifications.clear()
+        with wb.batch():
+            wb.set_cell_contents(name, 'a1', '1')
+        self.assertEqual(notifications, [])
+
+    def test_batch_rename(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        (_, name2) = wb.new_sheet()
+        notifications = []
+        wb.notify_cells_changed(
+            lambda _, cells: notifications.append(set(cells)))
+        wb.set_cell_contents(name, 'a1', '1')
+        wb.set_cell_contents(name, 'b1', '=a1 * 2')
+        wb.set_cell_contents(name2, 'a1', '=Sheet1!b1 + 1')
+        notifications.clear()
+
+        # the cells set before the rename are recalculated under the new name
+        with wb.batch():
+            wb.set_cell_contents(name, 'a1', '5')
+            wb.rename_sheet(name, 'Renamed')
+            wb.set_cell_contents('Renamed', 'c1', '=a1')
+        self.assertEqual(wb.get_cell_value('Renamed', 'b1'),
+                         decimal.Decimal(10))
+        self.assertEqual(wb.get_cell_value(name2, 'a1'), decimal.Decimal(11))
+        self.assertEqual(notifications,
+                         [{('Renamed', 'A1'), ('Renamed', 'B1'),
+                           ('Renamed', 'C1'), ('Sheet2', 'A1')}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,9 @@
 import unittest
+from unittest import mock
 import decimal
 import sheets
+# on the path once sheets is imported, as the module the sheets use
+import numeric_columns
 
 class TestCellRanges(unittest.TestCase):
     def test_cell_range_errors(self):
@@ -244,6 +247,103 @@ class TestCellRanges(unittest.TestCase):
         self.assertTrue(isinstance(value, sheets.CellError))
         self.assertEqual(value.get_type(), sheets.CellErrorType.CIRCULAR_REFERENCE)
 
+    def test_large_sparse_range(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.set_cell_contents(name, 'a1', '1')
+        wb.set_cell_contents(name, 'm500', '2')
+        wb.set_cell_contents(name, 'z1000', '3')
+        wb.set_cell_contents(name, 'ab1', '=SUM(A1:Z1000)')
+        self.assertEqual(wb.get_cell_value(name, 'ab1'), decimal.Decimal('6'))
+        wb.set_cell_contents(name, 'ab2', '=AVERAGE($A$1:$Z$1000)')
+        self.assertEqual(wb.get_cell_value(name, 'ab2'), decimal.Decimal('2'))
+
+        # edits anywhere in the range propagate to the aggregate
+        wb.set_cell_contents(name, 'c700', '4')
+        self.assertEqual(wb.get_cell_value(name, 'ab1'), decimal.Decimal('10'))
+        wb.set_cell_contents(name, 'm500', '0')
+        self.assertEqual(wb.get_cell_value(name, 'ab1'), decimal.Decimal('8'))
+
+        wb.set_cell_contents(name, 'ab3', '=SUM(missing!A1:B2)')
+        value = wb.get_cell_value(name, 'ab3')
+        self.assertTrue(isinstance(value, sheets.CellError))
+        self.assertEqual(value.get_type(), sheets.CellErrorType.BAD_REFERENCE)
+
+        wb.set_cell_contents(name, 'ab4', '=A1:B2')
+        value = wb.get_cell_value(name, 'ab4')
+        self.assertTrue(isinstance(value, sheets.CellError))
+        self.assertEqual(value.get_type(), sheets.CellErrorType.TYPE_ERROR)
+
+    def check_number_columns(self):
+        '''
+        Checks SUM, MIN, MAX and AVERAGE over ranges of numbers, as the
+        sheets' numeric columns are kept and changed, and returns the
+        workbook and the name of its sheet.
+        '''
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.set_cells_contents(name, {f'a{row}': str(row / 4)
+                                     for row in range(1, 101)})
+        wb.set_cells_contents(name, {'b50': '0', 'b51': '-0.125'})
+        wb.set_cells_contents(name, {
+            'c1': '=SUM(a1:b100)', 'c2': '=MIN(a1:b100)',
+            'c3': '=MAX(a1:b100)', 'c4': '=AVERAGE(a1:b100)',
+            'c5': '=SUM(a1:b100) & ""', 'c6': '=MIN(b1:b49, b50:b100)',
+            'c7': '=MAX(b50:b100, -1)'})
+        expected = ['1262.375', '-0.125', '25',
+                    '12.37622549019607843137254902', '1262.375', '-0.125',
+                    '0']
+        self.assertEqual([str(wb.get_cell_value(name, f'c{row}'))
+                          for row in range(1, 8)], expected)
+
+        # a copy of the sheet keeps its own numbers once either changes
+        wb.copy_sheet(name)
+        wb.set_cell_contents(name, 'a100', '1000')
+        self.assertEqual(wb.get_cell_value(name, 'c3'), decimal.Decimal(1000))
+        self.assertEqual(wb.get_cell_value('Sheet1_1', 'c3'),
+                         decimal.Decimal(25))
+
+        # ranges with other values are read cell by cell
+        wb.set_cell_contents(name, 'b70', 'true')
+        self.assertEqual(wb.get_cell_value(name, 'c2'),
+                         decimal.Decimal('-0.125'))
+        self.assertEqual(wb.get_cell_value(name, 'c1'),
+                         decimal.Decimal('2238.375'))
+        wb.set_cell_contents(name, 'b70', '0.1234567')
+        self.assertEqual(wb.get_cell_value(name, 'c1'),
+                         decimal.Decimal('2237.4984567'))
+        wb.set_cell_contents(name, 'b70', '=1/0')
+        value = wb.get_cell_value(name, 'c4')
+        self.assertTrue(isinstance(value, sheets.CellError))
+        self.assertEqual(value.get_type(), sheets.CellErrorType.DIVIDE_BY_ZERO)
+        return (wb, name)
+
+    @unittest.skipUnless(numeric_columns.numpy, 'NumPy is not installed')
+    def test_aggregate_number_columns(self):
+        columns = numeric_columns.NumericColumns
+        with mock.patch.object(columns, 'aggregate', autospec=True,
+                               side_effect=columns.aggregate) as aggregate:
+            (wb, name) = self.check_number_columns()
+        # the formulas read their ranges from the columns
+        self.assertTrue(aggregate.called)
+        numbers = wb.sheets[name.lower()].numbers
+        self.assertEqual(numbers.aggregate(sum, 1, 1, 1, 100),
+                         (decimal.Decimal('2237.5'), 100))
+        self.assertEqual(numbers.aggregate(max, 1, 1, 1, 100),
+                         (decimal.Decimal(1000), 100))
+        # a range holding anything but numbers is read cell by cell
+        self.assertIsNone(numbers.aggregate(sum, 1, 1, 2, 100))
+        numbers = wb.sheets['sheet1_1'].numbers
+        self.assertEqual(numbers.aggregate(min, 1, 1, 2, 100),
+                         (decimal.Decimal('-0.125'), 102))
+
+    def test_aggregate_without_numpy(self):
+        with mock.patch.object(numeric_columns, 'numpy', None):
+            (wb, name) = self.check_number_columns()
+        # without NumPy the sheets keep no columns
+        self.assertIsNone(wb.sheets[name.lower()].numbers)
+        self.assertIsNone(wb.sheets['sheet1_1'].numbers)
+
     def test_hlookup_function(self):
         wb = sheets.Workbook()
         (_, name) = wb.new_sheet()
@@ -361,5 +461,32 @@ class TestCellRanges(unittest.TestCase):
         self.assertTrue(isinstance(value, sheets.CellError))
         self.assertEqual(value.get_type(), sheets.CellErrorType.TYPE_ERROR)
 
+    def test_lookup_leaving_cycle(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        for i in range(1, 6):
+            wb.set_cell_contents(name, f'a{i}', str(i))
+            wb.set_cell_contents(name, f'b{i}', f'=a{i} * 2 + a1')
+        wb.set_cell_contents(name, 'c1', '=vlookup(a1, a1:b5, 2)')
+        wb.set_cell_contents(name, 'a1', '=c1')
+        value = wb.get_cell_value(name, 'c1')
+        self.assertEqual(value.get_type(), sheets.CellErrorType.CIRCULAR_REFERENCE)
+
+        # the lookup reads b2 before b2 leaves the cycle too
+        wb.set_cell_contents(name, 'a1', '2')
+        self.assertEqual(wb.get_cell_value(name, 'c1'), decimal.Decimal('6'))
+
+    def test_lookup_leaving_error(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.set_cell_contents(name, 'a1', '=1/0')
+        wb.set_cell_contents(name, 'b1', '5')
+        wb.set_cell_contents(name, 'c1', '=VLOOKUP(1, a1:b2, 2)')
+        value = wb.get_cell_value(name, 'c1')
+        self.assertEqual(value.get_type(), sheets.CellErrorType.DIVIDE_BY_ZERO)
+
+        wb.set_cell_contents(name, 'a1', '1')
+        self.assertEqual(wb.get_cell_value(name, 'c1'), decimal.Decimal('5'))
+
 if __name__ == '__main__':
     unittest.main()
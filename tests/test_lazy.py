@@ -0,0 +1,215 @@
+import decimal
+import random
+import unittest
+import sheets
+
+
+class TestLazy(unittest.TestCase):
+    '''
+    This class contains the tests relating to lazy evaluation mode and
+    flush().
+    '''
+    def count_evaluations(self, wb):
+        '''
+        Wraps the workbook's calculate_contents so that every cell evaluation
+        is recorded, and returns the list of recorded contents.
+        '''
+        evaluated = []
+        calculate_contents = wb.calculate_contents
+
+        def counting_calculate_contents(sheet_name, contents, in_scc=False,
+                                        formula=None):
+            evaluated.append(contents)
+            return calculate_contents(sheet_name, contents, in_scc, formula)
+        wb.calculate_contents = counting_calculate_contents
+        return evaluated
+
+    def assert_same_values(self, wb, lazy_wb, name, locations):
+        for location in locations:
+            value = wb.get_cell_value(name, location)
+            lazy_value = lazy_wb.get_cell_value(name, location)
+            if isinstance(value, sheets.CellError):
+                self.assertIsInstance(lazy_value, sheets.CellError)
+                self.assertEqual(value.get_type(), lazy_value.get_type())
+            else:
+                self.assertEqual(value, lazy_value)
+
+    def test_lazy_values(self):
+        edits = [('a1', '=a2 + a3'), ('a2', '=a3 * 2'), ('a3', '4'),
+                 ('b1', '=SUM(a1:a3)'), ('b2', '=IF(a3 > 3, b3, a1)'),
+                 ('b3', '=b2'), ('c1', '=INDIRECT(c2 & "")'), ('c2', 'a1'),
+                 ('c3', '=c1 + 1'), ('a3', '1'), ('c2', 'd1'),
+                 ('d1', '=a1 * 10'), ('b3', '5'), ('a2', None),
+                 ('d2', '=d3'), ('d3', '=d2 + d1'), ('d3', '=a2'),
+                 ('e1', '=VLOOKUP(2, e2:f3, 2)'), ('e2', '1'), ('e3', '2'),
+                 ('f2', '=a1'), ('f3', '=d1 + 1'), ('d1', '7')]
+        locations = sorted({location for (location, _) in edits})
+
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        lazy_wb = sheets.Workbook(lazy=True)
+        lazy_wb.new_sheet()
+        for (i, (location, contents)) in enumerate(edits):
+            wb.set_cell_contents(name, location, contents)
+            lazy_wb.set_cell_contents(name, location, contents)
+            # read only some of the cells along the way
+            if i % 3 == 0:
+                self.assert_same_values(wb, lazy_wb, name, [location, 'c3'])
+        self.assert_same_values(wb, lazy_wb, name, locations)
+        self.assertEqual(lazy_wb.get_cell_value(name, 'e1'),
+                         decimal.Decimal(8))
+        self.assertEqual(lazy_wb.get_cell_value(name, 'c3'),
+                         decimal.Decimal(8))
+
+        # a formula that reads a dirty cell it was not known to depend on
+        # is evaluated again after that cell
+        lazy_wb.set_cell_contents(name, 'g3', '3')
+        lazy_wb.set_cell_contents(name, 'g2', '=g3 * 2')
+        lazy_wb.set_cell_contents(name, 'g1', '=INDIRECT("g" & 2) + 1')
+        self.assertEqual(lazy_wb.get_cell_value(name, 'g1'),
+                         decimal.Decimal(7))
+
+        # cycles are found when the cells are read
+        lazy_wb.set_cell_contents(name, 'h1', '=h2')
+        lazy_wb.set_cell_contents(name, 'h2', '=h1')
+        lazy_wb.set_cell_contents(name, 'h3', '=h3')
+        for location in ['h1', 'h2', 'h3']:
+            self.assertEqual(lazy_wb.get_cell_value(name, location).get_type(),
+                             sheets.CellErrorType.CIRCULAR_REFERENCE)
+        lazy_wb.set_cell_contents(name, 'h2', '2')
+        self.assertEqual(lazy_wb.get_cell_value(name, 'h1'),
+                         decimal.Decimal(2))
+
+    def check_same_values(self, edits, locations):
+        '''
+        Makes the edits in an eager and a lazy workbook, and checks that the
+        cells have the same values in both once the lazy one is flushed.
+        '''
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        lazy_wb = sheets.Workbook(lazy=True)
+        lazy_wb.new_sheet()
+        for (location, contents) in edits:
+            wb.set_cell_contents(name, location, contents)
+            lazy_wb.set_cell_contents(name, location, contents)
+        lazy_wb.flush()
+        self.assert_same_values(wb, lazy_wb, name, locations)
+        return lazy_wb
+
+    def test_lazy_matches_eager(self):
+        # a formula is not in a cycle through a branch it does not take
+        lazy_wb = self.check_same_values(
+            [('b1', '5'), ('a1', '=IFERROR(b1, SUM(a1:a2))')], ['a1'])
+        self.assertEqual(lazy_wb.get_cell_value('Sheet1', 'a1'),
+                         decimal.Decimal(5))
+        lazy_wb = self.check_same_values(
+            [('b1', '=IF(c1, 1, b1)'), ('c1', 'TRUE')], ['b1'])
+        self.assertEqual(lazy_wb.get_cell_value('Sheet1', 'b1'),
+                         decimal.Decimal(1))
+
+        # a formula is in a cycle once it reads itself
+        lazy_wb = self.check_same_values([('a4', '="x"/INDIRECT("a4")')],
+                                         ['a4'])
+        self.assertEqual(lazy_wb.get_cell_value('Sheet1', 'a4').get_type(),
+                         sheets.CellErrorType.CIRCULAR_REFERENCE)
+        self.check_same_values([('a2', 'b1'), ('a1', '=INDIRECT(a2)'),
+                                ('b1', '=a1 + 1'), ('a2', 'c1')],
+                               ['a1', 'b1'])
+
+        rand = random.Random(7)
+        locations = [col + str(row) for col in 'abc' for row in range(1, 4)]
+        contents = ['1', '2', 'x', None, '=IF({0} > 1, {1}, 0)',
+                    '=IFERROR({0}, {1})', '=INDIRECT("{0}")',
+                    '=SUM({0}:{1})', '={0} + {1}', '=ISERROR({0})']
+        for _ in range(50):
+            edits = []
+            for _ in range(8):
+                content = rand.choice(contents)
+                if content is not None:
+                    content = content.format(*rand.sample(locations, 2))
+                edits.append((rand.choice(locations), content))
+            self.check_same_values(edits, locations)
+
+    def test_lazy_evaluates_on_read(self):
+        wb = sheets.Workbook(lazy=True)
+        (_, name) = wb.new_sheet()
+        evaluated = self.count_evaluations(wb)
+        for i in range(1, 101):
+            wb.set_cell_contents(name, f'a{i}', f'=a{i + 1} + 1')
+            wb.set_cell_contents(name, f'b{i}', f'=b{i + 1} + 1')
+        wb.set_cell_contents(name, 'a101', '0')
+        wb.set_cell_contents(name, 'b101', '0')
+        # only literal cells are evaluated when set
+        self.assertEqual(evaluated, ['0', '0'])
+
+        evaluated.clear()
+        self.assertEqual(wb.get_cell_value(name, 'a90'), decimal.Decimal(11))
+        self.assertEqual(len(evaluated), 11)
+        self.assertEqual(wb.get_cell_value(name, 'a1'), decimal.Decimal(100))
+        self.assertEqual(len(evaluated), 100)
+
+        # changing a cell only makes the cells that depend on it dirty, and
+        # each of them is evaluated once however many edits were made
+        evaluated.clear()
+        for i in range(10):
+            wb.set_cell_contents(name, 'a101', str(i))
+        self.assertEqual(wb.get_cell_value(name, 'a1'), decimal.Decimal(109))
+        self.assertEqual(evaluated.count('=a2 + 1'), 1)
+        self.assertEqual(len(evaluated), 10 + 100)
+
+        evaluated.clear()
+        wb.flush()
+        self.assertEqual(len(evaluated), 100)
+        self.assertEqual(wb.get_cell_value(name, 'b1'), decimal.Decimal(100))
+        self.assertEqual(len(evaluated), 100)
+
+    def test_lazy_notify(self):
+        wb = sheets.Workbook(lazy=True)
+        (_, name) = wb.new_sheet()
+        notifications = []
+        wb.notify_cells_changed(
+            lambda _, cells: notifications.append(set(cells)))
+        wb.set_cell_contents(name, 'a1', '1')
+        wb.set_cell_contents(name, 'a2', '=a1 + 1')
+        wb.set_cell_contents(name, 'a3', '=a2 * 0')
+        self.assertEqual(wb.get_cell_value(name, 'a2'), decimal.Decimal(2))
+        self.assertEqual(notifications, [])
+        wb.flush()
+        self.assertEqual(notifications, [{('Sheet1', 'A1'), ('Sheet1', 'A2'),
+                                          ('Sheet1', 'A3')}])
+
+        # only cells whose values differ from the last flush are reported
+        notifications.clear()
+        wb.set_cell_contents(name, 'a1', '5')
+        self.assertEqual(wb.get_cell_value(name, 'a2'), decimal.Decimal(6))
+        wb.set_cell_contents(name, 'b1', 'x')
+        wb.set_cell_contents(name, 'b1', None)
+        wb.flush()
+        self.assertEqual(notifications, [{('Sheet1', 'A1'), ('Sheet1', 'A2')}])
+        notifications.clear()
+        wb.flush()
+        self.assertEqual(notifications, [])
+
+        # other operations flush before they run
+        wb.set_cell_contents(name, 'a1', '6')
+        wb.rename_sheet(name, 'Renamed')
+        self.assertEqual(notifications[0], {('Sheet1', 'A1'),
+                                            ('Sheet1', 'A2')})
+        self.assertEqual(wb.get_cell_value('Renamed', 'a2'),
+                         decimal.Decimal(7))
+
+        # turning lazy mode off flushes, and later edits are eager
+        notifications.clear()
+        wb.set_cell_contents('Renamed', 'a1', '7')
+        wb.set_lazy(False)
+        self.assertEqual(notifications, [{('Renamed', 'A1'),
+                                          ('Renamed', 'A2')}])
+        wb.set_cell_contents('Renamed', 'a1', '8')
+        self.assertEqual(notifications[-1], {('Renamed', 'A1'),
+                                             ('Renamed', 'A2')})
+        self.assertEqual(wb.sheets['renamed'].cells['a2'].value,
+                         decimal.Decimal(9))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
 import unittest
+import io
+import sys
 import json
 import sheets
 
@@ -48,6 +50,55 @@ class TestLoadSaveWorkbook(unittest.TestCase):
         with open('tests/jsons/load_error.json', 'r') as f:
             self.assertRaises(ValueError, wb.load_workbook, f)
 
+    def test_load_workbook_formulas(self):
+        # cells are loaded in an order where formulas come before the cells
+        # they depend on; the loaded values must match setting the cells one
+        # at a time
+        contents = {
+            'Sheet1': {'A1': '=A2 + Sheet2!A1', 'A2': '=A3 * 2', 'A3': '4',
+                       'B1': '=B2', 'B2': '=B1', 'B3': '=B1 + 1',
+                       'C1': '=IF(A3 > 3, 5, C2)', 'C2': '=C1',
+                       'D1': '=VLOOKUP(2, E1:F3, 2)', 'D2': '=INDIRECT(D3 & 3)',
+                       'D3': 'a', 'E1': '1', 'E2': '=A3 - 2',
+                       'F1': 'one', 'F2': '=A1', 'F3': 'three',
+                       'G1': '=SUM(A1:A3, Sheet2!A1:A2)', 'G2': '=G1 +',
+                       'G3': '=unknown(A1)', 'G4': ' '},
+            'Sheet2': {'A1': '=Sheet1!A3 + 1', 'A2': '=Sheet1!D1'}}
+        document = {'sheets': [{'name': name, 'cell-contents': cells}
+                               for (name, cells) in contents.items()]}
+        loaded_wb = sheets.Workbook.load_workbook(
+            io.StringIO(json.dumps(document)))
+
+        wb = sheets.Workbook()
+        for name in contents:
+            wb.new_sheet(name)
+        for (name, cells) in contents.items():
+            for (location, cell_contents) in cells.items():
+                wb.set_cell_contents(name, location, cell_contents)
+
+        for (name, cells) in contents.items():
+            for location in cells:
+                value = wb.get_cell_value(name, location)
+                loaded_value = loaded_wb.get_cell_value(name, location)
+                if isinstance(value, sheets.CellError):
+                    self.assertEqual(value.get_type(), loaded_value.get_type())
+                else:
+                    self.assertEqual(value, loaded_value)
+        self.assertEqual(loaded_wb.get_cell_value('Sheet1', 'A1'), 13)
+        self.assertEqual(loaded_wb.get_cell_value('Sheet1', 'C1'), 5)
+        self.assertEqual(loaded_wb.get_cell_value('Sheet1', 'D1'), 13)
+        self.assertEqual(loaded_wb.get_cell_value('Sheet2', 'A2'), 13)
+        self.assertEqual(loaded_wb.get_cell_value('Sheet1', 'D2'), 4)
+        self.assertEqual(loaded_wb.get_cell_value('Sheet1', 'G1'), 43)
+        self.assertEqual(loaded_wb.get_cell_value('Sheet1', 'B3').get_type(),
+                         sheets.CellErrorType.CIRCULAR_REFERENCE)
+
+        # the loaded dependency graph keeps the workbook up to date
+        loaded_wb.set_cell_contents('Sheet1', 'A3', '5')
+        self.assertEqual(loaded_wb.get_cell_value('Sheet1', 'A1'), 16)
+        loaded_wb.set_cell_contents('Sheet1', 'E1', '2')
+        self.assertEqual(loaded_wb.get_cell_value('Sheet1', 'D1'), 'one')
+
     def test_save_workbook(self):
         wb = sheets.Workbook()
         (_, name) = wb.new_sheet()
@@ -63,3 +114,167 @@ class TestLoadSaveWorkbook(unittest.TestCase):
                             {"A1": "=b1+c1", "B1": "=c1", "C1": "1"}},
                            {"name": "Sheet2", "cell-contents": {}}]}
         self.assertEqual(temp, temp2)
+
+    def test_save_load_streaming(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.new_sheet('Other sheet: ü')
+        wb.new_sheet()
+        wb.set_cell_contents(name, 'a1', '=b1+c1')
+        wb.set_cell_contents(name, 'b1', '12345')
+        wb.set_cell_contents(name, 'c1', '\'tab\t and "quote" é')
+        wb.set_cell_contents(name, 'd1', '1')
+        wb.set_cell_contents(name, 'd1', '')
+        wb.set_cell_contents('Other sheet: ü', 'a1',
+                             '=Sheet1!B1 * 2')
+        document = {"sheets": [
+            {"name": "Sheet1", "cell-contents":
+             {"A1": "=b1+c1", "B1": "12345",
+              "C1": "'tab\t and \"quote\" é", "D1": None}},
+            {"name": "Other sheet: ü", "cell-contents":
+             {"A1": "=Sheet1!B1 * 2"}},
+            {"name": "Sheet2", "cell-contents": {}}]}
+
+        # the streamed output is the same text json.dumps would write
+        for indent in [4, 2, None]:
+            f = io.StringIO()
+            wb.save_workbook(f, indent=indent)
+            self.assertEqual(f.getvalue(), json.dumps(document, indent=indent))
+        f = io.StringIO()
+        sheets.Workbook().save_workbook(f)
+        self.assertEqual(f.getvalue(), json.dumps({"sheets": []}, indent=4))
+
+        class TrickleReader:
+            '''
+            A file-like object that returns at most a few characters per read,
+            so every value is split across reads.
+            '''
+            def __init__(self, text):
+                self.text = text
+                self.pos = 0
+
+            def read(self, size=-1):
+                chunk = self.text[self.pos:self.pos + 3]
+                self.pos += len(chunk)
+                return chunk
+
+        f = io.StringIO()
+        wb.save_workbook(f, indent=None)
+        loaded_wb = sheets.Workbook.load_workbook(TrickleReader(f.getvalue()))
+        self.assertEqual(loaded_wb.list_sheets(), wb.list_sheets())
+        self.assertEqual(loaded_wb.get_cell_value(name, 'b1'), 12345)
+        self.assertEqual(loaded_wb.get_cell_value('Other sheet: ü',
+                                                  'a1'), 24690)
+        self.assertEqual(loaded_wb.get_cell_value(name, 'c1'),
+                         'tab\t and "quote" é')
+
+        # other top-level keys are skipped, and errors past the first sheet
+        # are still reported
+        text = ('{"version": [1, {"x": 2}], "sheets": [{"name": "A", '
+                '"cell-contents": {"A1": "7"}}], "other": 1.5e3}')
+        loaded_wb = sheets.Workbook.load_workbook(TrickleReader(text))
+        self.assertEqual(loaded_wb.get_cell_value('A', 'a1'), 7)
+        for (text, error) in [
+                ('{"sheets": [{"name": "A", "cell-contents": {}}, }',
+                 json.JSONDecodeError),
+                ('{"sheets": [{"name": "A", "cell-contents": {}}]} x',
+                 json.JSONDecodeError),
+                ('{"sheets": [{"name": "A", "cell-contents": {}}',
+                 json.JSONDecodeError),
+                ('{"other": []}', KeyError),
+                ('{"sheets": {"name": "A"}}', TypeError),
+                ('{"sheets": [{"name": "A", "cell-contents": {}}, 5]}',
+                 TypeError)]:
+            self.assertRaises(error, sheets.Workbook.load_workbook,
+                              TrickleReader(text))
+            self.assertRaises(error, sheets.Workbook.load_workbook,
+                              io.StringIO(text))
+
+    def test_save_load_binary(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        (_, name2) = wb.new_sheet('Other')
+        contents = {'a1': '=b1 + Other!a1', 'b1': '2.5', 'c1': '=a1 / 0',
+                    'd1': '=d2', 'd2': '=d1', 'e1': "'text", 'e2': 'true',
+                    'f1': '=VLOOKUP(2, g1:h2, 2)', 'g1': '1', 'g2': '2',
+                    'h1': 'one', 'h2': '=b1 * 2', 'i1': '=missing!a1',
+                    'j1': '=SUM(b1:b3)', 'k1': '=a1 +'}
+        wb.set_cells_contents(name, contents)
+        wb.set_cell_contents(name2, 'a1', '=Sheet1!b1 * 4')
+
+        f = io.BytesIO()
+        wb.save_workbook_binary(f)
+        calculated = []
+        calculate_contents = sheets.Workbook.calculate_contents
+
+        def counting_calculate_contents(self, *args, **kwargs):
+            calculated.append(args)
+            return calculate_contents(self, *args, **kwargs)
+        sheets.Workbook.calculate_contents = counting_calculate_contents
+        try:
+            f.seek(0)
+            loaded_wb = sheets.Workbook.load_workbook_binary(f)
+            # opening the file does not evaluate anything
+            self.assertEqual(calculated, [])
+        finally:
+            sheets.Workbook.calculate_contents = calculate_contents
+
+        self.assertEqual(loaded_wb.list_sheets(), ['Sheet1', 'Other'])
+        self.assertEqual(loaded_wb.graph.forward, wb.graph.forward)
+        self.assertEqual(loaded_wb.graph.backward, wb.graph.backward)
+        self.assertEqual(loaded_wb.graph.get_range_dependents(),
+                         wb.graph.get_range_dependents())
+        self.assertEqual(loaded_wb.graph.order.keys, wb.graph.order.keys)
+        self.assertEqual(loaded_wb.graph.order.cycles, wb.graph.order.cycles)
+        for (sheet_name, locations) in [(name, contents), (name2, ['a1'])]:
+            for location in locations:
+                self.assertEqual(loaded_wb.get_cell_contents(sheet_name,
+                                                             location),
+                                 wb.get_cell_contents(sheet_name, location))
+                value = wb.get_cell_value(sheet_name, location)
+                loaded_value = loaded_wb.get_cell_value(sheet_name, location)
+                if isinstance(value, sheets.CellError):
+                    self.assertEqual(value.get_type(), loaded_value.get_type())
+                    self.assertEqual(value.get_detail(),
+                                     loaded_value.get_detail())
+                else:
+                    self.assertEqual(value, loaded_value)
+                    self.assertEqual(type(value), type(loaded_value))
+
+        # the loaded workbook keeps updating like the original
+        loaded_wb.set_cell_contents(name, 'b1', '3')
+        self.assertEqual(loaded_wb.get_cell_value(name, 'a1'), 15)
+        self.assertEqual(loaded_wb.get_cell_value(name, 'f1'), 6)
+        loaded_wb.set_cell_contents(name, 'd2', '4')
+        self.assertEqual(loaded_wb.get_cell_value(name, 'd1'), 4)
+        loaded_wb.new_sheet('missing')
+        loaded_wb.set_cell_contents('missing', 'a1', '8')
+        self.assertEqual(loaded_wb.get_cell_value(name, 'i1'), 8)
+        loaded_wb.rename_sheet('Other', 'Renamed')
+        self.assertEqual(loaded_wb.get_cell_contents(name, 'a1'),
+                         '=b1 + Renamed!a1')
+        (_, copy_name) = loaded_wb.copy_sheet(name)
+        loaded_wb.set_cell_contents(copy_name, 'b1', '1')
+        self.assertEqual(loaded_wb.get_cell_value(copy_name, 'a1'), 13)
+
+        # a file from another engine version is recalculated from contents
+        version_file = sys.modules['version_file']
+        version = version_file.version
+        version_file.version = '0.0.0'
+        try:
+            f = io.BytesIO()
+            wb.save_workbook_binary(f)
+        finally:
+            version_file.version = version
+        f.seek(0)
+        loaded_wb = sheets.Workbook.load_workbook_binary(f)
+        self.assertEqual(loaded_wb.get_cell_value(name, 'a1'), 12.5)
+        self.assertEqual(loaded_wb.get_cell_value(name, 'd1').get_type(),
+                         sheets.CellErrorType.CIRCULAR_REFERENCE)
+        self.assertEqual(loaded_wb.graph.forward, wb.graph.forward)
+
+        data = f.getvalue()
+        for bad_data in [b'', b'{"sheets": []}', data[:len(data) // 2],
+                         data[:8] + b'\x80\x05c__builtin__\neval\n']:
+            self.assertRaises(ValueError, sheets.Workbook.load_workbook_binary,
+                              io.BytesIO(bad_data))
@@ -1,5 +1,7 @@
 import decimal
 import unittest
+from unittest import mock
+import lark
 import sheets
 
 
@@ -408,5 +410,80 @@ class TestMoveCopyCells(unittest.TestCase):
         self.assertTrue(isinstance(value, sheets.CellError))
         self.assertEqual(value.get_type(), sheets.CellErrorType.BAD_REFERENCE)
 
+    def test_relocated_references(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        (_, name2) = wb.new_sheet('Other Sheet')
+        # only whole references are shifted, not text that looks like one
+        wb.set_cell_contents(name, 'b1', '=Sheet1!A1 + E1 + a10')
+        wb.set_cell_contents(name, 'c1', '=A1 & "Total A1"')
+        wb.set_cell_contents(name, 'd1', "=SUM(a1:$A$3) + 'Other Sheet' ! b2")
+        wb.set_cell_contents(name, 'e1', '=SUM(a1:b2)')
+        wb.copy_cells(name, 'b1', 'e1', 'b2')
+        self.assertEqual(wb.get_cell_contents(name, 'b2'),
+                         '=sheet1!A2 + E2 + A11')
+        self.assertEqual(wb.get_cell_contents(name, 'c2'), '=A2 & "total a1"')
+        self.assertEqual(wb.get_cell_contents(name, 'd2'),
+                         "=sum(A2:$A$3) + 'other sheet'!B3")
+        self.assertEqual(wb.get_cell_contents(name, 'e2'), '=sum(A2:B3)')
+
+        wb.set_cell_contents(name, 'a2', '4')
+        wb.set_cell_contents(name2, 'b3', '5')
+        self.assertEqual(wb.get_cell_value(name, 'c2'), '4total a1')
+        self.assertEqual(wb.get_cell_value(name, 'd2'), decimal.Decimal(9))
+
+        # a range with a corner off the sheet becomes #REF!
+        wb.move_cells(name, 'e1', 'e1', 'e9999')
+        self.assertEqual(wb.get_cell_contents(name, 'e9999'), '=sum(#REF!)')
+        value = wb.get_cell_value(name, 'e9999')
+        self.assertEqual(value.get_type(), sheets.CellErrorType.BAD_REFERENCE)
+
+    def test_relocation_does_not_parse(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        for i in range(1, 11):
+            wb.set_cell_contents(name, f'a{i}', str(i))
+            wb.set_cell_contents(name, f'b{i}', f'=a{i} * 2 + $a$1')
+            wb.set_cell_contents(name, f'c{i}', f'=SUM(b$1:b{i})')
+
+        parses = []
+        parse = lark.Lark.parse
+
+        def counting_parse(parser, text, *args, **kwargs):
+            parses.append(text)
+            return parse(parser, text, *args, **kwargs)
+        with mock.patch.object(lark.Lark, 'parse', counting_parse):
+            wb.copy_cells(name, 'a1', 'c10', 'e1')
+            wb.move_cells(name, 'e1', 'g10', 'f3')
+            wb.sort_region(name, 'f3', 'h12', [-1])
+            wb.set_cell_contents(name, 'f12', '20')
+        self.assertEqual(parses, [])
+
+        self.assertEqual(wb.get_cell_contents(name, 'g3'), '=F3 * 2 + $A$1')
+        self.assertEqual(wb.get_cell_contents(name, 'h3'), '=sum(G$1:G3)')
+        # sorted in descending order, so f3 is 10 and f12 was 1
+        self.assertEqual(wb.get_cell_value(name, 'g3'), decimal.Decimal(21))
+        self.assertEqual(wb.get_cell_value(name, 'g12'), decimal.Decimal(41))
+        self.assertEqual(wb.get_cell_value(name, 'h12'), decimal.Decimal(158))
+
+    def test_relocated_untaken_branches(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.set_cell_contents(name, 'a1', '=IFERROR(1, a1)')
+        wb.set_cell_contents(name, 'a2', '=IFERROR(1 / 0, a2)')
+        wb.set_cell_contents(name, 'd1', '=b1 + c1')
+
+        # a branch that is not taken does not put the cell in a cycle
+        wb.copy_cells(name, 'a1', 'a2', 'b1')
+        self.assertEqual(wb.get_cell_value(name, 'b1'), decimal.Decimal(1))
+        wb.move_cells(name, 'a1', 'a2', 'c1')
+        self.assertEqual(wb.get_cell_value(name, 'c1'), decimal.Decimal(1))
+        self.assertEqual(wb.get_cell_value(name, 'd1'), decimal.Decimal(2))
+
+        # a branch that is taken still does
+        for location in ('b2', 'c2'):
+            self.assertEqual(wb.get_cell_value(name, location).get_type(),
+                             sheets.CellErrorType.CIRCULAR_REFERENCE)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,6 @@
+import asyncio
 import decimal
+import threading
 import unittest
 import sheets
 
@@ -88,17 +90,203 @@ class TestNotify(unittest.TestCase):
 
         wb.set_cell_contents(name, "a4", "=a1")
         wb.copy_cells(name, 'a1', 'a4', 'b1')
-        lst = {('Sheet1', 'B4'), ('Sheet1', 'B1'), ('Sheet1', 'B2'), ('Sheet1', 'B3')}
+        # the copy is reported as one change, including c1, which reads b1
+        lst = {('Sheet1', 'B4'), ('Sheet1', 'B1'), ('Sheet1', 'B2'), ('Sheet1', 'B3'),
+               ('Sheet1', 'C1')}
         self.assertEqual(wb.notify_cells_master, lst)
 
         wb.move_cells(name, 'a1', 'a4', 'b1')
-        lst = {('Sheet1', 'A1'), ('Sheet1', 'A2'), ('Sheet1', 'A3'), ('Sheet1', 'A4')}
+        lst = {('Sheet1', 'A1'), ('Sheet1', 'A2'), ('Sheet1', 'A3'), ('Sheet1', 'A4'),
+               ('Sheet1', 'C1')}
         self.assertEqual(wb.notify_cells_master, lst)
 
         wb.move_cells(name, 'b1', 'b4', 'b2')
-        lst = {('Sheet1', 'B5'), ('Sheet1', 'B1'), ('Sheet1', 'B2'), ('Sheet1', 'B3'), ('Sheet1', 'B4')}
+        lst = {('Sheet1', 'B5'), ('Sheet1', 'B1'), ('Sheet1', 'B2'), ('Sheet1', 'B3'), ('Sheet1', 'B4'),
+               ('Sheet1', 'C1')}
         self.assertEqual(wb.notify_cells_master, lst)
 
+    def test_scoped_notifications(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        (_, name2) = wb.new_sheet()
+        calls = {'workbook': [], 'sheet': [], 'range': []}
+        wb.notify_cells_changed(lambda _, cells: calls['workbook'].append(
+            sorted(cells)))
+        wb.notify_cells_changed(lambda _, cells: calls['sheet'].append(
+            sorted(cells)), name2)
+        wb.notify_cells_changed(lambda _, cells: calls['range'].append(
+            sorted(cells)), 'SHEET1', 'c3', 'B2')
+
+        wb.set_cell_contents(name, 'a1', '1')
+        wb.set_cell_contents(name, 'b2', '=a1 + 1')
+        wb.set_cell_contents(name2, 'a1', '=Sheet1!b2 * 2')
+        self.assertEqual(calls['workbook'], [[('Sheet1', 'A1')],
+                                             [('Sheet1', 'B2')],
+                                             [('Sheet2', 'A1')]])
+        self.assertEqual(calls['sheet'], [[('Sheet2', 'A1')]])
+        self.assertEqual(calls['range'], [[('Sheet1', 'B2')]])
+
+        # each notify function only gets the cells it watches
+        wb.set_cell_contents(name, 'a1', '2')
+        self.assertEqual(calls['workbook'][-1], [('Sheet1', 'A1'),
+                                                 ('Sheet1', 'B2'),
+                                                 ('Sheet2', 'A1')])
+        self.assertEqual(calls['sheet'][-1], [('Sheet2', 'A1')])
+        self.assertEqual(calls['range'][-1], [('Sheet1', 'B2')])
+
+        # the sheet is still watched after it is renamed
+        wb.rename_sheet(name, 'Data')
+        wb.set_cell_contents('Data', 'c3', "'x")
+        self.assertEqual(calls['range'][-1], [('Data', 'C3')])
+        self.assertEqual(len(calls['range']), 3)
+
+        with self.assertRaises(KeyError):
+            wb.notify_cells_changed(print, 'Sheet9')
+        with self.assertRaises(ValueError):
+            wb.notify_cells_changed(print, name2, 'a1')
+        with self.assertRaises(ValueError):
+            wb.notify_cells_changed(print, name2, 'a1', 'zzzzz1')
+
+    def test_unwatched_changes(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        (_, name2) = wb.new_sheet()
+        wb.set_cell_contents(name, 'b1', '=a1 * 2')
+        wb.set_cell_contents(name, 'a1', '1')
+        self.assertEqual(wb.notify_cells_master, set())
+
+        calls = []
+        wb.notify_cells_changed(lambda _, cells: calls.append(sorted(cells)),
+                                name2, 'a1', 'a1')
+        wb.set_cell_contents(name, 'a1', '2')
+        self.assertEqual(wb.notify_cells_master, set())
+        wb.set_cell_contents(name2, 'a1', '=Sheet1!b1')
+        self.assertEqual(calls, [[('Sheet2', 'A1')]])
+
+        dispatcher = sheets.NotifyDispatcher()
+        self.addCleanup(dispatcher.close)
+        wb.set_notify_dispatcher(dispatcher)
+        wb.set_cell_contents(name, 'a1', '3')
+        wb.set_cell_contents(name2, 'a2', '3')
+        self.assertTrue(dispatcher.join(5))
+        self.assertEqual(calls, [[('Sheet2', 'A1')], [('Sheet2', 'A1')]])
+
+    def gated_workbook(self, dispatcher):
+        '''
+        Returns a workbook whose first notify function waits for an event
+        before it returns, with the event and the lists of the calls each of
+        its two notify functions received.
+        '''
+        wb = sheets.Workbook()
+        wb.new_sheet()
+        gate = threading.Event()
+        slow_calls = []
+        fast_calls = []
+
+        def slow(workbook, cells):
+            gate.wait()
+            slow_calls.append((sorted(cells), workbook.get_cell_value(
+                'Sheet1', 'b1')))
+        wb.notify_cells_changed(slow)
+        wb.notify_cells_changed(lambda _, cells: fast_calls.append(
+            sorted(cells)))
+        wb.set_notify_dispatcher(dispatcher)
+        self.addCleanup(dispatcher.close)
+        self.addCleanup(gate.set)
+        return (wb, gate, slow_calls, fast_calls)
+
+    def test_dispatcher_coalescing(self):
+        dispatcher = sheets.NotifyDispatcher()
+        (wb, gate, slow_calls, fast_calls) = self.gated_workbook(dispatcher)
+        wb.set_cell_contents('Sheet1', 'b1', '=a1 * 2')
+        while not dispatcher.subscribers[0].busy:
+            pass
+        for i in range(1, 6):
+            wb.set_cell_contents('Sheet1', 'a1', str(i))
+        wb.set_cell_contents('Sheet1', 'c1', 'x')
+        # the edits did not wait for the slow notify function
+        self.assertEqual(slow_calls, [])
+        gate.set()
+        self.assertTrue(dispatcher.join(5))
+
+        # the edits made while the slow notify function was busy reach it in
+        # one call
+        cells = [('Sheet1', 'A1'), ('Sheet1', 'B1'), ('Sheet1', 'C1')]
+        self.assertEqual(slow_calls, [([('Sheet1', 'B1')], decimal.Decimal(10)),
+                                      (cells, decimal.Decimal(10))])
+        self.assertEqual(sorted(set().union(*fast_calls)), cells)
+
+    def test_dispatcher_policies(self):
+        for policy in [sheets.MERGE, sheets.DROP]:
+            dispatcher = sheets.NotifyDispatcher(max_pending=1, policy=policy)
+            (wb, gate, slow_calls, _) = self.gated_workbook(dispatcher)
+            wb.set_cell_contents('Sheet1', 'a1', '1')
+            while not dispatcher.subscribers[0].busy:
+                pass
+            # the queue holds the first change set, the rest do not fit
+            for location in ['a2', 'a3', 'a4']:
+                wb.set_cell_contents('Sheet1', location, '1')
+            gate.set()
+            self.assertTrue(dispatcher.join(5))
+            expected = ([('Sheet1', 'A2'), ('Sheet1', 'A3'), ('Sheet1', 'A4')]
+                        if policy == sheets.MERGE else [('Sheet1', 'A2')])
+            self.assertEqual([cells for (cells, _) in slow_calls],
+                             [[('Sheet1', 'A1')], expected])
+
+        dispatcher = sheets.NotifyDispatcher(max_pending=1,
+                                             policy=sheets.BLOCK)
+        (wb, gate, slow_calls, _) = self.gated_workbook(dispatcher)
+        wb.set_cell_contents('Sheet1', 'a1', '1')
+        while not dispatcher.subscribers[0].busy:
+            pass
+        wb.set_cell_contents('Sheet1', 'a2', '1')
+        edits = threading.Thread(
+            target=wb.set_cell_contents, args=('Sheet1', 'a3', '1'))
+        edits.start()
+        edits.join(0.2)
+        # the edit is made, but waits for room in the queue to return
+        self.assertTrue(edits.is_alive())
+        self.assertEqual(wb.get_cell_value('Sheet1', 'a3'), decimal.Decimal(1))
+        gate.set()
+        edits.join(5)
+        self.assertFalse(edits.is_alive())
+        self.assertTrue(dispatcher.join(5))
+        self.assertEqual(sum(len(cells) for (cells, _) in slow_calls), 3)
+
+        with self.assertRaises(ValueError):
+            sheets.NotifyDispatcher(policy='wait')
+
+    def test_asyncio_dispatcher(self):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        self.addCleanup(loop.close)
+        self.addCleanup(thread.join)
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+
+        calls = []
+
+        async def on_cells_changed(workbook, cells):
+            await asyncio.sleep(0.01)
+            calls.append((sorted(cells),
+                          workbook.get_cell_value('Sheet1', 'b1')))
+
+        wb = sheets.Workbook()
+        wb.new_sheet()
+        wb.notify_cells_changed(on_cells_changed)
+        dispatcher = sheets.AsyncioNotifyDispatcher(loop)
+        wb.set_notify_dispatcher(dispatcher)
+        wb.set_cell_contents('Sheet1', 'b1', '=a1 + 1')
+        for i in range(1, 11):
+            wb.set_cell_contents('Sheet1', 'a1', str(i))
+        self.assertTrue(dispatcher.join(5))
+        self.assertLess(len(calls), 11)
+        self.assertEqual(sorted(set().union(*[cells for (cells, _)
+                                              in calls])),
+                         [('Sheet1', 'A1'), ('Sheet1', 'B1')])
+        self.assertEqual(calls[-1], ([('Sheet1', 'A1'), ('Sheet1', 'B1')],
+                                     decimal.Decimal(11)))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,112 @@
+import decimal
+import pickle
+import unittest
+import sheets
+
+
+class TestParallel(unittest.TestCase):
+    '''
+    This class contains the tests relating to parallel recalculation with
+    set_workers().
+    '''
+    def make_workbooks(self):
+        '''
+        Returns a serial workbook and one that uses two workers for every
+        recalculation, each with a sheet and a list of the notifications it
+        sent.
+        '''
+        workbooks = []
+        for num_workers in [0, 2]:
+            wb = sheets.Workbook()
+            (_, name) = wb.new_sheet()
+            wb.new_sheet()
+            wb.set_workers(num_workers, min_cells=2)
+            self.addCleanup(wb.set_workers, 0)
+            notifications = []
+            wb.notify_cells_changed(
+                lambda _, cells, notifications=notifications:
+                notifications.append(sorted(cells)))
+            workbooks.append((wb, name, notifications))
+        return workbooks
+
+    def assert_same_values(self, wb, parallel_wb, name, locations):
+        for location in locations:
+            value = wb.get_cell_value(name, location)
+            parallel_value = parallel_wb.get_cell_value(name, location)
+            if isinstance(value, sheets.CellError):
+                self.assertEqual(value.get_type(), parallel_value.get_type())
+                self.assertEqual(value.get_detail(),
+                                 parallel_value.get_detail())
+            else:
+                self.assertEqual(value, parallel_value)
+
+    def test_parallel_values(self):
+        ((wb, name, notifications),
+         (parallel_wb, _, parallel_notifications)) = self.make_workbooks()
+        contents = {}
+        for i in range(1, 21):
+            contents[f'a{i}'] = str(i)
+            contents[f'b{i}'] = f'=a{i} * 2 + a1'
+            contents[f'c{i}'] = f'=SUM(b1:b{i}) / (a{i} - 6)'
+            contents[f'd{i}'] = f'=IFERROR(c{i}, "none") & Sheet2!a1'
+        contents['e1'] = '=INDIRECT("b" & a1)'
+        contents['e2'] = '=VLOOKUP(a1, a1:b20, 2)'
+        contents['e3'] = '=e1 + e2'
+        edits = [('a1', '3'), ('a5', '6'), ('a1', '7'), ('a2', '=a1'),
+                 ('a20', None), ('a1', '=e3'), ('a1', '2')]
+        locations = [f'{col}{i}' for col in 'abcde' for i in range(1, 21)]
+        for workbook in [wb, parallel_wb]:
+            workbook.set_cells_contents(name, contents)
+            workbook.set_cell_contents('Sheet2', 'a1', "'!")
+            for (location, cell_contents) in edits:
+                workbook.set_cell_contents(name, location, cell_contents)
+        self.assert_same_values(wb, parallel_wb, name, locations)
+        self.assertEqual(notifications, parallel_notifications)
+        self.assertEqual(parallel_wb.get_cell_value(name, 'd5'), 'none!')
+        self.assertEqual(parallel_wb.get_cell_value(name, 'e3'),
+                         decimal.Decimal(12))
+
+    def test_parallel_thresholds(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.set_workers(2, min_cells=10)
+        self.addCleanup(wb.set_workers, 0)
+        submitted = []
+        submit = wb.pool.submit
+
+        def recording_submit(func, task):
+            submitted.append(len(task[2]))
+            return submit(func, task)
+        wb.pool.submit = recording_submit
+
+        # only levels with enough cells to evaluate go to the workers
+        wb.set_cells_contents(name, {f'b{i}': f'=a1 + {i}'
+                                     for i in range(1, 21)})
+        wb.set_cells_contents(name, {f'c{i}': f'=b{i} * 2'
+                                     for i in range(1, 6)})
+        submitted.clear()
+        wb.set_cell_contents(name, 'a1', '1')
+        self.assertEqual(submitted, [10, 10])
+        self.assertEqual(wb.get_cell_value(name, 'c5'), decimal.Decimal(12))
+
+        # a recalculation that reaches a cycle is done serially
+        wb.set_cell_contents(name, 'c1', '=c2')
+        wb.set_cell_contents(name, 'c2', '=c1 + b2')
+        submitted.clear()
+        wb.set_cell_contents(name, 'a1', '2')
+        self.assertEqual(submitted, [])
+        self.assertEqual(wb.get_cell_value(name, 'c1').get_type(),
+                         sheets.CellErrorType.CIRCULAR_REFERENCE)
+        self.assertEqual(wb.get_cell_value(name, 'b20'), decimal.Decimal(22))
+
+    def test_pickle_cell_error(self):
+        error = sheets.CellError(sheets.CellErrorType.DIVIDE_BY_ZERO,
+                                 'Cannot divide by zero.', ZeroDivisionError())
+        copy = pickle.loads(pickle.dumps(error))
+        self.assertEqual(copy.get_type(), error.get_type())
+        self.assertEqual(copy.get_detail(), error.get_detail())
+        self.assertIsInstance(copy.get_exception(), ZeroDivisionError)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -227,6 +227,31 @@ class TestSorted(unittest.TestCase):
         self.assertEqual(wb.get_cell_value(name, 'a1'), decimal.Decimal('0'))
         self.assertEqual(wb.get_cell_value(name, 'a2'), False)
 
+    def test_sort_booleans_and_numbers(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        # TRUE and 1, and FALSE and 0, are not ties; booleans sort after
+        # numbers whatever order the rows start in
+        expected = [decimal.Decimal(0), decimal.Decimal(1), decimal.Decimal(2),
+                    False, True]
+        for contents in (['TRUE', '1', 'FALSE', '0', '2'],
+                         ['1', 'TRUE', '0', 'FALSE', '2']):
+            for (i, value) in enumerate(contents):
+                wb.set_cell_contents(name, f'a{i + 1}', value)
+                wb.set_cell_contents(name, f'b{i + 1}', f'=a{i + 1}')
+            wb.sort_region(name, 'a1', 'b5', [1])
+            for (i, value) in enumerate(expected):
+                self.assertIs(type(wb.get_cell_value(name, f'a{i + 1}')),
+                              type(value))
+                self.assertEqual(wb.get_cell_value(name, f'a{i + 1}'), value)
+                self.assertEqual(wb.get_cell_value(name, f'b{i + 1}'), value)
+
+            wb.sort_region(name, 'a1', 'b5', [-1])
+            for (i, value) in enumerate(reversed(expected)):
+                self.assertIs(type(wb.get_cell_value(name, f'a{i + 1}')),
+                              type(value))
+                self.assertEqual(wb.get_cell_value(name, f'a{i + 1}'), value)
+
     def test_sort_functions(self):
         wb = sheets.Workbook()
         (_, name) = wb.new_sheet()
@@ -327,6 +352,23 @@ class TestSorted(unittest.TestCase):
         self.assertEqual(wb.get_cell_value(name, 'b2'), decimal.Decimal('4'))
         self.assertEqual(wb.get_cell_value(name, 'b3'), decimal.Decimal('3'))
 
+    def test_secondary_sort_cols(self):
+        # ties on the first column are ordered by the later columns, however
+        # many rows tie and whichever direction each column sorts in
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        rows = [('1', 'b', 'x'), ('2', 'c', 'y'), ('1', 'a', 'y'),
+                ('1', 'c', 'x'), ('2', 'c', 'x'), ('1', 'B', 'z')]
+        for (i, row) in enumerate(rows, 1):
+            for (col, contents) in zip('abc', row):
+                wb.set_cell_contents(name, f'{col}{i}', contents)
+        wb.sort_region(name, 'a1', 'c6', [1, -2, 3])
+        sorted_rows = [tuple(wb.get_cell_contents(name, f'{col}{i}')
+                             for col in 'abc') for i in range(1, 7)]
+        self.assertEqual(sorted_rows, [('1', 'c', 'x'), ('1', 'b', 'x'),
+                                       ('1', 'B', 'z'), ('1', 'a', 'y'),
+                                       ('2', 'c', 'x'), ('2', 'c', 'y')])
+
     def test_sort_errors(self):
         wb = sheets.Workbook()
         (_, name) = wb.new_sheet()
@@ -0,0 +1,147 @@
+import decimal
+import threading
+import unittest
+import sheets
+from sheets.read_write_lock import ReadWriteLock
+
+
+class TestThreads(unittest.TestCase):
+    '''
+    This class contains the tests relating to using workbooks from many
+    threads at once.
+    '''
+    def run_threads(self, targets):
+        '''
+        Runs each target on its own thread, and raises the first exception
+        any of them raised once they have all finished.
+        '''
+        errors = []
+
+        def run(target):
+            try:
+                target()
+            except BaseException as error:
+                errors.append(error)
+        threads = [threading.Thread(target=run, args=(target,))
+                   for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def build_workbook(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        contents = {}
+        for i in range(1, 31):
+            contents[f'a{i}'] = str(i)
+            contents[f'b{i}'] = f'=a{i} * 2 + INDIRECT("a" & {31 - i})'
+            contents[f'c{i}'] = f'=IFERROR(b{i} / (a{i} - 7), "none")'
+        contents['d1'] = '=SUM(b1:b30)'
+        contents['d2'] = '=VLOOKUP(5, a1:c30, 3)'
+        contents['d3'] = '=d4'
+        contents['d4'] = '=d3 + d1'
+        wb.set_cells_contents(name, contents)
+        for i in range(1, 31, 3):
+            wb.set_cell_contents(name, f'a{i}', str(i * 3))
+        wb.set_cell_contents(name, 'd4', '=d1 * 2')
+        return wb
+
+    def workbook_values(self, wb):
+        values = []
+        for location in ['a1', 'b7', 'c7', 'c10', 'd1', 'd2', 'd3', 'd4']:
+            value = wb.get_cell_value('Sheet1', location)
+            if isinstance(value, sheets.CellError):
+                value = value.get_type()
+            values.append(value)
+        return values
+
+    def test_workbooks_on_threads(self):
+        expected = self.workbook_values(self.build_workbook())
+        results = []
+        self.run_threads([lambda: results.append(self.workbook_values(
+            self.build_workbook())) for _ in range(4)])
+        self.assertEqual(results, [expected] * 4)
+
+    def test_readers_and_writer(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        num_cells = 50
+        num_edits = 100
+        wb.set_cell_contents(name, 'a1', '0')
+        wb.set_cells_contents(name, {f'b{i}': f'=a1 + {i}'
+                                     for i in range(1, num_cells + 1)})
+        done = threading.Event()
+
+        def write():
+            try:
+                for edit in range(1, num_edits + 1):
+                    wb.set_cell_contents(name, 'a1', str(edit))
+            finally:
+                done.set()
+
+        def read():
+            # the edits only increase a1, so each value of a1 read later,
+            # from any cell, is at least as large as the last one
+            last = 0
+            while not done.is_set():
+                for i in range(1, num_cells + 1):
+                    value = wb.get_cell_value(name, f'b{i}') - i
+                    self.assertGreaterEqual(value, last)
+                    last = value
+
+        self.run_threads([write] + [read] * 4)
+        self.assertEqual(wb.get_cell_value(name, f'b{num_cells}'),
+                         decimal.Decimal(num_edits + num_cells))
+
+    def test_reads_inside_writes(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        values = []
+        wb.notify_cells_changed(
+            lambda workbook, _: values.append(
+                workbook.get_cell_value(name, 'b1')))
+        wb.set_cell_contents(name, 'b1', '=a1 + 1')
+        with wb.batch():
+            wb.set_cell_contents(name, 'a1', '1')
+            values.append(wb.get_cell_contents(name, 'a1'))
+        self.assertEqual(values, [decimal.Decimal(1), '1', decimal.Decimal(2)])
+
+        # in lazy mode, reading a dirty cell evaluates it
+        wb.set_lazy(True)
+        wb.set_cell_contents(name, 'a1', '5')
+        self.run_threads([lambda: values.append(
+            wb.get_cell_value(name, 'b1'))])
+        self.assertEqual(values[-1], decimal.Decimal(6))
+
+    def test_read_write_lock(self):
+        lock = ReadWriteLock()
+        lock.acquire_read()
+        with self.assertRaises(RuntimeError):
+            lock.acquire_write()
+
+        # a writer waits for the reader, and new readers wait for the writer
+        events = []
+        writer = threading.Thread(target=lambda: (
+            lock.acquire_write(), events.append('write'),
+            lock.release_write()))
+        writer.start()
+        while not lock.writers_waiting:
+            pass
+        reader = threading.Thread(target=lambda: (
+            lock.acquire_read(), events.append('read'), lock.release_read()))
+        reader.start()
+        # the thread that already reads can read again
+        lock.acquire_read()
+        lock.release_read()
+        events.append('release')
+        lock.release_read()
+        writer.join()
+        reader.join()
+        self.assertEqual(events, ['release', 'write', 'read'])
+
+
+if __name__ == '__main__':
+    unittest.main()
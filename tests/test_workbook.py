@@ -96,6 +96,319 @@ class TestWorkbook(unittest.TestCase):
         wb.set_cell_contents(name, 'd14', '   ')
         self.assertEqual(wb.sheets[name.lower()].get_extent(), (0, 0))
 
+    def test_sheet_extent_churn(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        sheet = wb.sheets[name.lower()]
+        # clearing and setting the same cells over and over does not grow
+        # the extent index
+        for i in range(100):
+            wb.set_cell_contents(name, 'c5', str(i))
+            wb.set_cell_contents(name, 'a9', str(i))
+            self.assertEqual(wb.get_sheet_extent(name), (3, 9))
+            wb.set_cell_contents(name, 'a9', None)
+            self.assertEqual(wb.get_sheet_extent(name), (3, 5))
+        self.assertLessEqual(len(sheet.row_heap), 2)
+        self.assertLessEqual(len(sheet.col_heap), 2)
+
+        # after deleting most of a large sheet the extent is the largest row
+        # and column that still have contents
+        wb.set_cells_contents(name, {f'{col}{row}': '1' for col in 'abcdef'
+                                     for row in range(1, 201)})
+        self.assertEqual(wb.get_sheet_extent(name), (6, 200))
+        wb.set_cells_contents(name, {f'{col}{row}': None for col in 'abcdef'
+                                     for row in range(1, 201)
+                                     if not (col == 'b' and row == 150)})
+        self.assertEqual(wb.get_sheet_extent(name), (2, 150))
+        wb.set_cell_contents(name, 'c5', '1')
+        self.assertEqual(wb.get_sheet_extent(name), (3, 150))
+
+        # moving cells clears the cells they are moved from
+        wb.move_cells(name, 'b150', 'c150', 'b1')
+        self.assertEqual(wb.get_sheet_extent(name), (3, 5))
+
+    def assert_graph_consistent(self, wb):
+        '''
+        Checks that the two directions of the dependency graph mirror each
+        other, for both cells and ranges, and that there are no empty entries
+        left behind.
+        '''
+        edges = set()
+        for (sheet_name, sheet_graph) in wb.graph.backward.items():
+            self.assertTrue(sheet_graph)
+            for (location, cells) in sheet_graph.items():
+                self.assertTrue(cells)
+                edges.update((cell, (sheet_name, location)) for cell in cells)
+        forward_edges = set()
+        for (sheet_name, sheet_graph) in wb.graph.forward.items():
+            self.assertTrue(sheet_graph)
+            for (location, cells) in sheet_graph.items():
+                self.assertTrue(cells)
+                forward_edges.update(((sheet_name, location), cell)
+                                     for cell in cells)
+        self.assertEqual(edges, forward_edges)
+
+        range_edges = set()
+        for (sheet_name, sheet_graph) in wb.graph.range_backward.items():
+            for (location, ranges) in sheet_graph.items():
+                self.assertTrue(ranges)
+                range_edges.update((cell_range, (sheet_name, location))
+                                   for cell_range in ranges)
+        index_edges = set()
+        for (sheet_name, index) in wb.graph.ranges.items():
+            self.assertTrue(index.dependents)
+            for (cell_range, cells) in index.dependents.items():
+                index_edges.update(((sheet_name, cell_range), cell)
+                                   for cell in cells)
+        self.assertEqual(range_edges, index_edges)
+
+        # every cell comes after the cells it depends on in the order, and
+        # the cycles are the ones found by computing the order from scratch
+        graph = wb.graph
+        order = graph.order
+        for (cell, dependent) in edges:
+            if graph.has_precedents(*cell):
+                self.assertTrue(order.node(cell) == order.node(dependent) or
+                                order.key(cell) < order.key(dependent))
+        for ((range_sheet, cell_range), dependent) in range_edges:
+            for cell in graph.cells_with_precedents_in(range_sheet,
+                                                       cell_range):
+                self.assertTrue(order.node(cell) == order.node(dependent) or
+                                order.key(cell) < order.key(dependent))
+        self.assertEqual(set(order.keys),
+                         {order.node(cell)
+                          for cell in graph.cells_with_precedents()})
+        expected = type(order)(graph)
+        expected.rebuild()
+        self.assertEqual(set(order.cycles.values()),
+                         set(expected.cycles.values()))
+        self.assertEqual(order.self_loops, expected.self_loops)
+        self.assertEqual(len(order.used_keys), len(order.keys))
+        self.assertEqual(order.used_keys, set(order.keys.values()))
+
+    def test_dependency_graph(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.new_sheet('Other')
+        wb.set_cell_contents(name, 'a1', '=b1 + c1 + Other!a1')
+        self.assertEqual(wb.graph.precedents('sheet1', 'a1'),
+                         {('sheet1', 'b1'), ('sheet1', 'c1'),
+                          ('other', 'a1')})
+        # only the precedents that changed are updated
+        wb.set_cell_contents(name, 'a1', '=b1 + d1 + Other!a1')
+        self.assertEqual(wb.graph.dependents('sheet1', 'c1'), set())
+        self.assertEqual(wb.graph.dependents('sheet1', 'd1'),
+                         {('sheet1', 'a1')})
+        self.assert_graph_consistent(wb)
+
+        wb.set_cell_contents(name, 'a2', '=SUM(b1:b3) + a1')
+        wb.set_cell_contents('Other', 'b1', '=Sheet1!a2 + a1')
+        wb.set_cell_contents(name, 'a3', '=a3')
+        wb.set_cell_contents(name, 'a4', '=Missing!a1')
+        wb.set_cell_contents(name, 'a5', '=SUM(Other!a1:a3)')
+        self.assert_graph_consistent(wb)
+
+        wb.rename_sheet('Other', 'Missing')
+        self.assertEqual(wb.graph.dependents('missing', 'a1'),
+                         {('sheet1', 'a1'), ('sheet1', 'a4'),
+                          ('sheet1', 'a5'), ('missing', 'b1')})
+        self.assertEqual(wb.graph.precedents('missing', 'b1'),
+                         {('sheet1', 'a2'), ('missing', 'a1')})
+        self.assertEqual(wb.graph.range_precedents('sheet1', 'a5'),
+                         {('missing', (1, 1, 1, 3))})
+        self.assertIn(('sheet1', 'a5'), wb.graph.dependents('missing', 'a2'))
+        self.assertNotIn('other', wb.graph.forward)
+        self.assertNotIn('other', wb.graph.backward)
+        self.assertNotIn('other', wb.graph.ranges)
+        self.assert_graph_consistent(wb)
+
+        (_, copy_name) = wb.copy_sheet('Missing')
+        self.assertEqual(wb.graph.precedents(copy_name.lower(), 'b1'),
+                         {('sheet1', 'a2'), (copy_name.lower(), 'a1')})
+        self.assert_graph_consistent(wb)
+
+        # cells in a deleted sheet no longer depend on anything, but formulas
+        # that refer to the sheet still depend on it
+        wb.del_sheet('Missing')
+        self.assertNotIn('missing', wb.graph.backward)
+        self.assertEqual(wb.graph.dependents('missing', 'a1'),
+                         {('sheet1', 'a1'), ('sheet1', 'a4'),
+                          ('sheet1', 'a5')})
+        self.assert_graph_consistent(wb)
+
+        # ranges are kept whole, and found by the cells inside them
+        wb.set_cell_contents(name, 'e1', '=SUM(f1:g9999) + SUM(Sheet1!g2:f1)')
+        self.assertEqual(wb.graph.precedents('sheet1', 'e1'), set())
+        self.assertEqual(wb.graph.range_precedents('sheet1', 'e1'),
+                         {('sheet1', (6, 1, 7, 9999)),
+                          ('sheet1', (6, 1, 7, 2))})
+        self.assertIn(('sheet1', 'e1'), wb.graph.dependents('sheet1', 'g9000'))
+        self.assertIn(('sheet1', 'e1'), wb.graph.dependents('sheet1', 'f1'))
+        self.assertNotIn(('sheet1', 'e1'), wb.graph.dependents('sheet1', 'h1'))
+        self.assertEqual(wb.graph.precedents_in('sheet1', 'e1',
+                                                {('sheet1', 'g5'),
+                                                 ('sheet1', 'h5')}),
+                         {('sheet1', 'g5')})
+        wb.set_cell_contents(name, 'g9000', '5')
+        wb.set_cell_contents(name, 'f2', '=e1')
+        self.assertEqual(wb.get_cell_value(name, 'e1').get_type(),
+                         sheets.CellErrorType.CIRCULAR_REFERENCE)
+        wb.set_cell_contents(name, 'f2', '1')
+        self.assertEqual(wb.get_cell_value(name, 'e1'), decimal.Decimal(7))
+        wb.set_cell_contents(name, 'e1', None)
+        self.assertEqual(wb.graph.range_precedents('sheet1', 'e1'), set())
+        self.assertEqual(wb.graph.dependents('sheet1', 'g9000'), set())
+        self.assertEqual(set(wb.graph.ranges['sheet1'].dependents),
+                         {(2, 1, 2, 3)})
+        wb.set_cells_contents(name, {'g9000': None, 'f2': None})
+
+        wb.move_cells(name, 'a1', 'a4', 'c1')
+        self.assertEqual(wb.graph.precedents('sheet1', 'a1'), set())
+        self.assertEqual(wb.graph.dependents('sheet1', 'c1'),
+                         {('sheet1', 'c2')})
+        self.assert_graph_consistent(wb)
+        for location in ['c1', 'c2', 'c3', 'c4', 'a5']:
+            wb.set_cell_contents(name, location, None)
+        wb.del_sheet(copy_name)
+        self.assertEqual(wb.graph.forward, {})
+        self.assertEqual(wb.graph.ranges, {})
+        self.assertEqual(wb.graph.range_backward, {})
+        self.assertEqual(wb.graph.backward, {})
+
+    def test_cycle_tracking(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        for i in range(1, 21):
+            wb.set_cell_contents(name, f'a{i}', f'=a{i + 1} + b{i}')
+            wb.set_cell_contents(name, f'b{i}', f'=c{i}')
+        wb.set_cell_contents(name, 'c5', '=SUM(a18:a19)')
+        self.assert_graph_consistent(wb)
+        self.assertFalse(wb.graph.order.cycles)
+
+        # the cycles are kept up to date as edits close and break them
+        edits = [('a21', '=a1'), ('c10', '=b3'), ('a21', '1'),
+                 ('b3', '=a2 + c3'), ('c3', '=SUM(a1:b2)'), ('a10', '2'),
+                 ('a10', '=a11 + b10'), ('c5', None), ('b3', '=c3'),
+                 ('a21', '=c5'), ('c5', '=a1'), ('c3', None), ('c10', None)]
+        for (location, contents) in edits:
+            wb.set_cell_contents(name, location, contents)
+            self.assert_graph_consistent(wb)
+            for cell in wb.graph.order.cycles:
+                self.assertEqual(wb.get_cell_value(*cell).get_type(),
+                                 sheets.CellErrorType.CIRCULAR_REFERENCE)
+        self.assertEqual(len(set(wb.graph.order.cycles.values())), 1)
+        # a1 to a21, c5 and b5
+        self.assertEqual(len(wb.graph.order.cycles), 23)
+
+        wb.set_cell_contents(name, 'a21', None)
+        self.assert_graph_consistent(wb)
+        self.assertEqual(len(wb.graph.order.cycles), 7)
+        wb.set_cell_contents(name, 'c5', None)
+        self.assert_graph_consistent(wb)
+        self.assertFalse(wb.graph.order.cycles)
+        self.assertEqual(wb.get_cell_value(name, 'a1'), decimal.Decimal(0))
+
+        # a cell that refers to itself stays an error when something else it
+        # depends on changes
+        wb.set_cell_contents(name, 'd1', '=IFERROR(d1, d2)')
+        wb.set_cell_contents(name, 'd2', '5')
+        self.assertEqual(wb.get_cell_value(name, 'd1').get_type(),
+                         sheets.CellErrorType.CIRCULAR_REFERENCE)
+
+    def test_early_cutoff(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.notify_cells_changed(lambda *_: None)
+        wb.set_cell_contents(name, 'a1', '5')
+        wb.set_cell_contents(name, 'b1', '=IF(a1 > 0, 1, 0)')
+        for i in range(1, 51):
+            wb.set_cell_contents(name, f'c{i}', f'=b1 + {i}')
+        wb.set_cell_contents(name, 'd1', '=SUM(c1:c50)')
+
+        evaluated = []
+        calculate_contents = wb.calculate_contents
+        def counting_calculate_contents(sheet_name, contents, in_scc=False,
+                                        formula=None):
+            evaluated.append(contents)
+            return calculate_contents(sheet_name, contents, in_scc, formula)
+        wb.calculate_contents = counting_calculate_contents
+
+        # the same value, and a value the IF absorbs, stop at the first cells
+        wb.set_cell_contents(name, 'a1', '5')
+        self.assertEqual(evaluated, ['5'])
+        self.assertEqual(wb.notify_cells_master, set())
+        evaluated.clear()
+        wb.set_cell_contents(name, 'a1', '7')
+        self.assertEqual(evaluated, ['7', '=IF(a1 > 0, 1, 0)'])
+        self.assertEqual(wb.notify_cells_master, {(name, 'A1')})
+
+        # a change that gets through is propagated as before
+        evaluated.clear()
+        wb.set_cell_contents(name, 'a1', '-1')
+        self.assertEqual(len(evaluated), 53)
+        self.assertEqual(wb.get_cell_value(name, 'd1'), decimal.Decimal(1275))
+        self.assertEqual(len(wb.notify_cells_master), 53)
+
+        # a cell that depends on several changed cells is evaluated once,
+        # after all of them
+        evaluated.clear()
+        with wb.batch():
+            wb.set_cell_contents(name, 'c1', '=b1 + 2')
+            wb.set_cell_contents(name, 'c2', '=b1 + 3')
+        self.assertEqual(evaluated, ['=b1 + 2', '=b1 + 3', '=SUM(c1:c50)'])
+        self.assertEqual(wb.get_cell_value(name, 'd1'), decimal.Decimal(1277))
+
+        # a cell that starts reading a changed cell while it is evaluated,
+        # before that cell, is evaluated again once the cell changes
+        wb.calculate_contents = calculate_contents
+        wb.set_cell_contents(name, 'e3', '5')
+        wb.set_cell_contents(name, 'e2', '=a1 * 2')
+        wb.set_cell_contents(name, 'e1', '=INDIRECT(IF(a1 > 10, "e2", "e3"))')
+        self.assertEqual(wb.get_cell_value(name, 'e1'), decimal.Decimal(5))
+        wb.set_cell_contents(name, 'a1', '11')
+        self.assertEqual(wb.get_cell_value(name, 'e1'), decimal.Decimal(22))
+
+    def test_bool_number_changes(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        notifications = []
+        wb.notify_cells_changed(
+            lambda _, cells: notifications.append(sorted(cells)))
+        wb.set_cell_contents(name, 'a1', 'TRUE')
+        wb.set_cell_contents(name, 'b1', '=a1')
+        wb.set_cell_contents(name, 'c1', '=a1 & ""')
+        cells = [(name, 'A1'), (name, 'B1'), (name, 'C1')]
+
+        # TRUE equals 1 in Python, but the value still changed
+        notifications.clear()
+        wb.set_cell_contents(name, 'a1', '1')
+        self.assertEqual(wb.get_cell_value(name, 'b1'), decimal.Decimal(1))
+        self.assertEqual(wb.get_cell_value(name, 'c1'), '1')
+        self.assertEqual(notifications, [cells])
+
+        wb.set_cell_contents(name, 'a1', '0')
+        notifications.clear()
+        with wb.batch():
+            wb.set_cell_contents(name, 'a1', 'FALSE')
+        self.assertIs(wb.get_cell_value(name, 'b1'), False)
+        self.assertEqual(wb.get_cell_value(name, 'c1'), 'FALSE')
+        self.assertEqual(notifications, [cells])
+
+    def test_references_changed_during_update(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.set_cell_contents(name, 'a1', '1')
+        wb.set_cell_contents(name, 'b1', '=a1 * 2')
+        # a formula that changes its references during an update moves the
+        # cells after it in the order
+        wb.set_cell_contents(name, 'd1', '=INDIRECT(IF(a1 > 10, "b1", "d3"))')
+        wb.set_cell_contents(name, 'd3', '=d2')
+        wb.set_cell_contents(name, 'e1', '=d1 + d3')
+        wb.set_cell_contents(name, 'd2', '100')
+        self.assertEqual(wb.get_cell_value(name, 'e1'), decimal.Decimal(200))
+        wb.set_cell_contents(name, 'a1', '11')
+        self.assertEqual(wb.get_cell_value(name, 'e1'), decimal.Decimal(122))
+
     def test_is_cell_location_valid(self):
         wb = sheets.Workbook()
         self.assertTrue(wb.is_valid_cell_location('a15'))
@@ -415,6 +728,38 @@ class TestWorkbook(unittest.TestCase):
         self.assertEqual(wb.get_cell_value(name, 'd2'), decimal.Decimal(5))
         self.assertEqual(wb.get_cell_value(name, 'e2'), decimal.Decimal(10))
 
+    def test_update_absolute_and_conditional_refs(self):
+        # absolute references are dependencies like any other reference
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.set_cell_contents(name, 'a1', '1')
+        wb.set_cell_contents(name, 'b1', '=$A$1 + a$1')
+        wb.set_cell_contents(name, 'a1', '5')
+        self.assertEqual(wb.get_cell_value(name, 'b1'), decimal.Decimal(10))
+
+        # the same compiled formula is shared by cells on different sheets
+        (_, name2) = wb.new_sheet()
+        wb.set_cell_contents(name2, 'a1', '2')
+        wb.set_cell_contents(name2, 'b1', '=$A$1 + a$1')
+        self.assertEqual(wb.get_cell_value(name2, 'b1'), decimal.Decimal(4))
+        self.assertEqual(wb.get_cell_value(name, 'b1'), decimal.Decimal(10))
+
+        # only the IF branch that was taken is a dependency, so switching
+        # branches can make and break a cycle
+        wb.set_cell_contents(name, 'c1', '=IF(a1 > 3, d1, 7)')
+        wb.set_cell_contents(name, 'd1', '=c1')
+        value = wb.get_cell_value(name, 'c1')
+        self.assertEqual(value.get_type(),
+                         sheets.CellErrorType.CIRCULAR_REFERENCE)
+        wb.set_cell_contents(name, 'a1', '1')
+        self.assertEqual(wb.get_cell_value(name, 'c1'), decimal.Decimal(7))
+        self.assertEqual(wb.get_cell_value(name, 'd1'), decimal.Decimal(7))
+
+        # references built by INDIRECT are dependencies
+        wb.set_cell_contents(name, 'e1', '=INDIRECT("f" & 1) * 2')
+        wb.set_cell_contents(name, 'f1', '21')
+        self.assertEqual(wb.get_cell_value(name, 'e1'), decimal.Decimal(42))
+
     def test_update_unknown_sheet(self):
         # tests the case if sheet is unknown to begin with, then gets added
         wb = sheets.Workbook()
@@ -1,5 +1,7 @@
 import decimal
 import unittest
+from unittest import mock
+import lark
 import sheets
 
 
@@ -142,7 +144,56 @@ class TestWorkbookModifications(unittest.TestCase):
         self.assertEqual(name5, "Sheet1_1_1")
         self.assertEqual(i, 3)
         self.assertEqual(wb.get_cell_value(name5, 'a6'), decimal.Decimal(9))
-    
+
+        # formulas in the copy depend on the copy's cells, not the original's
+        wb.set_cell_contents(name5, 'a1', '1')
+        self.assertEqual(wb.get_cell_value(name5, 'a10'), decimal.Decimal(11))
+        self.assertEqual(wb.get_cell_value(name, 'a10'), decimal.Decimal(99))
+
+    def test_copy_sheet_shares_cells(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        wb.set_cell_contents(name, 'a1', '2')
+        wb.set_cell_contents(name, 'a2', '=a1 * 3')
+        wb.set_cell_contents(name, 'a3', '=Sheet1_2!a2 + a2')
+        wb.set_cell_contents(name, 'a4', '=SUM(a1:a2)')
+
+        evaluated = []
+        calculate_contents = wb.calculate_contents
+
+        def counting_calculate_contents(sheet_name, contents, in_scc=False,
+                                        formula=None):
+            evaluated.append((sheet_name, contents))
+            return calculate_contents(sheet_name, contents, in_scc, formula)
+        wb.calculate_contents = counting_calculate_contents
+
+        # the copy shares the cells, and none of its formulas are evaluated
+        (_, name2) = wb.copy_sheet(name)
+        self.assertIs(wb.sheets[name2.lower()].cells,
+                      wb.sheets[name.lower()].cells)
+        self.assertEqual(evaluated, [])
+        self.assertEqual(wb.get_cell_value(name2, 'a4'), decimal.Decimal(8))
+
+        # only the formulas that named the next copy are evaluated
+        (_, name3) = wb.copy_sheet(name)
+        self.assertEqual(sorted(evaluated),
+                         [(sheet_name, '=Sheet1_2!a2 + a2')
+                          for sheet_name in ['sheet1', 'sheet1_1',
+                                             'sheet1_2']])
+        for sheet_name in [name, name2, name3]:
+            self.assertEqual(wb.get_cell_value(sheet_name, 'a3'),
+                             decimal.Decimal(12))
+
+        # each sheet keeps its own cells once either is changed
+        wb.set_cell_contents(name, 'a1', '5')
+        self.assertEqual(wb.get_cell_value(name, 'a4'), decimal.Decimal(20))
+        self.assertEqual(wb.get_cell_value(name2, 'a4'), decimal.Decimal(8))
+        wb.set_cell_contents(name2, 'a1', '1')
+        self.assertEqual(wb.get_cell_value(name, 'a2'), decimal.Decimal(15))
+        self.assertEqual(wb.get_cell_value(name2, 'a4'), decimal.Decimal(4))
+        self.assertEqual(wb.get_cell_value(name3, 'a4'), decimal.Decimal(8))
+        self.assertEqual(wb.get_sheet_extent(name2), (1, 4))
+
     def test_copy_sheet_cell_errors(self):
         wb = sheets.Workbook()
         (_, name) = wb.new_sheet()
@@ -348,6 +399,75 @@ class TestWorkbookModifications(unittest.TestCase):
         self.assertEqual(list(wb.sheet_names.keys()), [name.lower(), name2.lower()])
         self.assertEqual(wb.get_cell_contents(name, 'a1'), "=temp!A5 + 'new*sheet'!A6")
 
+    def test_rename_keeps_values(self):
+        wb = sheets.Workbook()
+        (_, name) = wb.new_sheet()
+        (_, name2) = wb.new_sheet()
+        wb.set_cell_contents(name2, 'a1', '4')
+        wb.set_cell_contents(name, 'a1', f'={name2}!a1 * 2')
+        wb.set_cell_contents(name, 'a2', f'="{name2}" & {name2}!a1')
+        wb.set_cell_contents(name, 'a3', '=Data!a1 + 1')
+        wb.set_cell_contents(name, 'a4', f'=INDIRECT("{name2}!a1")')
+        wb.set_cell_contents(name, 'a5', f'=INDIRECT("{name2}" & "!a1")')
+        wb.set_cell_contents(name2, 'b1', f'=SUM({name2}!a1:a2) + {name}!a1')
+
+        parses = []
+        parse = lark.Lark.parse
+
+        def counting_parse(parser, text, *args, **kwargs):
+            parses.append(text)
+            return parse(parser, text, *args, **kwargs)
+
+        evaluated = []
+        calculate_contents = wb.calculate_contents
+
+        def counting_calculate_contents(sheet_name, contents, in_scc=False,
+                                        formula=None):
+            evaluated.append(contents if formula is None
+                             else formula.get_text())
+            return calculate_contents(sheet_name, contents, in_scc, formula)
+        wb.calculate_contents = counting_calculate_contents
+
+        # only the formulas that named the missing sheet, and the ones that
+        # find their sheet with INDIRECT, are evaluated again
+        with mock.patch.object(lark.Lark, 'parse', counting_parse):
+            wb.rename_sheet(name2, 'Data')
+        # only the reference INDIRECT now reads is new text
+        self.assertEqual(parses, ['=Data!a1'])
+        self.assertEqual(sorted(evaluated),
+                         ['=Data!a1 + 1', '=INDIRECT("Data!a1")',
+                          f'=INDIRECT("{name2}" & "!a1")'])
+
+        # text inside strings is not a reference, unless it is the
+        # reference INDIRECT is given
+        self.assertEqual(wb.get_cell_contents(name, 'a1'), '=Data!a1 * 2')
+        self.assertEqual(wb.get_cell_contents(name, 'a2'),
+                         f'="{name2}" & Data!a1')
+        self.assertEqual(wb.get_cell_contents('Data', 'b1'),
+                         f'=SUM(Data!a1:a2) + {name}!a1')
+        self.assertEqual(wb.get_cell_value(name, 'a1'), decimal.Decimal(8))
+        self.assertEqual(wb.get_cell_value(name, 'a2'), f'{name2}4')
+        self.assertEqual(wb.get_cell_value(name, 'a3'), decimal.Decimal(5))
+        self.assertEqual(wb.get_cell_contents(name, 'a4'),
+                         '=INDIRECT("Data!a1")')
+        self.assertEqual(wb.get_cell_contents(name, 'a5'),
+                         f'=INDIRECT("{name2}" & "!a1")')
+        self.assertEqual(wb.get_cell_value(name, 'a4'), decimal.Decimal(4))
+        self.assertEqual(wb.get_cell_value(name, 'a5').get_type(),
+                         sheets.CellErrorType.BAD_REFERENCE)
+        self.assertEqual(wb.get_cell_value('Data', 'b1'), decimal.Decimal(12))
+
+        # the renamed formulas keep their dependencies
+        wb.set_cell_contents('Data', 'a1', '5')
+        self.assertEqual(wb.get_cell_value(name, 'a1'), decimal.Decimal(10))
+        self.assertEqual(wb.get_cell_value(name, 'a3'), decimal.Decimal(6))
+        self.assertEqual(wb.get_cell_value(name, 'a4'), decimal.Decimal(5))
+        self.assertEqual(wb.get_cell_value('Data', 'b1'), decimal.Decimal(15))
+        (_, copy_name) = wb.copy_sheet(name)
+        self.assertEqual(wb.get_cell_value(copy_name, 'a1'), decimal.Decimal(10))
+        wb.set_cell_contents('Data', 'a1', '6')
+        self.assertEqual(wb.get_cell_value(copy_name, 'a1'), decimal.Decimal(12))
+
     def test_rename_update(self):
         wb = sheets.Workbook()
         (_, name) = wb.new_sheet()